@@ -4,11 +4,14 @@ used to collect statistics over a given time interval,
 aggregate and then submit to Graphite.
 """
 import logging
+import threading
 import time
 import metrics
+from util import KeyLimiter
 
 class Aggregator(object):
-    def __init__(self, metrics_store, metrics_settings={}):
+    def __init__(self, metrics_store, metrics_settings={}, metrics_state=None,
+                 metrics_lock=None):
         """
         An aggregator accumulates metrics via the :meth:`add_metrics()` call
         until :meth:`flush()` is called. Flushing will be initiated in a new
@@ -21,9 +24,35 @@ class Aggregator(object):
 
         :Parameters:
             - `metrics_store`: The metrics storage instance to flush to.
+            - `metrics_settings` (optional): The settings for each metric
+            type, keyed by the metric type shorthand.
+            - `metrics_state` (optional): A dictionary which outlives the
+            aggregator, in which stateful metrics such as gauges keep the
+            state they carry from one flush interval to the next. It is
+            keyed by metric class and should be shared by all of the
+            aggregators in turn.
+            - `metrics_lock` (optional): The lock which guards the metrics
+            state, which must be shared along with it, since the flushes
+            of several aggregators may run at once.
         """
         self.metrics_store = metrics_store
         self.metrics_settings = self._load_metric_settings(metrics_settings)
+        self.metrics_state = metrics_state if metrics_state is not None else {}
+        self.metrics_lock = metrics_lock if metrics_lock is not None else threading.Lock()
+
+        # The time to stamp the flushed metrics with, which Statsite sets
+        # to the end of the flush interval. Defaults to the time of folding.
+        self.timestamp = None
+
+        # Statsite's own metrics for the interval, keyed by name, which
+        # Statsite sets when self-instrumentation is enabled. They are
+        # flushed under the namespace along with the aggregator's own.
+        self.internal_metrics = None
+        self.internal_namespace = "statsite"
+
+        # The limiter of the number of keys in the interval, if any, which
+        # aggregators set if they bound the number of keys
+        self.limiter = None
 
     def add_metrics(self, metrics):
         """
@@ -32,6 +61,22 @@ class Aggregator(object):
         """
         raise NotImplementedError()
 
+    def add_batch(self, batch):
+        """
+        Add a batch of parsed metrics to be aggregated in the next flushing
+        period. The batch is a dictionary of lists of (key,value,flag) tuples
+        keyed by metric class, as returned by :meth:`Collector._parse_batch()`.
+
+        By default this creates the metric objects and calls
+        :meth:`add_metrics()`, but aggregators should override this
+        to fold in the records directly.
+        """
+        metrics = []
+        for cls,records in batch.iteritems():
+            metrics.extend([cls(key, value, flag) for key,value,flag in records])
+
+        self.add_metrics(metrics)
+
     def flush(self):
         """
         This method will be called to run in a specific thread. It is responsible
@@ -39,18 +84,42 @@ class Aggregator(object):
         """
         raise NotImplementedError()
 
+    def size(self):
+        """
+        Returns a tuple of the number of keys aggregated so far and the
+        number of samples buffered for them. This may be called from
+        another thread while metrics are being added, so it may be a
+        little off. Aggregators which don't keep track return (0, 0).
+        """
+        return (0, 0)
+
+    def drain(self):
+        """
+        Returns everything aggregated so far as a picklable partial aggregate
+        and resets the aggregator. Partial aggregates are used to combine the
+        work of aggregators in other processes using :meth:`merge()`.
+        """
+        raise NotImplementedError()
+
+    def merge(self, partial):
+        """
+        Merges a partial aggregate returned by :meth:`drain()` of another
+        aggregator into this one. This is called prior to :meth:`flush()`.
+        """
+        raise NotImplementedError()
+
     def _load_metric_settings(self, settings):
         """
         This method takes a list of settings set by the Statsite program,
         in the format of a dictionary keyed by the shorthand for the metric,
         example:
 
-            { "ms": { "percentile": 80 } }
+            { "ms": { "percentile": [80, 99] } }
 
         And it turns it into a fast lookup based on the class that that
         setting actually represents:
 
-            { Timer: { "percentile": 80 } }
+            { Timer: { "percentile": [80, 99] } }
 
         This format is much more efficient for ``_fold_metrics``.
         """
@@ -65,45 +134,234 @@ class Aggregator(object):
         This method will go over an array of metric objects and fold them into
         a list of data.
         """
-        # Store the metrics as a dictionary by queue type
-        metrics_by_type = {}
+        accumulators = {}
+        self._accumulate(accumulators, metrics)
+        return self._fold_accumulators(accumulators)
+
+    def _accumulate(self, accumulators, metrics):
+        """
+        Folds each of the given metric objects into the accumulator for
+        its type, creating accumulators as necessary. ``accumulators`` is
+        a dictionary keyed by metric class.
+        """
         for metric in metrics:
-            key = type(metric)
-            metrics_by_type.setdefault(key, [])
-            metrics_by_type[key].append(metric)
+            cls = type(metric)
+            accum = accumulators.get(cls)
+            if accum is None:
+                accum = accumulators[cls] = cls.accumulator(**self.metrics_settings.get(cls, {}))
 
-        # Fold over the metrics
+            metric._fold(accum)
+
+    def _fold_internal_metrics(self, accumulators, fold_seconds, names=None):
+        """
+        Returns the internal metrics given by Statsite as a list of data,
+        along with the number of keys in the accumulators and the seconds
+        it took to fold them.
+        """
+        stats = dict(self.internal_metrics)
+        stats["aggregator.keys"] = sum([len(accum) for accum in accumulators.itervalues()])
+        if self.limiter is not None:
+            stats["aggregator.overflowed"] = self.limiter.overflowed
+        stats["aggregator.fold_seconds"] = fold_seconds
+
+        now = self.timestamp if self.timestamp is not None else time.time()
+        lookup = (names or metrics.UNCACHED_NAMES).lookup(self.internal_namespace)
+        return [(lookup(key)[0], value, now) for key,value in sorted(stats.iteritems())]
+
+    def _limit_accumulator(self, cls, accum, limiter=None):
+        """
+        Returns the given accumulator with its keys limited by the given
+        :class:`KeyLimiter`, or else that of the aggregator, merging the
+        state of keys which are over the limits into that of their
+        overflow keys.
+        """
+        limit = (limiter or self.limiter).limit
+        if not isinstance(accum, dict):
+            return [(limit(record[0]),) + tuple(record[1:]) for record in accum]
+
+        limited = cls.accumulator(**self.metrics_settings.get(cls, {}))
+        overflowed = []
+        for key,value in accum.iteritems():
+            new_key = limit(key)
+            if new_key == key:
+                limited[key] = value
+            else:
+                overflowed.append({new_key: value})
+
+        # Merge the overflowing keys one at a time, so that the metric
+        # combines the state of every key folded into the same overflow key
+        for other in overflowed:
+            cls.merge(limited, other)
+
+        return limited
+
+    def _limit_state(self, cls, accum, state):
+        """
+        Returns the accumulator of a stateful metric with its keys limited
+        along with the keys of its state. The state outlives the interval,
+        so it would otherwise grow by up to the limits every interval.
+        """
+        limiter = self.limiter
+        state_limiter = KeyLimiter(limiter.max_keys, limiter.max_keys_per_prefix,
+                                   limiter.prefix_depth, limiter.overflow_key)
+        state_limiter.admit(state)
+        accum = self._limit_accumulator(cls, accum, state_limiter)
+        limiter.overflowed += state_limiter.overflowed
+        return accum
+
+    def _fold_accumulators(self, accumulators, names=None):
+        """
+        This method takes a dictionary of accumulators keyed by metric class
+        and folds them into a list of data. If the :class:`OutputNames`
+        of the metrics store are given, the data is named with its prefix.
+        """
         data = []
-        now = time.time()
-        for cls,metrics in metrics_by_type.iteritems():
-            data.extend(cls.fold(metrics, now, **self.metrics_settings.get(cls, {})))
+        now = self.timestamp if self.timestamp is not None else time.time()
+        for cls,accum in accumulators.iteritems():
+            if not cls.stateful:
+                settings = self.metrics_settings.get(cls, {})
+                data.extend(cls.fold_accumulator(accum, now, names=names, **settings))
+
+        # The state is shared with the aggregators of other intervals,
+        # which may be flushing at the same time
+        with self.metrics_lock:
+            for cls,accum in accumulators.iteritems():
+                if cls.stateful:
+                    settings = self.metrics_settings.get(cls, {})
+                    state = self.metrics_state.setdefault(cls, {})
+                    if self.limiter is not None:
+                        accum = self._limit_state(cls, accum, state)
+                    data.extend(cls.fold_accumulator(accum, now, state=state, names=names, **settings))
+
+            # Stateful metrics still emit their state for intervals in which
+            # none of them were received
+            for cls,state in self.metrics_state.iteritems():
+                if cls not in accumulators:
+                    settings = self.metrics_settings.get(cls, {})
+                    accum = cls.accumulator(**settings)
+                    data.extend(cls.fold_accumulator(accum, now, state=state, names=names, **settings))
 
         return data
 
 class DefaultAggregator(Aggregator):
     def __init__(self, *args, **kwargs):
+        """
+        The default aggregator folds metrics into a running state per key
+        as they are added, so that memory scales with the number of
+        distinct keys rather than the number of metrics received, and
+        flushing only has to go over the keys.
+
+        The number of distinct keys in each interval can be bounded with
+        the ``max_keys`` and ``max_keys_per_prefix`` keyword arguments,
+        along with ``prefix_depth`` and ``overflow_key``, which are
+        given to a :class:`KeyLimiter`. Once a limit is reached, metrics
+        for new keys are folded into the overflow key instead.
+        """
+        limits = {}
+        for name in ("max_keys", "max_keys_per_prefix", "prefix_depth", "overflow_key"):
+            if name in kwargs:
+                limits[name] = kwargs.pop(name)
+
         super(DefaultAggregator, self).__init__(*args, **kwargs)
 
-        self.metrics_queue = []
+        # Collector threads may still be adding to this aggregator while
+        # it is being flushed, so the accumulators are only touched under
+        # the lock, and flushing detaches them before folding
+        self.accumulators = {}
+        self.lock = threading.Lock()
+        if int(limits.get("max_keys", 0)) or int(limits.get("max_keys_per_prefix", 0)):
+            self.limiter = KeyLimiter(**limits)
+
         self.logger = logging.getLogger("statsite.aggregator.default")
 
     def add_metrics(self, metrics):
-        self.metrics_queue.extend(metrics)
+        with self.lock:
+            limiter = self.limiter
+            if limiter is not None:
+                for metric in metrics:
+                    metric.key = limiter.limit(metric.key)
+
+            self._accumulate(self.accumulators, metrics)
+
+    def add_batch(self, batch):
+        with self.lock:
+            accumulators = self.accumulators
+            limiter = self.limiter
+            for cls,records in batch.iteritems():
+                accum = accumulators.get(cls)
+                if accum is None:
+                    accum = accumulators[cls] = cls.accumulator(**self.metrics_settings.get(cls, {}))
+
+                if limiter is not None:
+                    records = limiter.limit_records(records)
+
+                cls.accumulate(accum, records)
+
+    def drain(self):
+        with self.lock:
+            accumulators, self.accumulators = self.accumulators, {}
+            if self.limiter is not None:
+                self.limiter.reset()
+            return accumulators
+
+    def size(self):
+        # Every value of a list, such as the values of a timer, is a
+        # sample, while other accumulated values stand for a single one.
+        # Accumulators which are lists hold a record per sample.
+        keys = 0
+        samples = 0
+        for accum in self.accumulators.values():
+            if isinstance(accum, dict):
+                keys += len(accum)
+                samples += sum([len(value) if isinstance(value, list) else 1
+                                for value in accum.values()])
+            else:
+                keys += len(set([record[0] for record in accum]))
+                samples += len(accum)
+
+        return (keys, samples)
+
+    def merge(self, partial):
+        with self.lock:
+            for cls,other in partial.iteritems():
+                if self.limiter is not None:
+                    other = self._limit_accumulator(cls, other)
+
+                accum = self.accumulators.get(cls)
+                if accum is None:
+                    self.accumulators[cls] = other
+                else:
+                    cls.merge(accum, other)
 
     def flush(self):
+        # Detach the accumulators, so that a collector thread which still
+        # holds on to this aggregator can't change them while folding
+        with self.lock:
+            accumulators, self.accumulators = self.accumulators, {}
+
         if self.logger.isEnabledFor(logging.DEBUG):
             self.logger.debug("Aggregating data...")
 
-            for metric in self.metrics_queue:
-                self.logger.debug("Metric: %s" % repr(metric))
+            for cls,accum in accumulators.iteritems():
+                self.logger.debug("Metric: %s (%d entries)" % (cls.__name__, len(accum)))
+
+        # Stores which cache the names of the keys they flush have the
+        # folds name the data, so they don't have to add their prefix
+        names = getattr(self.metrics_store, "names", None)
 
+        data = []
         try:
-            data = self._fold_metrics(self.metrics_queue)
+            start = time.time()
+            data = self._fold_accumulators(accumulators, names)
+            if self.internal_metrics is not None:
+                data.extend(self._fold_internal_metrics(accumulators, time.time() - start, names))
         except:
             self.logger.exception("Failed to fold metrics data")
 
         try:
-            if data:
+            if data and names is not None:
+                self.metrics_store.flush(data, prefixed=True)
+            elif data:
                 self.metrics_store.flush(data)
         except:
             self.logger.exception("Failed to flush data")
@@ -2,19 +2,101 @@
 Contains classes which handle the TCP aliveness check.
 """
 
+import json
 import logging
+import socket
 import SocketServer
 
 LOGGER = logging.getLogger("statsite.aliveness")
 
+class AlivenessServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    The TCP server of the aliveness check, which gives its handlers the
+    Statsite server being checked in its ``statsite`` attribute.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, handler, statsite=None):
+        SocketServer.TCPServer.__init__(self, address, handler)
+        self.statsite = statsite
+
 class AlivenessHandler(SocketServer.BaseRequestHandler):
     """
     This is the TCP handler which responds to any aliveness checks
-    to Statsite. This handler simply responds to every packet received
-    with the contents of "YES" (all caps). This is so that in the future
-    if smarter checks are done, "NO" could possibly respond as well.
+    to Statsite. This handler responds to every connection with the
+    contents of "YES" (all caps), or "NO" if Statsite isn't keeping
+    up with flushing its metrics, whether or not anything is sent.
+
+    HTTP requests are answered over HTTP instead, with a status of 200 if
+    Statsite is healthy or 503 if it isn't:
+
+    * ``GET /`` responds with "YES" or "NO".
+    * ``GET /stats`` responds with the live numbers of :meth:`Statsite.stats()`
+      as a JSON object.
+    * ``POST /profile`` starts profiling Statsite, as :meth:`Statsite.profile()`.
+    """
+
+    HTTP_METHODS = ("GET", "HEAD", "POST")
+    "The request methods which mark a request as HTTP."
+
+    REQUEST_TIMEOUT = 0.2
+    """
+    The seconds to wait for a request before answering, since checks
+    which only connect and wait for "YES" never send anything.
     """
 
     def handle(self):
         LOGGER.debug("Aliveness check from: %s" % self.client_address[0])
-        self.request.send("YES")
+        self.request.settimeout(self.REQUEST_TIMEOUT)
+        try:
+            data = self.request.recv(4096)
+        except socket.error:
+            data = ""
+
+        request_line = data.split("\n", 1)[0].split()
+        if len(request_line) == 3 and request_line[0] in self.HTTP_METHODS and \
+                request_line[2].startswith("HTTP/"):
+            self._handle_http(request_line[0], request_line[1])
+        else:
+            self.request.sendall("YES" if self._healthy() else "NO")
+
+    def _handle_http(self, method, path):
+        """
+        Responds to an HTTP request for the given path.
+        """
+        statsite = self.server.statsite
+        path = path.split("?", 1)[0]
+        status = 200 if self._healthy() else 503
+
+        if path == "/" and method in ("GET", "HEAD"):
+            self._respond(status, "YES" if status == 200 else "NO")
+        elif path == "/stats" and method in ("GET", "HEAD") and statsite is not None:
+            stats = statsite.stats()
+            stats["healthy"] = status == 200
+            self._respond(status, json.dumps(stats, sort_keys=True), "application/json")
+        elif path == "/profile" and method == "POST" and statsite is not None:
+            if statsite.profile():
+                self._respond(202, "Profiling")
+            else:
+                self._respond(409, "Already profiling")
+        else:
+            self._respond(404, "Not found")
+
+    def _healthy(self):
+        """
+        Returns whether Statsite is keeping up.
+        """
+        statsite = self.server.statsite
+        return statsite is None or statsite.healthy()
+
+    def _respond(self, status, body, content_type="text/plain"):
+        """
+        Writes an HTTP response with the given status and body.
+        """
+        reasons = {200: "OK", 202: "Accepted", 404: "Not Found",
+                   409: "Conflict", 503: "Service Unavailable"}
+        self.request.sendall("HTTP/1.0 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n"
+                             "Connection: close\r\n\r\n%s" %
+                             (status, reasons[status], content_type, len(body), body))
@@ -63,6 +63,7 @@ class StatsiteCommand(object):
         Runs the statiste application.
         """
         signal.signal(signal.SIGINT, self._on_sigint)
+        signal.signal(signal.SIGUSR1, self._on_sigusr1)
         self.statsite = Statsite(self.settings)
 
         # Run Statsite in a separate thread so that signal handlers can
@@ -84,6 +85,13 @@ class StatsiteCommand(object):
         if self.statsite:
             self.statsite.shutdown()
 
+    def _on_sigusr1(self, signal, frame):
+        """
+        Called when a SIGUSR1 is sent to profile the running statsite server.
+        """
+        if self.statsite:
+            self.statsite.profile()
+
     def _parse_settings_from_file(self, paths):
         """
         Parses settings from a configuration file.
@@ -3,19 +3,39 @@ Contains the base class for collectors as well as the built-in UDP
 collector.
 """
 
+import errno
 import logging
+import multiprocessing
+import select
+import signal
 import socket
 import SocketServer
+import sys
+import threading
+import time
 
 import metrics
 import parser
 
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15 if sys.platform.startswith("linux") else None)
+"""
+The ``SO_REUSEPORT`` socket option, which older Pythons don't expose even
+when the platform supports it. This is ``None`` if it isn't supported.
+"""
+
 class Collector(object):
     """
     Collectors should inherit from this class, which provides the
     necessary interface and helpers for implementing a collector.
     """
 
+    aggregates_elsewhere = False
+    """
+    Whether the metrics are aggregated outside of this process, in which
+    case the aggregator of this process holds nothing until the partial
+    aggregates are merged into it at the end of the interval.
+    """
+
     def __init__(self, aggregator):
         """
         Initializes a collector. Subclasses can override this with custom
@@ -25,6 +45,12 @@ class Collector(object):
         self.logger = logging.getLogger("statsite.collector")
         self.aggregator = aggregator
 
+        # Count what is received for self-instrumentation. These only ever
+        # go up, and may miss the odd increment under contention.
+        self.packets = 0
+        self.lines = 0
+        self.parse_errors = 0
+
     def start(self):
         """
         This method must be implemented by collectors, and is called
@@ -47,6 +73,16 @@ class Collector(object):
         """
         self.aggregator = aggregator
 
+    def collect_partials(self):
+        """
+        This method is called right after :meth:`set_aggregator()` when
+        switching aggregators. Collectors which aggregate metrics outside
+        of the main process should return the partial aggregates (see
+        :meth:`Aggregator.drain()`) for the interval that just ended, so
+        they can be merged into the aggregator being flushed.
+        """
+        return []
+
     def _parse_metrics(self, message):
         """
         Given a raw message of metrics split by newline characters, this will
@@ -55,16 +91,20 @@ class Collector(object):
         This will raise a :exc:`ValueError` if any metrics are invalid, unless
         ``ignore_errors`` is set to True.
         """
+        self.packets += 1
+
         results = []
         for line in message.split("\n"):
             # If the line is blank, we ignore it
             if len(line) == 0: continue
+            self.lines += 1
 
             # Parse the line, and skip it if its invalid
             try:
                 (key, value, metric_type, flag) = parser.parse_line(line)
             except ValueError:
                 self.logger.error("Invalid line syntax: %s" % line)
+                self.parse_errors += 1
                 continue
 
             # Create the metric and store it in our results
@@ -75,7 +115,42 @@ class Collector(object):
             else:
                 # Ignore the bad invalid metric, but log it
                 self.logger.error("Invalid metric '%s' in line: %s" % (metric_type, line))
+                self.parse_errors += 1
+
+        return results
+
+    def _parse_batch(self, message, packets=1):
+        """
+        Given a raw message of metrics split by newline characters, this will
+        parse all of the metrics in a single pass and return a dictionary of
+        lists of (key,value,flag) tuples keyed by metric class, which can be
+        added to the aggregator with :meth:`_add_batch()`. This is much
+        cheaper than :meth:`_parse_metrics()` for messages of many lines.
 
+        Invalid lines and metric types are logged and skipped. The message
+        may be made up of a number of ``packets`` joined together.
+        """
+        records_by_type, invalid = parser.parse_message(message)
+        for line in invalid:
+            self.logger.error("Invalid line syntax: %s" % line)
+
+        lines = len(invalid)
+        errors = len(invalid)
+        results = {}
+        for metric_type,records in records_by_type.iteritems():
+            lines += len(records)
+            cls = metrics.METRIC_TYPES.get(metric_type)
+            if cls is not None:
+                results[cls] = records
+            else:
+                # Ignore the bad invalid metric, but log it
+                self.logger.error("Invalid metric '%s' in %d lines, such as key: %s" %
+                                  (metric_type, len(records), records[0][0]))
+                errors += len(records)
+
+        self.packets += packets
+        self.lines += lines
+        self.parse_errors += errors
         return results
 
     def _add_metrics(self, metrics):
@@ -84,6 +159,13 @@ class Collector(object):
         """
         self.aggregator.add_metrics(metrics)
 
+    def _add_batch(self, batch):
+        """
+        Adds the given batch of metrics, as returned by :meth:`_parse_batch()`,
+        to the aggregator.
+        """
+        self.aggregator.add_batch(batch)
+
 class UDPCollector(Collector):
     """
     This is a collector which listens for UDP packets, parses them,
@@ -123,13 +205,7 @@ class UDPCollectorSocketServer(SocketServer.UDPServer):
 
     def _setup_socket_buffers(self):
         "Increases the receive buffer sizes"
-        # Try to set the buffer size to 4M, 2M, 1M, and 512K
-        for buff_size in (4*1024**2,2*1024**2,1024**2,512*1024):
-            try:
-                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buff_size)
-                return
-            except:
-                pass
+        setup_socket_buffers(self.socket)
 
 class UDPCollectorSocketHandler(SocketServer.BaseRequestHandler):
     """
@@ -143,22 +219,263 @@ class UDPCollectorSocketHandler(SocketServer.BaseRequestHandler):
             message, _ = self.request
 
             # Add the parsed metrics to the aggregator
-            metrics = self.server.collector._parse_metrics(message)
-            self.server.collector._add_metrics(metrics)
+            batch = self.server.collector._parse_batch(message)
+            self.server.collector._add_batch(batch)
         except Exception:
             self.server.collector.logger.exception("Exception during processing UDP packet")
 
+class BatchUDPCollector(Collector):
+    """
+    This is a collector which listens for UDP packets like the
+    :class:`UDPCollector`, but is meant for high packet rates. Rather
+    than going through SocketServer for every datagram, it drains the
+    non-blocking socket in a tight loop whenever it becomes readable,
+    then parses and adds all the datagrams received as a single batch.
+    """
+
+    poll_interval = 0.5
+    "Seconds to wait for the socket to become readable before checking for shutdown."
+
+    def __init__(self, host="0.0.0.0", port=8125, batch_size=1024, reuse_port=False, **kwargs):
+        super(BatchUDPCollector, self).__init__(**kwargs)
+
+        self.batch_size = int(batch_size)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self.socket.bind((host, int(port)))
+        self.socket.setblocking(0)
+        setup_socket_buffers(self.socket)
+
+        self.logger = logging.getLogger("statsite.batchudpcollector")
+        self._running = False
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+
+    def start(self):
+        # Run the receive loop forever, blocking this thread
+        self.logger.debug("BatchUDPCollector starting")
+        self._running = True
+        self._is_shut_down.clear()
+        try:
+            while self._running:
+                readable, _, _ = select.select([self.socket], [], [], self.poll_interval)
+                if readable:
+                    self._receive_batch()
+        finally:
+            self.socket.close()
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        # Tell the receive loop to stop and wait for it
+        self.logger.debug("BatchUDPCollector shutting down")
+        self._running = False
+        self._is_shut_down.wait()
+
+    def _receive_batch(self):
+        """
+        Reads up to ``batch_size`` datagrams off the socket without
+        blocking, and adds the metrics in all of them to the aggregator
+        at once.
+        """
+        packets = []
+        recv = self.socket.recv
+        try:
+            for _ in xrange(self.batch_size):
+                packets.append(recv(65535))
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.logger.exception("Exception while receiving UDP packets")
+
+        if not packets:
+            return
+
+        try:
+            batch = self._parse_batch("\n".join(packets), len(packets))
+            self._add_batch(batch)
+        except Exception:
+            self.logger.exception("Exception during processing UDP packets")
+
+class MultiProcessUDPCollector(Collector):
+    """
+    This is a collector which runs a number of worker processes, each of
+    which binds the UDP port with ``SO_REUSEPORT`` so that the kernel
+    spreads packets across them. Every worker parses and aggregates its
+    share of the packets using a :class:`BatchUDPCollector`, and hands
+    its partial aggregate, along with the counts of what it received,
+    over to this process when aggregators are switched, allowing a
+    single Statsite to make use of multiple cores.
+    """
+
+    partial_timeout = 5
+    "Seconds to wait for a worker to hand over its partial aggregate."
+
+    aggregates_elsewhere = True
+
+    def __init__(self, host="0.0.0.0", port=8125, workers=2, batch_size=1024, **kwargs):
+        super(MultiProcessUDPCollector, self).__init__(**kwargs)
+
+        if SO_REUSEPORT is None:
+            raise ValueError, "SO_REUSEPORT is not supported on this platform!"
+
+        self.workers = int(workers)
+        self.batch_size = int(batch_size)
+        if self.workers <= 0: raise ValueError, "Must have at least 1 worker!"
+
+        # Bind the port once up front, so that a bad address fails early and
+        # so that the workers all share the same port if an ephemeral one
+        # was requested.
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        probe.bind((host, int(port)))
+        self.address = probe.getsockname()
+        probe.close()
+
+        self.logger = logging.getLogger("statsite.multiprocessudpcollector")
+        self._drains = 0
+        self._processes = []
+        self._pipes_lock = threading.Lock()
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+
+    def start(self):
+        # Start the workers, then block this thread until shutdown
+        self.logger.debug("MultiProcessUDPCollector starting %d workers" % self.workers)
+        self._is_shut_down.clear()
+        with self._pipes_lock:
+            for _ in xrange(self.workers):
+                conn, worker_conn = multiprocessing.Pipe()
+                process = multiprocessing.Process(target=self._run_worker, args=(worker_conn,))
+                process.daemon = True
+                process.start()
+                self._processes.append((process, conn))
+
+        while not self._is_shut_down.is_set():
+            self._is_shut_down.wait(0.5)
+
+    def shutdown(self):
+        # Tell all the workers to stop and wait for them
+        self.logger.debug("MultiProcessUDPCollector shutting down")
+        with self._pipes_lock:
+            for process, conn in self._processes:
+                try:
+                    conn.send("shutdown")
+                except (EOFError, IOError):
+                    pass
+
+            for process, conn in self._processes:
+                process.join(self.partial_timeout)
+                if process.is_alive():
+                    process.terminate()
+
+            self._processes = []
+
+        self._is_shut_down.set()
+
+    def collect_partials(self):
+        # Ask all the workers to switch aggregators first, so that they
+        # switch as close to each other as possible, then gather the results.
+        # Every drain is numbered, so that a partial which arrives too late
+        # for its interval is thrown away rather than taken for the next.
+        partials = []
+        with self._pipes_lock:
+            self._drains += 1
+            waiting = {}
+            for process, conn in self._processes:
+                try:
+                    conn.send(("drain", self._drains))
+                    waiting[conn.fileno()] = (process, conn)
+                except (EOFError, IOError):
+                    self.logger.error("Worker %d has gone away" % process.pid)
+
+            # Wait for all the workers at once, until a single deadline
+            deadline = time.time() + self.partial_timeout
+            while waiting:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                try:
+                    readable, _, _ = select.select(waiting.keys(), [], [], remaining)
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                for fd in readable:
+                    process, conn = waiting[fd]
+                    try:
+                        drain, partial, counts = conn.recv()
+                    except (EOFError, IOError):
+                        self.logger.error("Worker %d has gone away" % process.pid)
+                        del waiting[fd]
+                        continue
+
+                    # The workers count what they received since their last
+                    # drain, which was received whether or not it's late
+                    packets, lines, parse_errors = counts
+                    self.packets += packets
+                    self.lines += lines
+                    self.parse_errors += parse_errors
+
+                    if drain != self._drains:
+                        self.logger.warning("Discarding a late partial from worker %d" % process.pid)
+                        continue
+
+                    partials.append(partial)
+                    del waiting[fd]
+
+            for process, conn in waiting.values():
+                self.logger.error("Timed out waiting for worker %d" % process.pid)
+
+        return partials
+
+    def _run_worker(self, conn):
+        """
+        This is the main loop of the worker processes. The aggregator
+        inherited from the parent process is used to aggregate this worker's
+        share of the packets until the parent asks for it to be drained.
+        """
+        # The parent process is responsible for handling signals
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        collector = BatchUDPCollector(host=self.address[0], port=self.address[1],
+                                      batch_size=self.batch_size, reuse_port=True,
+                                      aggregator=self.aggregator)
+        try:
+            while True:
+                readable, _, _ = select.select([collector.socket, conn], [], [])
+                if collector.socket in readable:
+                    collector._receive_batch()
+
+                if conn in readable:
+                    command = conn.recv()
+                    if command == "shutdown":
+                        break
+                    elif command[0] == "drain":
+                        # Hand over what was counted along with the partial,
+                        # since the counts of this process aren't seen
+                        counts = (collector.packets, collector.lines, collector.parse_errors)
+                        collector.packets = collector.lines = collector.parse_errors = 0
+                        conn.send((command[1], collector.aggregator.drain(), counts))
+        except (EOFError, IOError, KeyboardInterrupt):
+            pass
+        finally:
+            collector.socket.close()
 
 class TCPCollector(Collector):
     """
     This is a collector which listens for TCP connections,
     spawns a thread for each one, parses incoming metrics,
-    and adds them to the aggregator.
+    and adds them to the aggregator. Connections which send a line
+    longer than ``max_line_size`` bytes are closed.
     """
 
-    def __init__(self, host="0.0.0.0", port=8125, **kwargs):
+    def __init__(self, host="0.0.0.0", port=8125, max_line_size=65536, **kwargs):
         super(TCPCollector, self).__init__(**kwargs)
 
+        self.max_line_size = int(max_line_size)
         self.server = TCPCollectorSocketServer((host, int(port)),
                                                TCPCollectorSocketHandler,
                                                collector=self)
@@ -192,13 +509,7 @@ class TCPCollectorSocketServer(SocketServer.ThreadingTCPServer):
 
     def _setup_socket_buffers(self):
         "Increases the receive buffer sizes"
-        # Try to set the buffer size to 4M, 2M, 1M, and 512K
-        for buff_size in (4*1024**2,2*1024**2,1024**2,512*1024):
-            try:
-                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buff_size)
-                return
-            except:
-                pass
+        setup_socket_buffers(self.socket)
 
 
 class TCPCollectorSocketHandler(SocketServer.StreamRequestHandler):
@@ -208,18 +519,206 @@ class TCPCollectorSocketHandler(SocketServer.StreamRequestHandler):
     """
     daemon_threads = True # Gracefully exit if our request handler threads are around
     timeout = 10          # Use a default timeout for connections
+    read_size = 65536     # Read the connection in large chunks
 
     def handle(self):
+        collector = self.server.collector
+        buf = ""
         while True:
             try:
-                # Read a line of input
-                line = self.rfile.readline()
-                if not line: break
+                # Read whatever is available, and only parse the complete
+                # lines, keeping any trailing partial line for later
+                data = self.connection.recv(self.read_size)
+                if not data:
+                    lines, buf = buf, ""
+                else:
+                    buf += data
+                    idx = buf.rfind("\n") + 1
+                    lines, buf = buf[:idx], buf[idx:]
 
                 # Add the parsed metrics to the aggregator
-                metrics = self.server.collector._parse_metrics(line)
-                self.server.collector._add_metrics(metrics)
+                if lines:
+                    batch = collector._parse_batch(lines)
+                    collector._add_batch(batch)
+
+                if not data: break
+
+                # Don't keep buffering a line which the client never ends
+                if len(buf) > collector.max_line_size:
+                    collector.logger.error("Line exceeds %d bytes, closing TCP connection" %
+                                           collector.max_line_size)
+                    break
             except Exception:
-                self.server.collector.logger.exception("Exception during processing TCP connection")
+                collector.logger.exception("Exception during processing TCP connection")
                 break
 
+class EventTCPCollector(Collector):
+    """
+    This is a collector which listens for TCP connections like the
+    :class:`TCPCollector`, but multiplexes all of the connections on a
+    single event loop using epoll (or poll where epoll isn't available)
+    instead of spawning a thread per connection. Connections are read in
+    large chunks, and all the complete lines read during a single wakeup
+    are parsed and added to the aggregator at once.
+    """
+
+    poll_interval = 0.5
+    "Seconds to wait for socket events before checking for shutdown."
+
+    request_queue_size = 128
+    "The backlog of connections waiting to be accepted."
+
+    def __init__(self, host="0.0.0.0", port=8125, read_size=65536, max_line_size=65536, **kwargs):
+        super(EventTCPCollector, self).__init__(**kwargs)
+
+        self.read_size = int(read_size)
+        self.max_line_size = int(max_line_size)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, int(port)))
+        self.socket.listen(self.request_queue_size)
+        self.socket.setblocking(0)
+        setup_socket_buffers(self.socket)
+
+        self.logger = logging.getLogger("statsite.eventtcpcollector")
+        self._connections = {}
+        self._running = False
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+
+    def start(self):
+        # Run the event loop forever, blocking this thread
+        self.logger.debug("EventTCPCollector starting")
+        self._running = True
+        self._is_shut_down.clear()
+
+        if hasattr(select, "epoll"):
+            self._poller = select.epoll()
+            self._poll = self._poller.poll
+            self._read_events = select.EPOLLIN
+            self._close_events = select.EPOLLHUP | select.EPOLLERR
+        else:
+            self._poller = select.poll()
+            self._poll = lambda timeout: self._poller.poll(timeout * 1000)
+            self._read_events = select.POLLIN
+            self._close_events = select.POLLHUP | select.POLLERR | select.POLLNVAL
+
+        self._poller.register(self.socket.fileno(), self._read_events)
+        try:
+            while self._running:
+                self._handle_events(self._poll(self.poll_interval))
+        finally:
+            for fd in self._connections.keys():
+                self._close_connection(fd)
+
+            self.socket.close()
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        # Tell the event loop to stop and wait for it
+        self.logger.debug("EventTCPCollector shutting down")
+        self._running = False
+        self._is_shut_down.wait()
+
+    def _handle_events(self, events):
+        """
+        Handles the events from a single wakeup of the event loop. The
+        complete lines read from all connections are parsed as one message.
+        """
+        chunks = []
+        listen_fd = self.socket.fileno()
+        for fd, event in events:
+            if fd == listen_fd:
+                self._accept_connections()
+            elif event & self._read_events:
+                chunk = self._read_connection(fd)
+                if chunk:
+                    chunks.append(chunk)
+            elif event & self._close_events:
+                chunk = self._close_connection(fd)
+                if chunk:
+                    chunks.append(chunk)
+
+        if not chunks:
+            return
+
+        try:
+            batch = self._parse_batch("\n".join(chunks))
+            self._add_batch(batch)
+        except Exception:
+            self.logger.exception("Exception during processing TCP data")
+
+    def _accept_connections(self):
+        """
+        Accepts all the connections waiting on the listening socket.
+        """
+        while True:
+            try:
+                conn, _ = self.socket.accept()
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.logger.exception("Exception while accepting TCP connection")
+                return
+
+            conn.setblocking(0)
+            self._connections[conn.fileno()] = [conn, ""]
+            self._poller.register(conn.fileno(), self._read_events)
+
+    def _read_connection(self, fd):
+        """
+        Reads a chunk from a connection and returns the complete lines
+        read so far, buffering any trailing partial line.
+        """
+        connection = self._connections.get(fd)
+        if connection is None:
+            return None
+
+        try:
+            data = connection[0].recv(self.read_size)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return None
+            data = ""
+
+        # An empty read means the connection was closed by the client
+        if not data:
+            return self._close_connection(fd)
+
+        buf = connection[1] + data
+        idx = buf.rfind("\n") + 1
+        lines, connection[1] = buf[:idx], buf[idx:]
+
+        # Don't keep buffering a line which the client never ends
+        if len(connection[1]) > self.max_line_size:
+            self.logger.error("Line exceeds %d bytes, closing TCP connection" % self.max_line_size)
+            connection[1] = ""
+            self._close_connection(fd)
+
+        return lines or None
+
+    def _close_connection(self, fd):
+        """
+        Closes a connection, returning whatever partial line was left
+        in its buffer.
+        """
+        connection = self._connections.pop(fd, None)
+        if connection is None:
+            return None
+
+        try:
+            self._poller.unregister(fd)
+        except (IOError, KeyError, ValueError):
+            pass
+
+        connection[0].close()
+        return connection[1]
+
+def setup_socket_buffers(sock):
+    "Increases the receive buffer sizes of the given socket"
+    # Try to set the buffer size to 4M, 2M, 1M, and 512K
+    for buff_size in (4*1024**2,2*1024**2,1024**2,512*1024):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buff_size)
+            return
+        except:
+            pass
@@ -0,0 +1,48 @@
+"""
+Contains the consistent hash ring used to spread metrics across several
+Graphite servers, in the same way carbon's relays do.
+"""
+
+import bisect
+import hashlib
+
+class ConsistentHashRing(object):
+    """
+    A consistent hash ring which places keys on nodes exactly as the
+    ``ConsistentHashRing`` of carbon does, so that a metric is sent to
+    the same carbon server that carbon's own consistent hashing relays
+    would send it to. Nodes are (server, instance) tuples, as in carbon.
+    """
+
+    def __init__(self, nodes, replica_count=100):
+        self.ring = []
+        self.nodes = set()
+        self.replica_count = int(replica_count)
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        """
+        Adds a node to the ring, at a position for each of its replicas.
+        """
+        self.nodes.add(node)
+        for i in xrange(self.replica_count):
+            replica_key = "%s:%d" % (node, i)
+            bisect.insort(self.ring, (self.compute_ring_position(replica_key), node))
+
+    def get_node(self, key):
+        """
+        Returns the node which the key belongs to.
+        """
+        if not self.ring: raise ValueError, "The hash ring has no nodes!"
+
+        position = self.compute_ring_position(key)
+        index = bisect.bisect_left(self.ring, (position, None)) % len(self.ring)
+        return self.ring[index][1]
+
+    def compute_ring_position(self, key):
+        """
+        Returns the position of the key on the ring, which is the first
+        16 bits of its md5 hash.
+        """
+        return int(hashlib.md5(key).hexdigest()[:4], 16)
@@ -4,19 +4,47 @@ sub-classes. These are used to wrap the values in the
 incoming messages, and contain them in classes of
 the proper type.
 """
+import collections
+import functools
+import itertools
 import math
 import time
 
+from sketch import HyperLogLog, KLLSketch
+from util import OutputNames, to_bool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+UNCACHED_NAMES = OutputNames(size=0)
+"""
+The output names of metrics folded without those of a metrics store,
+which have no prefix and aren't cached.
+"""
+
 class Metric(object):
+    __slots__ = ("key", "value", "flag")
+
+    stateful = False
+    """
+    Whether the metric carries state from one flush interval to the next.
+    If so, :meth:`fold_accumulator()` is given a dictionary which is kept
+    across intervals as the ``state`` keyword argument, and is called
+    even for intervals in which no metrics of the type were received.
+    """
+
     def __init__(self, key, value, flag=None):
         """
         Represents a base metric. This is not used directly,
         and is instead invoked from sub-classes that are typed
         by the metric.
 
-        Each sub-class must implement a class method :meth:`fold()`
-        which takes a list of objects of the same type and returns a list
-        of (key,value,timestamp) pairs.
+        Each sub-class may override the class methods :meth:`accumulator()`
+        and :meth:`fold_accumulator()` along with :meth:`_fold()`, which
+        together implement :meth:`fold()`: taking a list of objects of the
+        same type and returning a list of (key,value,timestamp) pairs.
 
         :Parameters:
             - `key` : The key of the metric
@@ -30,7 +58,7 @@ class Metric(object):
         self.flag = flag
 
     @classmethod
-    def fold(cls, lst, now):
+    def fold(cls, lst, now, **kwargs):
         """
         Takes a list of the metrics objects and emits lists of (key,value,timestamp)
         pairs.
@@ -39,7 +67,62 @@ class Metric(object):
             - `lst` : A list of metrics objects
             - `now` : The time at which folding started
         """
-        return [(o.key,o.value,o.flag if o.flag else now) for o in lst]
+        accumulator = cls.accumulator(**kwargs)
+        for item in lst: item._fold(accumulator)
+        return cls.fold_accumulator(accumulator, now, **kwargs)
+
+    @classmethod
+    def accumulator(cls, **kwargs):
+        """
+        Returns a new, empty accumulator for this metric type. Metrics
+        are folded into the accumulator one at a time as they arrive
+        using :meth:`_fold()`, so that only the running state per key
+        is kept around rather than every metric object.
+
+        The metric settings for the type are given as keyword arguments.
+        """
+        return []
+
+    @classmethod
+    def fold_accumulator(cls, accum, now, names=None, **kwargs):
+        """
+        Takes an accumulator which metrics have been folded into and
+        emits lists of (key,value,timestamp) pairs.
+
+        :Parameters:
+            - `accum` : An accumulator returned by :meth:`accumulator()`
+            - `now` : The time at which folding started
+            - `names` (optional) : The :class:`OutputNames` to look up the
+            output names of the keys in, which are then emitted with its
+            prefix. By default the names are built without a prefix, using
+            :data:`UNCACHED_NAMES`.
+        """
+        lookup = (names or UNCACHED_NAMES).lookup("")
+        return [(lookup(k)[0],v,f if f else now) for k,v,f in accum]
+
+    @classmethod
+    def accumulate(cls, accum, records):
+        """
+        Folds a list of (key,value,flag) tuples into the given accumulator,
+        exactly as if a metric object had been created and folded in for
+        each of them. This is used to fold in parsed batches of metrics
+        without the overhead of a metric object per record.
+        """
+        accum.extend(records)
+
+    @classmethod
+    def merge(cls, accum, other):
+        """
+        Merges the accumulator ``other`` into ``accum``, as if every
+        metric folded into ``other`` had been folded into ``accum``.
+        """
+        accum.extend(other)
+
+    def _fold(self, accum):
+        """
+        Folds this metric into the given accumulator.
+        """
+        accum.append((self.key, self.value, self.flag))
 
     def __eq__(self, other):
         """
@@ -55,11 +138,27 @@ class Counter(Metric):
     """
     Represents counter metrics, provided by 'c' type.
     """
+    __slots__ = ()
+
     @classmethod
-    def fold(cls, lst, now):
-        accumulator = {}
-        for item in lst: item._fold(accumulator)
-        return [("counts.%s" % key,value,now) for key,value in accumulator.iteritems()]
+    def accumulator(cls, **kwargs):
+        return {}
+
+    @classmethod
+    def fold_accumulator(cls, accum, now, names=None, **kwargs):
+        lookup = (names or UNCACHED_NAMES).lookup("counts")
+        return [(lookup(key)[0],value,now) for key,value in accum.iteritems()]
+
+    @classmethod
+    def accumulate(cls, accum, records):
+        for key,value,sample_rate in records:
+            if not sample_rate: sample_rate = 1.0
+            accum[key] = accum.get(key, 0) + value / (1 / sample_rate)
+
+    @classmethod
+    def merge(cls, accum, other):
+        for key,value in other.iteritems():
+            accum[key] = accum.get(key, 0) + value
 
     def _fold(self, accum):
         accum.setdefault(self.key, 0)
@@ -67,61 +166,414 @@ class Counter(Metric):
         accum[self.key] += self.value / (1 / sample_rate)
 
 
+class Gauge(Metric):
+    """
+    Represents gauge metrics, provided by the 'g' type. Only the last
+    value of each gauge is kept, and it is carried over from one flush
+    interval to the next, so a single value is emitted per gauge for
+    every interval no matter how often it is sent.
+
+    Values sent with a sign are relative updates to the current value of
+    the gauge rather than absolute values, which the parser marks with
+    a flag of True.
+    """
+    __slots__ = ()
+
+    stateful = True
+
+    @classmethod
+    def accumulator(cls, **kwargs):
+        return {}
+
+    @classmethod
+    def fold_accumulator(cls, accum, now, state=None, names=None, **kwargs):
+        if state is None:
+            state = {}
+
+        # The accumulator holds the last absolute value for each gauge,
+        # or None if there was none this interval, along with the sum of
+        # the relative updates sent since.
+        for key,(value,delta) in accum.iteritems():
+            if value is None:
+                value = state.get(key, 0)
+            state[key] = value + delta
+
+        lookup = (names or UNCACHED_NAMES).lookup("gauges")
+        return [(lookup(key)[0],value,now) for key,value in state.iteritems()]
+
+    @classmethod
+    def accumulate(cls, accum, records):
+        # Only a flag of True marks a relative update, so that a sample
+        # rate which ends up in the flag isn't taken for one
+        for key,value,relative in records:
+            if relative is True:
+                last, delta = accum.get(key, (None, 0))
+                accum[key] = (last, delta + value)
+            else:
+                accum[key] = (value, 0)
+
+    @classmethod
+    def merge(cls, accum, other):
+        for key,(value,delta) in other.iteritems():
+            if value is None and key in accum:
+                last, last_delta = accum[key]
+                accum[key] = (last, last_delta + delta)
+            else:
+                accum[key] = (value, delta)
+
+    def _fold(self, accum):
+        self.accumulate(accum, [(self.key, self.value, self.flag)])
+
+class Set(Metric):
+    """
+    Represents set metrics, provided by the 's' type. The number of
+    unique members sent for each key during the interval is estimated
+    with a :class:`HyperLogLog`, so each key takes a fixed amount of
+    memory no matter how many members are sent. The ``precision``
+    setting trades memory for accuracy, see :class:`HyperLogLog`.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def accumulator(cls, precision=12, **kwargs):
+        return collections.defaultdict(functools.partial(HyperLogLog, int(precision)))
+
+    @classmethod
+    def fold_accumulator(cls, accum, now, names=None, **kwargs):
+        lookup = (names or UNCACHED_NAMES).lookup("sets")
+        return [(lookup(key)[0],members.cardinality(),now) for key,members in accum.iteritems()]
+
+    @classmethod
+    def accumulate(cls, accum, records):
+        for key,member,_ in records:
+            accum[key].add(member)
+
+    @classmethod
+    def merge(cls, accum, other):
+        for key,members in other.iteritems():
+            mine = accum.get(key)
+            if mine is None:
+                accum[key] = members
+            else:
+                mine.merge(members)
+
+    def _fold(self, accum):
+        accum[self.key].add(self.value)
+
 class Timer(Metric):
     """
     Represents timing metrics, provided by the 'ms' type.
+
+    By default every value is kept so that the statistics are exact.
+    With the ``sketch`` setting, the values for each key are kept in a
+    :class:`KLLSketch` instead, which bounds the memory used per key.
+    The sum, count, lower, upper and standard deviation stay exact, while
+    the percentile statistics become approximate.
+
+    With the ``vectorize`` setting and NumPy installed, the statistics
+    for all of the keys are computed at once with vectorized operations,
+    which is much faster when there are many keys. The floating point
+    statistics, such as the standard deviation, may differ from those of
+    the pure Python fold in their last digits. Without NumPy, the setting
+    is ignored.
+
+    The ``percentile`` setting may be a list of percentiles, or a comma
+    separated string of them, all of which are computed from the same
+    sorted values. The statistics for the 99.9th percentile are suffixed
+    with "99_9", for example.
     """
+    __slots__ = ()
+
+    STATS = ("sum", "mean", "lower", "upper", "count", "stdev")
+    "The names of the statistics computed for timers, in order."
+
     @classmethod
-    def fold(cls, lst, now, percentile=90):
-        accumulator = {}
-        for item in lst: item._fold(accumulator)
+    def accumulator(cls, sketch=False, sketch_k=200, **kwargs):
+        if to_bool(sketch):
+            return collections.defaultdict(functools.partial(KLLSketch, int(sketch_k)))
+        return collections.defaultdict(list)
+
+    @classmethod
+    def accumulate(cls, accum, records):
+        for key,value,_ in records:
+            accum[key].append(value)
+
+    @classmethod
+    def merge(cls, accum, other):
+        for key,vals in other.iteritems():
+            mine = accum.get(key)
+            if mine is None:
+                accum[key] = vals
+            elif isinstance(mine, KLLSketch):
+                mine.merge(vals)
+            else:
+                mine.extend(vals)
+
+    @classmethod
+    def fold_accumulator(cls, accum, now, percentile=90, sketch=False, vectorize=False,
+                         names=None, **kwargs):
+        # All of the percentiles are computed from the same sorted values
+        percentiles = cls._percentiles(percentile)
+        suffixes = [".%s" % name for name in cls.STATS]
+        for pct in percentiles:
+            pct_suffix = cls._percentile_suffix(pct)
+            suffixes.extend([".%s_%s" % (name, pct_suffix) for name in cls.STATS])
+        lookup = (names or UNCACHED_NAMES).lookup("timers", tuple(suffixes))
+
+        if numpy is not None and to_bool(vectorize) and not to_bool(sketch) and accum:
+            results = cls._vectorized_stats(accum, percentiles)
+        else:
+            results = [(key,) + cls._key_stats(vals, percentiles) for key,vals in accum.iteritems()]
 
         outputs = []
-        for key,vals in accumulator.iteritems():
-            # Sort the values
+        timestamps = itertools.repeat(now)
+        for key,stats,stats_pcts in results:
+            values = list(stats)
+            for stats_pct in stats_pcts:
+                values.extend(stats_pct)
+
+            outputs.extend(itertools.izip(lookup(key), values, timestamps))
+
+        return outputs
+
+    @classmethod
+    def _percentiles(cls, percentile):
+        """
+        Returns the list of percentiles given by the ``percentile`` setting,
+        which is either a single percentile, a list of them, or a comma
+        separated string of them such as "50,90,99,99.9".
+        """
+        if isinstance(percentile, basestring):
+            percentile = percentile.split(",")
+        elif not isinstance(percentile, (list, tuple)):
+            percentile = [percentile]
+
+        percentiles = []
+        for pct in percentile:
+            pct = float(pct)
+            percentiles.append(int(pct) if pct == int(pct) else pct)
+
+        return percentiles
+
+    @classmethod
+    def _percentile_suffix(cls, percentile):
+        """
+        Returns the suffix of the statistic names for a percentile, such
+        as "90" for the 90th percentile or "99_9" for the 99.9th.
+        """
+        return str(percentile).replace(".", "_")
+
+    @classmethod
+    def _key_stats(cls, vals, percentiles):
+        """
+        Computes the statistics for the values of a single key, which are
+        either a list or a sketch.
+        """
+        if isinstance(vals, KLLSketch):
+            return cls._sketch_stats(vals, percentiles)
+
+        return cls._stats(vals, percentiles)
+
+    @classmethod
+    def _stats(cls, vals, percentiles):
+        """
+        Computes the statistics over a list of values, returning a tuple
+        of the overall statistics and a list of the inner percentile
+        statistics for each percentile, each in the order of :attr:`STATS`.
+        """
+        # Sort the values
+        vals.sort()
+
+        val_count = len(vals)
+        val_sum = sum(vals)
+        val_avg = float(val_sum) / val_count
+        val_min = vals[0]
+        val_max = vals[-1]
+        val_stdev = cls._stdev(vals, val_avg)
+
+        return ((val_sum, val_avg, val_min, val_max, val_count, val_stdev),
+                [cls._percentile_stats(vals, pct) for pct in percentiles])
+
+    @classmethod
+    def _percentile_stats(cls, vals, percentile):
+        """
+        Computes the inner percentile statistics over a sorted list of
+        values.
+        """
+        # Calculate the inner percentile
+        inner_indexes = int(len(vals) * (percentile / 100.0))
+        lower_idx = (len(vals) - inner_indexes) / 2
+        upper_idx = lower_idx + inner_indexes
+
+        # If we only have one item, then the percentile is just the
+        # values itself, otherwise the lower_idx:upper_idx slice returns
+        # an empty list.
+        if len(vals) == 1:
+            vals_pct = vals
+        else:
+            vals_pct = vals[lower_idx:upper_idx]
+
+        val_sum_pct = sum(vals_pct)
+        val_avg_pct = val_sum_pct / inner_indexes if inner_indexes > 0 else val_sum_pct
+        val_min_pct = vals[lower_idx]
+        val_max_pct = vals[upper_idx]
+        val_stdev_pct = cls._stdev(vals_pct, val_avg_pct)
+
+        return (val_sum_pct, val_avg_pct, val_min_pct, val_max_pct, inner_indexes, val_stdev_pct)
+
+    @classmethod
+    def _sketch_stats(cls, sketch, percentiles):
+        """
+        Computes the same statistics as :meth:`_stats()` from a sketch.
+        The inner percentile statistics are computed over the weighted
+        values of the sketch, as if each was repeated by its weight.
+        """
+        val_count = sketch.count
+        stats = (sketch.sum, float(sketch.sum) / val_count, sketch.min,
+                 sketch.max, val_count, sketch.stdev())
+        if val_count == 1:
+            return (stats, [(sketch.sum, sketch.sum, sketch.min, sketch.max, 0, 0)
+                            for pct in percentiles])
+
+        items = sketch.items()
+        return (stats, [cls._sketch_percentile_stats(items, val_count, pct)
+                        for pct in percentiles])
+
+    @classmethod
+    def _sketch_percentile_stats(cls, items, val_count, percentile):
+        """
+        Computes the inner percentile statistics over the sorted, weighted
+        values of a sketch.
+        """
+        # Calculate the inner percentile
+        inner_indexes = int(val_count * (percentile / 100.0))
+        lower_idx = (val_count - inner_indexes) / 2
+        upper_idx = lower_idx + inner_indexes
+
+        # Walk the weighted values, adding up the part of each which
+        # overlaps the lower_idx:upper_idx slice
+        position = 0
+        val_sum_pct = 0.0
+        val_sq_pct = 0.0
+        val_min_pct = None
+        val_max_pct = items[-1][0]
+        for value,weight in items:
+            start = position
+            position += weight
+
+            overlap = min(position, upper_idx) - max(start, lower_idx)
+            if overlap > 0:
+                val_sum_pct += value * overlap
+                val_sq_pct += value * value * overlap
+
+            if val_min_pct is None and position > lower_idx:
+                val_min_pct = value
+            if position > upper_idx:
+                val_max_pct = value
+                break
+
+        val_avg_pct = val_sum_pct / inner_indexes if inner_indexes > 0 else val_sum_pct
+        val_stdev_pct = 0
+        if inner_indexes > 1:
+            variance = (val_sq_pct - inner_indexes * val_avg_pct * val_avg_pct) / (inner_indexes - 1)
+            val_stdev_pct = math.sqrt(max(variance, 0))
+
+        return (val_sum_pct, val_avg_pct, val_min_pct, val_max_pct, inner_indexes, val_stdev_pct)
+
+    @classmethod
+    def _vectorized_stats(cls, accum, percentiles):
+        """
+        Computes the same statistics as :meth:`_stats()` for every key
+        at once using NumPy, returning a list of (key, stats, stats_pcts)
+        tuples. The sorted values of all the keys are flattened into a
+        single array, so that each statistic is a handful of vectorized
+        operations over that array rather than a Python loop over the
+        values of every key.
+        """
+        keys = accum.keys()
+        lists = [accum[key] for key in keys]
+
+        # Sorting each list in C is cheaper than sorting the flattened
+        # array by key and value, and leaves the values of each key
+        # contiguous and in order
+        for vals in lists:
             vals.sort()
 
-            val_count = len(vals)
-            val_sum = sum(vals)
-            val_avg = float(val_sum) / val_count
-            val_min = vals[0]
-            val_max = vals[-1]
-            val_stdev = cls._stdev(vals, val_avg)
+        counts = numpy.array([len(vals) for vals in lists])
+        ids = numpy.repeat(numpy.arange(len(keys)), counts)
+        starts = numpy.cumsum(counts) - counts
+
+        # Keys whose values are all integers get integer statistics, as
+        # with the pure Python fold. Summing the values in C is the
+        # cheapest way to find out.
+        is_int = [not isinstance(sum(vals), float) for vals in lists]
+
+        values = numpy.fromiter(itertools.chain.from_iterable(lists), float, counts.sum())
+        positions = numpy.arange(len(values)) - starts[ids]
 
-            # Calculate the inner percentile
-            inner_indexes = int(len(vals) * (percentile / 100.0))
-            lower_idx = (len(vals) - inner_indexes) / 2
+        # Weighted bincounts add the values of each key up in order, so
+        # the sums come out exactly as the pure Python sums do
+        val_sum = numpy.bincount(ids, weights=values, minlength=len(keys))
+        val_avg = val_sum / counts
+        val_min = values[starts]
+        val_max = values[starts + counts - 1]
+        val_stdev = cls._vectorized_stdev(values, ids, val_avg, counts)
+        columns = [val_sum, val_avg, val_min, val_max, counts, val_stdev]
+
+        for percentile in percentiles:
+            # Calculate the inner percentile. A single value is its own
+            # percentile slice.
+            inner_indexes = (counts * (percentile / 100.0)).astype(int)
+            lower_idx = (counts - inner_indexes) // 2
             upper_idx = lower_idx + inner_indexes
+            slice_end = numpy.where(counts == 1, 1, upper_idx)
+            in_slice = (positions >= lower_idx[ids]) & (positions < slice_end[ids])
+            slice_values = numpy.where(in_slice, values, 0.0)
 
-            # If we only have one item, then the percentile is just the
-            # values itself, otherwise the lower_idx:upper_idx slice returns
-            # an empty list.
-            if len(vals) == 1:
-                vals_pct = vals
-            else:
-                vals_pct = vals[lower_idx:upper_idx]
-
-            val_sum_pct = sum(vals_pct)
-            val_avg_pct = val_sum_pct / inner_indexes if inner_indexes > 0 else val_sum_pct
-            val_min_pct = vals[lower_idx]
-            val_max_pct = vals[upper_idx]
-            val_stdev_pct = cls._stdev(vals_pct, val_avg_pct)
-
-            outputs.append(("timers.%s.sum" % key, val_sum, now))
-            outputs.append(("timers.%s.mean" % key, val_avg, now))
-            outputs.append(("timers.%s.lower" % key, val_min, now))
-            outputs.append(("timers.%s.upper" % key, val_max, now))
-            outputs.append(("timers.%s.count" % key, val_count, now))
-            outputs.append(("timers.%s.stdev" % key, val_stdev, now))
-
-            outputs.append(("timers.%s.sum_%d" % (key, percentile), val_sum_pct, now))
-            outputs.append(("timers.%s.mean_%d" % (key, percentile), val_avg_pct, now))
-            outputs.append(("timers.%s.lower_%d" % (key, percentile), val_min_pct, now))
-            outputs.append(("timers.%s.upper_%d" % (key, percentile), val_max_pct, now))
-            outputs.append(("timers.%s.count_%d" % (key, percentile), inner_indexes, now))
-            outputs.append(("timers.%s.stdev_%d" % (key, percentile), val_stdev_pct, now))
+            val_sum_pct = numpy.bincount(ids, weights=slice_values, minlength=len(keys))
+            val_avg_pct = val_sum_pct / numpy.maximum(inner_indexes, 1)
+            val_avg_pct = numpy.where(is_int, numpy.floor(val_avg_pct), val_avg_pct)
+            val_min_pct = values[starts + lower_idx]
+            val_max_pct = values[starts + numpy.minimum(upper_idx, counts - 1)]
+            val_stdev_pct = cls._vectorized_stdev(slice_values, ids, val_avg_pct,
+                                                  slice_end - lower_idx, in_slice)
+            columns.extend([val_sum_pct, val_avg_pct, val_min_pct, val_max_pct,
+                            inner_indexes, val_stdev_pct])
 
-        return outputs
+        rows = zip(*[column.tolist() for column in columns])
+
+        # The sum, mean, lower and upper of every percentile, along with
+        # the overall sum, lower and upper, are integers for integer keys
+        int_columns = [0, 2, 3]
+        for i in xrange(len(percentiles)):
+            int_columns.extend([6 * (i + 1) + j for j in xrange(4)])
+
+        results = []
+        for key,row,row_is_int in zip(keys, rows, is_int):
+            if row_is_int:
+                row = list(row)
+                for i in int_columns:
+                    row[i] = int(row[i])
+
+            results.append((key, row[:6], [row[i:i + 6] for i in xrange(6, len(row), 6)]))
+
+        return results
+
+    @classmethod
+    def _vectorized_stdev(cls, values, ids, avgs, sizes, mask=None):
+        """
+        Computes the sample standard deviation of the values of every key
+        at once, as :meth:`_stdev()` does for a single key. Only the values
+        in the mask are included, if one is given.
+        """
+        diffs = values - avgs[ids]
+        diffs_sq = diffs * diffs
+        if mask is not None:
+            diffs_sq = numpy.where(mask, diffs_sq, 0.0)
+
+        diff_sq = numpy.bincount(ids, weights=diffs_sq, minlength=len(avgs))
+        sample_size = sizes - 1
+        return numpy.sqrt(diff_sq / numpy.maximum(sample_size, 1)) * (sample_size > 0)
 
     @classmethod
     def _stdev(cls, lst, lst_avg):
@@ -137,13 +589,14 @@ class Timer(Metric):
         return math.sqrt(diff_sq / sample_size)
 
     def _fold(self, accum):
-        accum.setdefault(self.key, [])
         accum[self.key].append(self.value)
 
 class KeyValue(Metric):
     """
     Represents a key/value metric, provided by the 'kv' type.
     """
+    __slots__ = ()
+
     def __init__(self,key, value, flag=None):
         super(KeyValue, self).__init__(key,value,flag)
 
@@ -151,17 +604,30 @@ class KeyValue(Metric):
         if flag is None: self.flag = time.time()
 
     @classmethod
-    def fold(cls, lst, now):
+    def accumulate(cls, accum, records):
+        # Records without a timestamp are stamped with the time the whole
+        # batch arrived at, just like creating the metric objects would.
+        # Every record is kept, so the keys are interned to share a single
+        # copy of each key between them.
+        now = time.time()
+        accum.extend([(intern(k),v,now if f is None else f) for k,v,f in records])
+
+    @classmethod
+    def fold_accumulator(cls, accum, now, names=None, **kwargs):
         """
-        Takes a list of the metrics objects and emits lists of (key,value,timestamp)
-        pairs. Adds the kv prefix to all the keys so as not to pollute the main namespace.
+        Emits lists of (key,value,timestamp) pairs for every key/value
+        folded in. Adds the kv prefix to all the keys so as not to pollute
+        the main namespace.
         """
-        return [("kv.%s" % o.key,o.value,o.flag if o.flag else now) for o in lst]
+        lookup = (names or UNCACHED_NAMES).lookup("kv")
+        return [(lookup(k)[0],v,f if f else now) for k,v,f in accum]
 
 
 METRIC_TYPES = {
     "c": Counter,
+    "g": Gauge,
     "ms": Timer,
+    "s": Set,
     "kv": KeyValue,
 }
 """
@@ -2,10 +2,18 @@
 Contains the base metrics store class and default metrics store class.
 """
 
+import cPickle
+import Queue
 import socket
+import struct
 import threading
+import time
 import logging
 
+from hashing import ConsistentHashRing
+from spool import RingSpool
+from util import OutputNames, resolve_class_string
+
 class MetricsStore(object):
     """
     This is the base class for all metric stores. There is only one
@@ -15,9 +23,17 @@ class MetricsStore(object):
 
     Metrics stores _must_ be threadsafe, since :meth:`flush()` could
     potentially be called by multiple flushing aggregators.
+
+    Stores which add a prefix to the keys may keep an
+    :class:`OutputNames` in a ``names`` attribute. Aggregators then
+    have the metrics named by it, with the prefix already added, and
+    flush them with ``prefixed`` set.
     """
 
-    def flush(self, metrics):
+    names = None
+    "The cache of output names of the keys flushed, if the store keeps one."
+
+    def flush(self, metrics, prefixed=False):
         """
         This method is called by aggregators when flushing data.
         This must be thread-safe.
@@ -25,45 +41,139 @@ class MetricsStore(object):
         raise NotImplementedError("flush not implemented")
 
 class GraphiteStore(MetricsStore):
-    def __init__(self, host="localhost", port=2003, prefix="statsite", attempts=3):
+    DROP_POLICIES = ("newest", "oldest")
+    "The policies for which batches to drop when the send queue is full."
+
+    def __init__(self, host="localhost", port=2003, prefix="statsite", attempts=3,
+                 queue_size=0, drop="newest", spool_path=None, spool_size=64 * 1024 * 1024,
+                 replay_rate=10000, name_cache_size=100000, timeout=10):
         """
         Implements a metrics store interface that allows metrics to
         be persisted to Graphite. Raises a :class:`ValueError` on bad arguments.
 
+        By default, :meth:`flush()` writes the metrics to Graphite before
+        returning. If a queue size is given, :meth:`flush()` only queues the
+        formatted metrics, which a background thread then sends, so that a
+        slow Graphite server doesn't hold up the flushing aggregators. If
+        the queue is full, either the newest batch (the one being queued)
+        or the oldest queued batch is dropped.
+
+        If a spool path is given, batches which fail to send are appended
+        to a :class:`RingSpool` at that path instead of being lost, and a
+        background thread replays them once Graphite is reachable again,
+        sending at most ``replay_rate`` metrics per second so that the
+        backlog doesn't swamp Graphite.
+
+        Connecting to and writing to Graphite give up after ``timeout``
+        seconds, so that a server which accepts connections but stops
+        reading can't hold up the flushes forever.
+
+        The number of metrics enqueued, sent, dropped from the queue, failed
+        to send, spooled and replayed are counted in :attr:`counters`, and
+        the seconds spent formatting and writing the metrics are added up in
+        :attr:`timings`.
+
+        The full output names of the keys, prefix included, are cached in
+        :attr:`names` across flushes, for up to ``name_cache_size`` keys of
+        each metric type.
+
         :Parameters:
             - `host` : The hostname of the graphite server.
             - `port` : The port of the graphite server
             - `prefix` (optional) : A prefix to add to the keys. Defaults to 'statsite'
             - `attempts` (optional) : The number of re-connect retries before failing.
+            - `queue_size` (optional) : The number of batches to queue for the
+            background thread to send. Defaults to 0, which sends synchronously.
+            - `drop` (optional) : Either "newest" or "oldest", the batch to drop
+            when the queue is full. Defaults to "newest".
+            - `spool_path` (optional) : The path of the file to spool batches
+            which fail to send to. Defaults to no spooling.
+            - `spool_size` (optional) : The size of the spool file in bytes,
+            past which the oldest batches are dropped. Defaults to 64MB.
+            - `replay_rate` (optional) : The most spooled metrics to replay
+            per second. Defaults to 10000.
+            - `name_cache_size` (optional) : The number of keys to cache the
+            output names of. Defaults to 100000, and 0 disables the cache.
+            - `timeout` (optional) : The seconds to wait to connect to or
+            write to Graphite before giving up. Defaults to 10.
         """
         # Convert the port to an int since its coming from a configuration file
         port = int(port)
+        queue_size = int(queue_size)
+        replay_rate = int(replay_rate)
+        name_cache_size = int(name_cache_size)
+        timeout = float(timeout)
 
         if port <= 0: raise ValueError, "Port must be positive!"
         if attempts <= 1: raise ValueError, "Must have at least 1 attempt!"
+        if queue_size < 0: raise ValueError, "Queue size must not be negative!"
+        if drop not in self.DROP_POLICIES: raise ValueError, "Drop policy must be 'newest' or 'oldest'!"
+        if replay_rate <= 0: raise ValueError, "Replay rate must be positive!"
+        if name_cache_size < 0: raise ValueError, "Name cache size must not be negative!"
+        if timeout <= 0: raise ValueError, "Timeout must be positive!"
 
         self.host = host
         self.port = port
         self.prefix = prefix
         self.attempts = attempts
-        self.sock_lock = threading.Lock()
-        self.sock = self._create_socket()
+        self.timeout = timeout
+        self.drop = drop
         self.logger = logging.getLogger("statsite.graphitestore")
+        self.sock_lock = threading.Lock()
+
+        # Connect on the first write rather than now, so that Statsite
+        # starts even if Graphite is down
+        self.sock = None
+
+        self.counters = {"enqueued": 0, "sent": 0, "dropped": 0, "failed": 0,
+                         "spooled": 0, "replayed": 0}
+        self.timings = {"format": 0.0, "write": 0.0}
+        self.counters_lock = threading.Lock()
+
+        if name_cache_size > 0:
+            self.names = OutputNames(prefix, name_cache_size)
 
-    def flush(self, metrics):
+        self.spool = None
+        if spool_path:
+            self.spool = RingSpool(spool_path, spool_size)
+            self.replay_rate = replay_rate
+            self.replay_allowance = 0
+            self.replayer = threading.Thread(target=self._replay_spooled)
+            self.replayer.daemon = True
+            self.replayer.start()
+
+        self.queue = None
+        if queue_size > 0:
+            self.queue = Queue.Queue(queue_size)
+            self.sender = threading.Thread(target=self._send_queued)
+            self.sender.daemon = True
+            self.sender.start()
+
+    def flush(self, metrics, prefixed=False):
         """
         Flushes the metrics provided to Graphite.
 
        :Parameters:
         - `metrics` : A list of (key,value,timestamp) tuples.
+        - `prefixed` (optional) : Whether the keys already have the prefix,
+        having been named by :attr:`names`.
         """
         # Construct the output
-        data = "\n".join(["%s.%s %s %d" % (self.prefix,k,v,ts) for k,v,ts in metrics]) + "\n"
+        start = time.time()
+        chunks = self._format(metrics, prefixed)
+        self._time("format", time.time() - start)
+
+        # Leave the sending to the background thread if we're queueing
+        if self.queue is not None:
+            for chunk in chunks:
+                self._enqueue(chunk)
+            return
 
         # Serialize writes to the socket
         self.sock_lock.acquire()
         try:
-            self._write_metric(data)
+            for chunk in chunks:
+                self._send(chunk)
         except:
             self.logger.exception("Failed to write out the metrics!")
         finally:
@@ -71,25 +181,423 @@ class GraphiteStore(MetricsStore):
 
     def close(self):
         """
-        Closes the connection. The socket will be recreated on the next
-        flush.
+        Closes the connection, after waiting for any queued metrics to be
+        sent. The socket will be recreated on the next flush. Spooled
+        metrics stay spooled.
+        """
+        if self.queue is not None:
+            self.queue.join()
+
+        self.sock_lock.acquire()
+        try:
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+        finally:
+            self.sock_lock.release()
+
+    def _format(self, metrics, prefixed=False):
+        """
+        Formats the metrics for the plaintext protocol, returning a list
+        of (data, count) tuples of the strings to write to the socket in
+        turn and the number of metrics in each.
+        """
+        if prefixed:
+            lines = ["%s %s %d" % metric for metric in metrics]
+        else:
+            lines = ["%s.%s %s %d" % (self.prefix,k,v,ts) for k,v,ts in metrics]
+
+        return [("\n".join(lines) + "\n", len(metrics))]
+
+    def _count(self, counter, count):
+        """
+        Adds to one of the counters.
+        """
+        self.counters_lock.acquire()
+        try:
+            self.counters[counter] += count
+        finally:
+            self.counters_lock.release()
+
+    def _time(self, timing, seconds):
+        """
+        Adds to one of the timings.
+        """
+        self.counters_lock.acquire()
+        try:
+            self.timings[timing] += seconds
+        finally:
+            self.counters_lock.release()
+
+    def _enqueue(self, chunk):
+        """
+        Queues a chunk returned by :meth:`_format()` for the background
+        thread to send, dropping a chunk if the queue is full.
+        """
+        while True:
+            try:
+                self.queue.put_nowait(chunk)
+                self._count("enqueued", chunk[1])
+                return
+            except Queue.Full:
+                if self.drop == "newest":
+                    self._count("dropped", chunk[1])
+                    return
+
+            # Make room by dropping the oldest chunk, unless the sender
+            # beat us to it
+            try:
+                _, count = self.queue.get_nowait()
+                self.queue.task_done()
+                self._count("dropped", count)
+            except Queue.Empty:
+                pass
+
+    def _send_queued(self):
+        """
+        Sends the queued chunks to Graphite until the process exits. This
+        runs in the background thread.
+        """
+        while True:
+            chunk = self.queue.get()
+            self.sock_lock.acquire()
+            try:
+                self._send(chunk)
+            except:
+                self.logger.exception("Failed to write out the metrics!")
+            finally:
+                self.sock_lock.release()
+                self.queue.task_done()
+
+    def _send(self, chunk):
         """
-        self.sock.close()
+        Writes a chunk returned by :meth:`_format()` to the socket, counting
+        whether it was sent and spooling it if it wasn't. The socket lock
+        must be held.
+        """
+        data, count = chunk
+        start = time.time()
+        try:
+            sent = self._write_metric(data)
+        except:
+            self.logger.exception("Failed to write out the metrics!")
+            sent = False
+        self._time("write", time.time() - start)
+
+        if sent:
+            self._count("sent", count)
+            return
+
+        self._count("failed", count)
+        if self.spool is not None and self.spool.append(data, count):
+            self._count("spooled", count)
+
+    def _replay_spooled(self):
+        """
+        Replays the spooled chunks until the process exits, sending at
+        most the replay rate of metrics each second. This runs in the
+        background thread.
+        """
+        while True:
+            time.sleep(1)
+            try:
+                self._replay()
+            except:
+                self.logger.exception("Failed to replay spooled metrics!")
+
+    def _replay(self):
+        """
+        Sends the oldest spooled chunks until a second's worth of the replay
+        rate has been sent, the spool is empty, or a chunk fails to send.
+        Chunks are sent whole, so the metrics sent past the allowance are
+        taken off the allowance of the seconds after, which keeps to the
+        replay rate even for chunks larger than it.
+        """
+        self.replay_allowance = min(self.replay_allowance, 0) + self.replay_rate
+        while self.replay_allowance > 0:
+            record = self.spool.peek()
+            if record is None:
+                return
+
+            seq, data, count = record
+            self.sock_lock.acquire()
+            try:
+                # Try a single reconnect rather than the usual attempts,
+                # since Graphite is likely still down if this fails
+                try:
+                    if self.sock is None:
+                        raise socket.error, "Not connected"
+                    self.sock.sendall(data)
+                except socket.error:
+                    self.sock = self._create_socket()
+                    self.sock.sendall(data)
+            except socket.error:
+                return
+            finally:
+                self.sock_lock.release()
+
+            self.spool.pop(seq)
+            self._count("replayed", count)
+            self.replay_allowance -= count
 
     def _create_socket(self):
-        """Creates a socket and connects to the graphite server"""
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((self.host,self.port))
-        return sock
+        """
+        Creates a socket and connects to the graphite server. The timeout
+        applies to connecting and to every write after.
+        """
+        return socket.create_connection((self.host,self.port), self.timeout)
 
     def _write_metric(self, metric):
-        """Tries to write a string to the socket, reconnecting on any errors"""
+        """
+        Tries to write a string to the socket, reconnecting on any errors.
+        Returns whether the string was written.
+        """
         for attempt in xrange(self.attempts):
             try:
+                if self.sock is None:
+                    self.sock = self._create_socket()
                 self.sock.sendall(metric)
-                return
+                return True
             except socket.error:
                 self.logger.exception("Error while flushing to graphite. Reattempting...")
-                self.sock = self._create_socket()
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
 
         self.logger.critical("Failed to flush to Graphite! Gave up after %d attempts." % self.attempts)
+        return False
+
+class GraphitePickleStore(GraphiteStore):
+    def __init__(self, host="localhost", port=2004, prefix="statsite", attempts=3, batch_size=500, **kwargs):
+        """
+        Implements a metrics store which persists metrics to Graphite
+        using the pickle protocol of carbon, rather than the plaintext
+        protocol. The metrics are sent in batches, each of which is a
+        pickled list of (path, (timestamp, value)) tuples prefixed by its
+        length, which is much cheaper to produce than the plaintext lines
+        and for carbon to parse.
+
+        :Parameters:
+            - `host` : The hostname of the graphite server.
+            - `port` : The pickle port of the graphite server.
+            - `prefix` (optional) : A prefix to add to the keys. Defaults to 'statsite'
+            - `attempts` (optional) : The number of re-connect retries before failing.
+            - `batch_size` (optional) : The most metrics to send in each batch,
+            which keeps each message within the size carbon will accept.
+
+        The remaining keyword arguments are those of :class:`GraphiteStore`.
+        """
+        batch_size = int(batch_size)
+        if batch_size <= 0: raise ValueError, "Batch size must be positive!"
+
+        super(GraphitePickleStore, self).__init__(host, port, prefix, attempts, **kwargs)
+        self.batch_size = batch_size
+
+    def _format(self, metrics, prefixed=False):
+        """
+        Formats the metrics for the pickle protocol, returning a list of
+        (data, count) tuples of the length prefixed batches to write to the
+        socket in turn and the number of metrics in each.
+        """
+        prefix = "" if prefixed else self.prefix + "."
+        chunks = []
+        for i in xrange(0, len(metrics), self.batch_size):
+            # Only build the points for one batch at a time, since building
+            # them all up front keeps the garbage collector busy
+            points = [(prefix + k, (int(ts), v)) for k,v,ts in metrics[i:i + self.batch_size]]
+            payload = cPickle.dumps(points, cPickle.HIGHEST_PROTOCOL)
+            chunks.append((struct.pack("!L", len(payload)) + payload, len(points)))
+
+        return chunks
+
+class ShardedGraphiteStore(MetricsStore):
+    ROUTE_CACHE_SIZE = 100000
+    "The number of keys to remember the destination of."
+
+    SHARD_QUEUE_SIZE = 10
+    "The number of shards to queue for each destination before dropping them."
+
+    def __init__(self, destinations, prefix="statsite", replicas=100,
+                 destination_class="metrics_store.GraphiteStore", name_cache_size=100000, **kwargs):
+        """
+        Implements a metrics store which spreads the metrics across several
+        Graphite servers by consistent hashing of their keys, placing each
+        key on the same server that carbon's consistent hashing relays
+        would. Each destination has its own store, and so its own
+        connection, queue and spool, and is written to by its own
+        long-lived thread, so that a slow or failing destination doesn't
+        hold up the others. :meth:`flush()` only hands each destination
+        its shard, and if a destination falls so far behind that
+        ``SHARD_QUEUE_SIZE`` shards are waiting for it, its new shards are
+        dropped and counted in the ``dropped`` counter. The Graphite stores
+        connect on their first write, so a destination which is down
+        doesn't stop Statsite from starting, and the metrics for it are
+        spooled if spooling is on.
+
+        :Parameters:
+            - `destinations` : A list of "host:port[:instance]" strings, or a
+            comma separated string of them, as in carbon's DESTINATIONS.
+            - `prefix` (optional) : A prefix to add to the keys. Defaults to 'statsite'
+            - `replicas` (optional) : The number of replicas of each destination
+            on the hash ring. This must match carbon's, which is 100.
+            - `destination_class` (optional) : The store class to use for each
+            destination. Defaults to :class:`GraphiteStore`.
+            - `name_cache_size` (optional) : The number of keys to cache the
+            output names of. Defaults to 100000, and 0 disables the cache.
+
+        The remaining keyword arguments are given to the store of each
+        destination. If a spool path is given, each destination spools to
+        its own file, suffixed with the host and port. Metrics which were
+        named by :attr:`names` are flushed to the destination stores with
+        ``prefixed`` set, which the Graphite stores understand.
+        """
+        if isinstance(destinations, basestring):
+            destinations = destinations.split(",")
+
+        destinations = [self._parse_destination(dest) for dest in destinations]
+        if not destinations: raise ValueError, "Must have at least 1 destination!"
+
+        cls = destination_class
+        if isinstance(cls, basestring):
+            cls = resolve_class_string(cls)
+
+        name_cache_size = int(name_cache_size)
+        if name_cache_size < 0: raise ValueError, "Name cache size must not be negative!"
+
+        self.prefix = prefix
+        if name_cache_size > 0:
+            self.names = OutputNames(prefix, name_cache_size)
+
+        self.stores = {}
+        for host, port, instance in destinations:
+            node = (host, instance)
+            if node in self.stores:
+                raise ValueError, "Destinations on the same host need distinct instances!"
+
+            settings = dict(kwargs)
+            if settings.get("spool_path"):
+                settings["spool_path"] = "%s.%s_%d" % (settings["spool_path"], host, port)
+
+            self.stores[node] = cls(host=host, port=port, prefix=prefix, **settings)
+
+        self.ring = ConsistentHashRing(self.stores.keys(), replicas)
+        self.routes = {}
+        self.dropped = 0
+        self.logger = logging.getLogger("statsite.shardedgraphitestore")
+
+        # Start the thread which writes to each destination
+        self.queues = {}
+        for node in self.stores:
+            self.queues[node] = Queue.Queue(self.SHARD_QUEUE_SIZE)
+            thread = threading.Thread(target=self._write_shards, args=(node, self.queues[node]))
+            thread.daemon = True
+            thread.start()
+
+    def flush(self, metrics, prefixed=False):
+        """
+        Flushes each of the metrics provided to the Graphite server its
+        key hashes to.
+
+        :Parameters:
+        - `metrics` : A list of (key,value,timestamp) tuples.
+        - `prefixed` (optional) : Whether the keys already have the prefix,
+        having been named by :attr:`names`.
+        """
+        shards = dict([(node, []) for node in self.stores])
+        routes = self.routes
+        if len(routes) >= self.ROUTE_CACHE_SIZE:
+            routes.clear()
+
+        # Carbon hashes the full metric path, so include the prefix
+        prefix = "" if prefixed else self.prefix + "."
+        for metric in metrics:
+            node = routes.get(metric[0])
+            if node is None:
+                node = routes[metric[0]] = self.ring.get_node(prefix + metric[0])
+            shards[node].append(metric)
+
+        # Hand each shard to the thread of its destination without waiting
+        # for it to be written, so a stuck destination can't hold up the
+        # flush
+        for node, shard in shards.iteritems():
+            if not shard:
+                continue
+
+            try:
+                self.queues[node].put_nowait((shard, prefixed))
+            except Queue.Full:
+                self.logger.warning("Too many shards queued for destination %s, dropping a shard" % (node,))
+                self.dropped += len(shard)
+
+    @property
+    def counters(self):
+        "The counters of all the destination stores added up."
+        counters = self._sum_children("counters")
+        counters["dropped"] = counters.get("dropped", 0) + self.dropped
+        return counters
+
+    @property
+    def timings(self):
+        "The timings of all the destination stores added up."
+        return self._sum_children("timings")
+
+    def close(self):
+        """
+        Closes the connection to every destination, after waiting for the
+        queued shards to be written.
+        """
+        for queue in self.queues.itervalues():
+            queue.join()
+
+        for store in self.stores.itervalues():
+            if hasattr(store, "close"):
+                store.close()
+
+    def _write_shards(self, node, queue):
+        """
+        Flushes the shards queued for a single destination until the
+        process exits. This runs in the thread of the destination.
+        """
+        while True:
+            metrics, prefixed = queue.get()
+            try:
+                self._flush_shard(node, metrics, prefixed)
+            finally:
+                queue.task_done()
+
+    def _flush_shard(self, node, metrics, prefixed=False):
+        """
+        Flushes the metrics to the store of a single destination, making
+        sure its failures don't affect the other destinations.
+        """
+        try:
+            if prefixed:
+                self.stores[node].flush(metrics, prefixed=True)
+            else:
+                self.stores[node].flush(metrics)
+        except:
+            self.logger.exception("Failed to flush to destination: %s" % (node,))
+
+    def _sum_children(self, attr):
+        """
+        Adds up a dictionary attribute of the destination stores which
+        have it.
+        """
+        totals = {}
+        for store in self.stores.itervalues():
+            for key,value in getattr(store, attr, {}).items():
+                totals[key] = totals.get(key, 0) + value
+
+        return totals
+
+    def _parse_destination(self, destination):
+        """
+        Parses a "host:port[:instance]" destination into a tuple of
+        (host, port, instance), where the instance may be None.
+        """
+        parts = destination.strip().split(":")
+        if len(parts) not in (2, 3):
+            raise ValueError, "Destinations must be host:port[:instance]: %s" % destination
+
+        instance = parts[2] if len(parts) == 3 else None
+        return (parts[0], int(parts[1]), instance)
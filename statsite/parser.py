@@ -4,11 +4,39 @@ parsing incoming messages.
 """
 import re
 
-LINE_REGEX = re.compile("^([a-zA-Z0-9-_.]+):(-?[0-9.]+)\|([a-z]+)(?:\|@([0-9.]+))?$")
+LINE_PATTERN = "([a-zA-Z0-9-_.]+):([-+]?[0-9.]+|[^|\n]+(?=\|s(?:\||$)))\|([a-z]+)(?:\|@([0-9.]+))?"
+"""
+The pattern of a single stats line, capturing the key, value, type and flag.
+Values are numbers, except for sets whose members may be any string.
+"""
+
+LINE_REGEX = re.compile("^%s$" % LINE_PATTERN)
 """
 Simple Regex used to match stats lines inside incoming messages.
 """
 
+CACHE_SIZE = 10000
+"""
+The number of recently parsed lines to remember the results for. Clients
+tend to send the exact same lines over and over (counters incremented by
+one, for example), and looking these up is much cheaper than parsing.
+"""
+
+CACHE_TYPES = ("c",)
+"""
+The types of the lines to remember the results for. The values of timers
+and key/values and the members of sets are nearly always different, so
+remembering those lines would only churn the cache.
+"""
+
+CACHE_LINE_LENGTH = 256
+"""
+The longest line to remember the result for, so that the cache holds a
+bounded amount of memory however long the keys which clients send are.
+"""
+
+_cache = {}
+
 def parse_line(line):
     """
     Utility function to parse an incoming line in a message.
@@ -16,19 +44,83 @@ def parse_line(line):
     Raises :exc:`ValueError` if the line is invalid or the
     message type if not valid.
 
-    Returns a :class:`Metric` object of the proper subclass.
+    Returns a (key, value, type, flag) tuple.
+    """
+    result = _cache.get(line)
+    if result is not None:
+        return result
+
+    result = _parse(line)
+    if result is None:
+        raise ValueError, "Invalid line: '%s'" % line
+
+    return result
+
+def parse_message(message):
+    """
+    Utility function to parse all of the lines in an incoming message
+    at once, which is much cheaper than calling :func:`parse_line()`
+    for each line. Blank lines are ignored.
+
+    Returns a tuple of (metrics, invalid), where metrics is a dictionary
+    of lists of (key, value, flag) tuples keyed by the metric type, and
+    invalid is a list of the lines which could not be parsed.
+    """
+    result = {}
+    invalid = []
+    cache = _cache
+    for line in message.split("\n"):
+        parsed = cache.get(line)
+        if parsed is None:
+            parsed = _parse(line)
+            if parsed is None:
+                if line:
+                    invalid.append(line)
+                continue
+
+        key, value, metric_type, flag = parsed
+        records = result.get(metric_type)
+        if records is None:
+            records = result[metric_type] = []
+        records.append((key, value, flag))
+
+    return (result, invalid)
+
+def _parse(line):
+    """
+    Parses a line which isn't cached, remembering the result. Returns
+    None if the line is invalid.
     """
     match = LINE_REGEX.match(line)
     if match is None:
-        raise ValueError, "Invalid line: '%s'" % line
+        return None
 
     key, value, metric_type, flag = match.groups()
 
-    # Do type conversion to either float or int
-    value = float(value) if "." in value else int(value)
-    if flag is not None:
-        flag = float(flag) if "." in flag else int(flag)
+    # Gauges with a sign are relative updates, which is marked by a flag
+    # of True. Gauges have no other use for the flag, so a sample rate
+    # sent with a gauge is ignored.
+    relative = metric_type == "g" and value[0] in "+-"
+
+    # Do type conversion to either float or int, except for the members
+    # of sets which are kept as they are
+    try:
+        if metric_type != "s":
+            value = float(value) if "." in value else int(value)
+        if metric_type == "g":
+            flag = True if relative else None
+        elif flag is not None:
+            flag = float(flag) if "." in flag else int(flag)
+    except ValueError:
+        return None
 
-    # Return the metric object
-    return (key, value, metric_type, flag)
+    # Remember the result if the line is likely to be sent again,
+    # starting over once the cache is full rather than paying for any
+    # bookkeeping on every line
+    result = (key, value, metric_type, flag)
+    if metric_type in CACHE_TYPES and len(line) <= CACHE_LINE_LENGTH:
+        if len(_cache) >= CACHE_SIZE:
+            _cache.clear()
+        _cache[line] = result
 
+    return result
@@ -0,0 +1,111 @@
+"""
+Contains the sampling profiler which can be started on a running server
+to see where its threads spend their time.
+"""
+
+import collections
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+class SamplingProfiler(object):
+    """
+    Profiles every thread of the process by sampling their stacks at a
+    fixed interval for a number of seconds, then writes out how often
+    each stack was seen in the collapsed stack format used by flame graph
+    tools: one line per distinct stack, made up of the thread name and
+    the functions from the outermost to the innermost separated by
+    semicolons, followed by the number of samples.
+
+    Unlike :mod:`cProfile`, which only traces the thread it is enabled
+    in, this sees the collector and flush threads which are already
+    running. Nothing runs until the profiler is started, so there is no
+    overhead otherwise.
+    """
+
+    def __init__(self, directory=None, duration=30, interval=0.01):
+        """
+        :Parameters:
+            - `directory` (optional) : The directory to write the profiles to.
+            Defaults to the temporary directory.
+            - `duration` (optional) : The number of seconds to profile for.
+            Defaults to 30.
+            - `interval` (optional) : The number of seconds between samples.
+            Defaults to 0.01.
+        """
+        duration = float(duration)
+        interval = float(interval)
+        if duration <= 0: raise ValueError, "Duration must be positive!"
+        if interval <= 0: raise ValueError, "Interval must be positive!"
+
+        self.directory = directory or tempfile.gettempdir()
+        self.duration = duration
+        self.interval = interval
+        self.thread = None
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger("statsite.profiler")
+
+    def start(self):
+        """
+        Starts profiling in a background thread, unless a profile is
+        already being taken. Returns whether profiling was started.
+        """
+        self.lock.acquire()
+        try:
+            if self.thread is not None and self.thread.is_alive():
+                return False
+
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+            return True
+        finally:
+            self.lock.release()
+
+    def sample(self, stacks, ignore=None):
+        """
+        Takes a single sample of the stack of every thread other than the
+        one given, adding to the counts of the collapsed stacks.
+        """
+        names = dict([(thread.ident, thread.name) for thread in threading.enumerate()])
+        for ident, frame in sys._current_frames().items():
+            if ident == ignore:
+                continue
+
+            functions = []
+            while frame is not None:
+                code = frame.f_code
+                functions.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                frame = frame.f_back
+
+            functions.append(names.get(ident, "thread-%d" % ident))
+            functions.reverse()
+            stacks[";".join(functions)] += 1
+
+    def _run(self):
+        """
+        Samples the stacks for the duration and writes them out. This runs
+        in the background thread.
+        """
+        self.logger.info("Profiling for %d seconds" % self.duration)
+        ident = threading.current_thread().ident
+        stacks = collections.defaultdict(int)
+        end = time.time() + self.duration
+        while time.time() < end:
+            self.sample(stacks, ident)
+            time.sleep(self.interval)
+
+        path = os.path.join(self.directory, "statsite-%d-%d.collapsed" % (os.getpid(), int(time.time())))
+        try:
+            with open(path, "w") as f:
+                for stack, count in sorted(stacks.iteritems()):
+                    f.write("%s %d\n" % (stack, count))
+        except (IOError, OSError):
+            self.logger.exception("Failed to write the profile to: %s" % path)
+            return
+
+        self.logger.info("Wrote the profile to: %s" % path)
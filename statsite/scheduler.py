@@ -0,0 +1,222 @@
+"""
+Contains the scheduler which starts the flush of each interval, and
+the executor which runs the flushes.
+"""
+
+import logging
+import math
+import threading
+import time
+
+class FlushScheduler(object):
+    """
+    Calls a function at the end of every interval from a single
+    long-lived thread. The end of each interval is computed from the
+    first rather than from when the previous call returned, so the
+    schedule doesn't drift by the time each call takes.
+
+    If aligned, the intervals end on multiples of the interval since the
+    epoch, so that servers with synchronized clocks all flush at the same
+    wall clock times. Otherwise the first interval ends one interval
+    after the scheduler is started.
+
+    The function is called with the time at which the interval ended.
+    How late the last call was made is kept in :attr:`lag`, and the
+    latest of all of them in :attr:`max_lag`. If a call takes so long
+    that whole intervals pass in the meantime, those intervals are
+    skipped and counted in :attr:`skipped`.
+    """
+
+    def __init__(self, interval, callback, align=True):
+        """
+        :Parameters:
+            - `interval` : The number of seconds between calls.
+            - `callback` : The function to call with the end of each interval.
+            - `align` (optional) : Whether to align the intervals to the
+            wall clock. Defaults to True.
+        """
+        interval = float(interval)
+        if interval <= 0: raise ValueError, "Interval must be positive!"
+
+        self.interval = interval
+        self.callback = callback
+        self.align = align
+
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.skipped = 0
+
+        self.stopped = threading.Event()
+        self.thread = None
+        self.logger = logging.getLogger("statsite.scheduler")
+
+    def start(self):
+        """
+        Starts calling the function in a background thread.
+        """
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops calling the function, waiting for a call in progress to
+        return unless this is called from within it.
+        """
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+        self.thread = None
+
+    def first_boundary(self, now):
+        """
+        Returns the end of the first interval for a scheduler started at
+        the given time.
+        """
+        if self.align:
+            return (math.floor(now / self.interval) + 1) * self.interval
+
+        return now + self.interval
+
+    def _run(self):
+        """
+        Calls the function at the end of every interval until stopped.
+        This runs in the background thread.
+        """
+        boundary = self.first_boundary(time.time())
+        while True:
+            # Waiting can return a little early, so wait out any remainder
+            remaining = boundary - time.time()
+            while remaining > 0:
+                if self.stopped.wait(remaining):
+                    return
+                remaining = boundary - time.time()
+
+            if self.stopped.is_set():
+                return
+
+            self.lag = -remaining
+            self.max_lag = max(self.max_lag, self.lag)
+            self.logger.debug("Flushing the interval ending at %d, %.3fs late" % (boundary, self.lag))
+
+            try:
+                self.callback(boundary)
+            except:
+                self.logger.exception("Failed to call the scheduled function")
+
+            # Carry on from the next boundary still to come, rather than
+            # calling the function for every one which has passed
+            boundary += self.interval
+            behind = int((time.time() - boundary) / self.interval)
+            if behind > 0:
+                self.logger.warning("Skipping %d flush intervals which passed while flushing" % behind)
+                self.skipped += behind
+                boundary += behind * self.interval
+
+class FlushExecutor(object):
+    """
+    Runs the flushes of aggregators in background threads, with at most
+    a given number of them running at once, so that flushes which take
+    longer than the flush interval can't pile up without bound. When an
+    aggregator is submitted while the most flushes are already running,
+    the policy decides what to do with it:
+
+    * ``wait`` blocks until one of the running flushes finishes.
+    * ``merge`` holds on to the aggregator, and merges it into the
+      aggregator submitted next, which flushes them both.
+    * ``drop`` throws the aggregator away.
+
+    The number of aggregators merged and dropped are counted in
+    :attr:`merged` and :attr:`dropped`, and how long the last flush took
+    and when it finished are kept in :attr:`last_duration` and
+    :attr:`last_flushed`.
+    """
+
+    POLICIES = ("wait", "merge", "drop")
+    "The policies for aggregators submitted when the most flushes are running."
+
+    def __init__(self, max_pending=2, policy="wait"):
+        """
+        :Parameters:
+            - `max_pending` (optional) : The most flushes to run at once.
+            Defaults to 2.
+            - `policy` (optional) : One of "wait", "merge" or "drop".
+            Defaults to "wait".
+        """
+        max_pending = int(max_pending)
+        if max_pending <= 0: raise ValueError, "Must allow at least 1 pending flush!"
+        if policy not in self.POLICIES: raise ValueError, "Policy must be 'wait', 'merge' or 'drop'!"
+
+        self.max_pending = max_pending
+        self.policy = policy
+        self.pending = 0
+        self.merged = 0
+        self.dropped = 0
+        self.last_duration = None
+        self.last_flushed = None
+
+        self.late = None
+        self.condition = threading.Condition()
+        self.logger = logging.getLogger("statsite.executor")
+
+    def submit(self, aggregator):
+        """
+        Starts flushing the aggregator in a background thread, applying
+        the policy if the most flushes are already running. Returns whether
+        the flush was started.
+        """
+        self.condition.acquire()
+        try:
+            # Fold in the aggregator held back by the merge policy, now
+            # that there's another to merge it into
+            if self.late is not None:
+                late, self.late = self.late, None
+                try:
+                    aggregator.merge(late.drain())
+                except:
+                    self.logger.exception("Failed to merge a late aggregator, dropping it")
+                    self.dropped += 1
+
+            while self.pending >= self.max_pending:
+                if self.policy == "wait":
+                    self.condition.wait()
+                elif self.policy == "merge":
+                    self.logger.warning("Too many pending flushes, merging into the next flush")
+                    self.late = aggregator
+                    self.merged += 1
+                    return False
+                else:
+                    self.logger.warning("Too many pending flushes, dropping a flush")
+                    self.dropped += 1
+                    return False
+
+            self.pending += 1
+        finally:
+            self.condition.release()
+
+        thread = threading.Thread(target=self._flush, args=(aggregator,))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _flush(self, aggregator):
+        """
+        Flushes the aggregator, making room for the next flush once done.
+        This runs in the background thread.
+        """
+        start = time.time()
+        try:
+            aggregator.flush()
+        except:
+            self.logger.exception("Failed to flush an aggregator")
+        finally:
+            self.condition.acquire()
+            try:
+                self.last_flushed = time.time()
+                self.last_duration = self.last_flushed - start
+                self.pending -= 1
+                self.condition.notify()
+            finally:
+                self.condition.release()
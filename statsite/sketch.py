@@ -0,0 +1,221 @@
+"""
+Contains the mergeable sketches which metrics use to summarize their
+values in a bounded amount of memory per key: the quantile sketch which
+timers can use to approximate their percentile statistics, and the
+HyperLogLog which sets use to estimate their number of unique members.
+"""
+import hashlib
+import math
+import random
+import struct
+
+class KLLSketch(object):
+    """
+    Implements the KLL quantile sketch (Karnin, Lang and Liberty). Values
+    are kept in a hierarchy of compactors, where every value held at level
+    ``h`` stands for ``2**h`` of the values added. Whenever a compactor
+    fills up it is sorted and every other value is promoted to the next
+    level, so the sketch holds roughly ``3*k`` values no matter how many
+    are added. With the default ``k`` of 200 the rank of any value is
+    off by about 1% of the count at most.
+
+    The count, sum, minimum, maximum and variance of the values are
+    tracked exactly on the side. Sketches can be merged, as long as they
+    were created with the same ``k``.
+    """
+
+    C = 2.0 / 3.0
+    "The factor by which the capacity of each lower compactor shrinks."
+
+    def __init__(self, k=200):
+        self.k = int(k)
+        self.compactors = [[]]
+        self.size = 0
+        self.max_size = self._capacity(0)
+
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def append(self, value):
+        """
+        Adds a value to the sketch.
+        """
+        self.compactors[0].append(value)
+        self.size += 1
+        if self.size >= self.max_size:
+            self._compress()
+
+        # Track the exact statistics, using Welford's method for the variance
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min: self.min = value
+        if self.max is None or value > self.max: self.max = value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def merge(self, other):
+        """
+        Merges another sketch into this one, as if all the values added
+        to ``other`` had been added to this sketch.
+        """
+        if other.count == 0:
+            return
+
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+
+        for level, compactor in enumerate(other.compactors):
+            self.compactors[level].extend(compactor)
+
+        self.size = sum([len(c) for c in self.compactors])
+        while self.size >= self.max_size:
+            self._compress()
+
+        # Combine the exact statistics
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.count = count
+        self.sum += other.sum
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def stdev(self):
+        """
+        Returns the exact sample standard deviation of the values.
+        """
+        if self.count < 2:
+            return 0
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def items(self):
+        """
+        Returns a sorted list of (value, weight) tuples, where the weights
+        add up to the number of values added to the sketch.
+        """
+        items = []
+        for level, compactor in enumerate(self.compactors):
+            weight = 2 ** level
+            items.extend([(value, weight) for value in compactor])
+
+        items.sort()
+        return items
+
+    def _capacity(self, level):
+        """
+        Returns the capacity of the compactor at the given level. The top
+        compactor has a capacity of ``k``, and they shrink going down.
+        """
+        depth = len(self.compactors) - level - 1
+        return int(math.ceil((self.C ** depth) * self.k)) + 1
+
+    def _grow(self):
+        """
+        Adds a new compactor on top of the hierarchy.
+        """
+        self.compactors.append([])
+        self.max_size = sum([self._capacity(level) for level in xrange(len(self.compactors))])
+
+    def _compress(self):
+        """
+        Compacts the lowest compactor which is at capacity, promoting
+        every other one of its values to the level above.
+        """
+        for level, compactor in enumerate(self.compactors):
+            if len(compactor) >= self._capacity(level):
+                if level + 1 >= len(self.compactors):
+                    self._grow()
+
+                # Randomly keep either the odd or even values, so that
+                # the ranks are right in expectation. If there is an odd
+                # number of values, the largest one stays at this level.
+                compactor.sort()
+                odd = len(compactor) % 2
+                keep = compactor.pop() if odd else None
+                self.compactors[level + 1].extend(compactor[random.randint(0, 1)::2])
+                del compactor[:]
+                if odd: compactor.append(keep)
+                break
+
+        self.size = sum([len(c) for c in self.compactors])
+
+class HyperLogLog(object):
+    """
+    Implements the HyperLogLog cardinality estimator (Flajolet et al.).
+    Members are hashed to 64 bits, where the first ``precision`` bits pick
+    one of ``2**precision`` registers, and the register keeps the highest
+    position of the first set bit seen in the rest of the hash.
+
+    The registers take a byte each, so the default precision of 12 takes
+    4KB no matter how many members are added, and the relative standard
+    error of the estimate is ``1.04 / sqrt(2**precision)``, about 1.6%.
+    HyperLogLogs with the same precision can be merged.
+    """
+
+    MIN_PRECISION = 4
+    MAX_PRECISION = 16
+
+    _POWERS = [2.0 ** -i for i in xrange(66)]
+    "The inverse powers of two for every possible register value."
+
+    def __init__(self, precision=12):
+        precision = int(precision)
+        if precision < self.MIN_PRECISION or precision > self.MAX_PRECISION:
+            raise ValueError, "HyperLogLog precision must be between %d and %d" % \
+                (self.MIN_PRECISION, self.MAX_PRECISION)
+
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+        self._shift = 64 - precision
+        self._mask = (1 << self._shift) - 1
+
+    def add(self, member):
+        """
+        Adds a member to the set.
+        """
+        if not isinstance(member, str):
+            member = str(member)
+
+        x = struct.unpack("<Q", hashlib.md5(member).digest()[:8])[0]
+        index = x >> self._shift
+        rank = self._shift - (x & self._mask).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """
+        Merges another HyperLogLog into this one, as if all the members
+        added to ``other`` had been added to this one.
+        """
+        if other.precision != self.precision:
+            raise ValueError, "Can't merge HyperLogLogs with different precisions"
+
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def cardinality(self):
+        """
+        Returns the estimated number of unique members added.
+        """
+        m = self.size
+        if m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[m]
+
+        estimate = alpha * m * m / sum(map(self._POWERS.__getitem__, self.registers))
+
+        # Small cardinalities are estimated much better by counting the
+        # registers which are still empty
+        zeros = self.registers.count("\0")
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)
+
+        return int(round(estimate))
@@ -0,0 +1,208 @@
+"""
+Contains the disk-backed spool which stores keep the batches they fail
+to deliver in, so they can be replayed once the backing store is
+reachable again.
+"""
+
+import mmap
+import os
+import struct
+import threading
+
+class RingSpool(object):
+    """
+    A fixed-size ring of records kept in a memory-mapped file. Records
+    are appended at the tail and removed from the head in the order they
+    were appended. When there isn't room for a new record, the oldest
+    records are dropped to make room for it, so the file never grows past
+    its configured size.
+
+    Each record is a string of data along with the number of metrics in
+    it. The positions of the head and tail are kept in a header at the
+    start of the file, so the spool survives restarts.
+
+    The spool is thread-safe.
+    """
+
+    MAGIC = "SSP1"
+    "Identifies spool files, and their format version."
+
+    HEADER = struct.Struct("!4sQQQQ")
+    "The file header: the magic, head, tail, number of records and head sequence."
+
+    RECORD = struct.Struct("!II")
+    "The header of each record: the length of its data and its metric count."
+
+    WRAP = 0xFFFFFFFF
+    "A record length which marks that the next record is at the start of the ring."
+
+    def __init__(self, path, size):
+        """
+        Opens the spool at the given path, creating it if it doesn't exist
+        or recreating it if it was created with a different size.
+
+        :Parameters:
+            - `path` : The path of the spool file.
+            - `size` : The number of bytes to use for the records.
+        """
+        size = int(size)
+        if size <= self.RECORD.size: raise ValueError, "Spool size is too small!"
+
+        self.path = path
+        self.capacity = size
+        self.lock = threading.Lock()
+
+        # Count the records which had to be dropped to make room
+        self.dropped = 0
+        self.dropped_count = 0
+
+        total = self.HEADER.size + size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            existing = os.fstat(fd).st_size
+            if existing != total:
+                os.ftruncate(fd, total)
+
+            self.map = mmap.mmap(fd, total)
+        finally:
+            os.close(fd)
+
+        magic, self.head, self.tail, self.records, self.seq = self.HEADER.unpack_from(self.map, 0)
+        if existing != total or magic != self.MAGIC:
+            self.head = self.tail = self.records = self.seq = 0
+            self._write_header()
+
+    def __len__(self):
+        return self.records
+
+    def append(self, data, count):
+        """
+        Appends a record to the spool, dropping the oldest records if
+        there isn't room for it. Returns False if the record is too large
+        to ever fit in the spool.
+        """
+        size = self.RECORD.size + len(data)
+        if size > self.capacity:
+            return False
+
+        self.lock.acquire()
+        try:
+            while True:
+                position = self._reserve(size)
+                if position is not None:
+                    break
+
+                self.dropped += 1
+                self.dropped_count += self._pop()[1]
+
+            offset = self.HEADER.size + position
+            self.RECORD.pack_into(self.map, offset, len(data), count)
+            self.map[offset + self.RECORD.size:offset + size] = data
+
+            self.tail = position + size
+            self.records += 1
+            self._write_header()
+            return True
+        finally:
+            self.lock.release()
+
+    def peek(self):
+        """
+        Returns the oldest record as a (seq, data, count) tuple without
+        removing it, or None if the spool is empty. The sequence number
+        identifies the record to :meth:`pop()`.
+        """
+        self.lock.acquire()
+        try:
+            if not self.records:
+                return None
+
+            self._skip_wrap()
+            offset = self.HEADER.size + self.head
+            length, count = self.RECORD.unpack_from(self.map, offset)
+            start = offset + self.RECORD.size
+            return (self.seq, self.map[start:start + length], count)
+        finally:
+            self.lock.release()
+
+    def pop(self, seq):
+        """
+        Removes the oldest record, if it is still the record with the given
+        sequence number returned by :meth:`peek()`. It may not be, if it was
+        dropped to make room for new records in the meantime.
+        """
+        self.lock.acquire()
+        try:
+            if self.records and self.seq == seq:
+                self._pop()
+                self._write_header()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """
+        Writes the spool out to disk and closes it.
+        """
+        self.map.flush()
+        self.map.close()
+
+    def _reserve(self, size):
+        """
+        Returns the position to write a record of the given size at, or
+        None if there's no room for it. Writes the wrap marker if the
+        record has to go at the start of the ring. The lock must be held.
+        """
+        if not self.records:
+            self.head = self.tail = 0
+            return 0
+
+        # Unless the records wrap around the end of the ring, the free
+        # space is after the tail and before the head
+        if self.tail > self.head:
+            if self.capacity - self.tail >= size:
+                return self.tail
+
+            if self.head >= size:
+                if self.capacity - self.tail >= self.RECORD.size:
+                    self.RECORD.pack_into(self.map, self.HEADER.size + self.tail, self.WRAP, 0)
+                return 0
+
+            return None
+
+        if self.head - self.tail >= size:
+            return self.tail
+
+        return None
+
+    def _skip_wrap(self):
+        """
+        Moves the head to the start of the ring if the next record is
+        there. The lock must be held.
+        """
+        if self.capacity - self.head < self.RECORD.size:
+            self.head = 0
+        else:
+            length, _ = self.RECORD.unpack_from(self.map, self.HEADER.size + self.head)
+            if length == self.WRAP:
+                self.head = 0
+
+    def _pop(self):
+        """
+        Removes the oldest record, returning its (length, count). The lock
+        must be held, and the header isn't written.
+        """
+        self._skip_wrap()
+        length, count = self.RECORD.unpack_from(self.map, self.HEADER.size + self.head)
+        self.head += self.RECORD.size + length
+        self.records -= 1
+        self.seq += 1
+        if not self.records:
+            self.head = self.tail = 0
+
+        return (length, count)
+
+    def _write_header(self):
+        """
+        Writes the positions out to the header. The lock must be held.
+        """
+        self.HEADER.pack_into(self.map, 0, self.MAGIC, self.head, self.tail, self.records, self.seq)
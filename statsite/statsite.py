@@ -4,15 +4,17 @@ for running a server.
 """
 import logging
 import pprint
-import SocketServer
 import threading
+import time
 
 from . import __version__
 from aggregator import DefaultAggregator
-from aliveness import AlivenessHandler
+from aliveness import AlivenessHandler, AlivenessServer
 from collector import UDPCollector
 from metrics_store import GraphiteStore
-from util import deep_merge, resolve_class_string
+from profiler import SamplingProfiler
+from scheduler import FlushExecutor, FlushScheduler
+from util import deep_merge, resolve_class_string, to_bool
 
 BANNER = """
 Statsite v%(version)s
@@ -34,13 +36,17 @@ class Statsite(object):
 
     DEFAULT_SETTINGS = {
         "flush_interval": 10,
+        "flush_align": True,
+        "flush_max_pending": 2,
+        "flush_policy": "wait",
         "aggregator": {
             "class": "aggregator.DefaultAggregator"
         },
         "aliveness_check": {
             "enabled": False,
             "host": "0.0.0.0",
-            "port": 8325
+            "port": 8325,
+            "max_flush_lag": 60
         },
         "collector": {
             "class": "collector.UDPCollector"
@@ -48,6 +54,15 @@ class Statsite(object):
         "store": {
             "class": "metrics_store.GraphiteStore"
         },
+        "instrumentation": {
+            "enabled": False,
+            "namespace": "statsite"
+        },
+        "profiler": {
+            "directory": None,
+            "duration": 30,
+            "interval": 0.01
+        },
         "metrics": {}
     }
 
@@ -89,8 +104,12 @@ class Statsite(object):
         self.logger.debug("Initializing metrics store: %s" % self._store_cls)
         self.store = self._store_cls(**self.settings["store"])
 
-        # Setup the aggregator, provide the store
+        # Setup the aggregator, provide the store along with the state
+        # which stateful metrics carry across flush intervals, and the
+        # lock which guards it from flushes running at once
         self.settings["aggregator"]["metrics_store"] = self.store
+        self.metrics_state = {}
+        self.metrics_lock = threading.Lock()
         self.logger.debug("Initializing aggregator: %s" % self._aggregator_cls)
         self.aggregator = self._create_aggregator()
 
@@ -99,9 +118,22 @@ class Statsite(object):
         self.logger.debug("Initializing collector: %s" % self._collector_cls)
         self.collector = self._collector_cls(**self.settings["collector"])
 
+        # Setup the scheduler which starts the flush of every interval,
+        # and the executor which bounds how many flushes run at once
+        self.scheduler = FlushScheduler(int(self.settings["flush_interval"]), self._on_timer,
+                                        align=to_bool(self.settings["flush_align"]))
+        self.executor = FlushExecutor(self.settings["flush_max_pending"],
+                                      self.settings["flush_policy"])
+
+        # Setup the profiler, which only runs when asked to
+        self.profiler = SamplingProfiler(**self.settings["profiler"])
+
+        # The running totals of Statsite's own metrics at the last flush
+        self.internal_totals = {}
+
         # Setup defaults
         self.aliveness_check = None
-        self.timer = None
+        self.started = time.time()
 
     def start(self):
         """
@@ -109,11 +141,12 @@ class Statsite(object):
         separate thread and return immediately.
         """
         self.logger.info("Statsite starting")
-        self._reset_timer()
+        self.started = time.time()
 
         if self.settings["aliveness_check"]["enabled"]:
             self._enable_aliveness_check()
 
+        self.scheduler.start()
         self.collector.start()
 
     def shutdown(self):
@@ -126,17 +159,82 @@ class Statsite(object):
         inaccurate statistics.
         """
         self.logger.info("Statsite shutting down")
-        if self.timer:
-            self.timer.cancel()
+        self.scheduler.stop()
 
         self._disable_aliveness_check()
         self.collector.shutdown()
 
+    def profile(self):
+        """
+        Starts profiling every thread of the server for the configured
+        duration, after which the profile is written to the configured
+        directory. Returns False if a profile is already being taken.
+        """
+        return self.profiler.start()
+
+    def stats(self):
+        """
+        Returns the live numbers of the server as a dictionary: how much
+        the collector has received, how many keys and samples the current
+        aggregator holds, and how the flushes and the store are keeping up.
+        The flush lag is how long overdue the next flush is, which is 0
+        while flushes are finishing every interval. The keys and samples
+        are left out for collectors which aggregate in other processes,
+        since the aggregator only holds them once the interval has ended.
+        """
+        stats = {
+            "flush.pending": self.executor.pending,
+            "flush.dropped": self.executor.dropped,
+            "flush.merged": self.executor.merged,
+            "flush.last_duration": self.executor.last_duration,
+            "flush.lag": self._flush_lag(),
+            "flush.scheduler_lag": self.scheduler.lag
+        }
+
+        for name in ("packets", "lines", "parse_errors"):
+            stats["collector.%s" % name] = getattr(self.collector, name, 0)
+
+        if not getattr(self.collector, "aggregates_elsewhere", False):
+            keys, samples = self.aggregator.size()
+            stats["aggregator.keys"] = keys
+            stats["aggregator.samples"] = samples
+
+        limiter = getattr(self.aggregator, "limiter", None)
+        if limiter is not None:
+            stats["aggregator.overflowed"] = limiter.overflowed
+
+        for name,value in getattr(self.store, "counters", {}).items():
+            stats["store.%s" % name] = value
+
+        queue = getattr(self.store, "queue", None)
+        if queue is not None:
+            stats["store.queued"] = queue.qsize()
+
+        return stats
+
+    def healthy(self):
+        """
+        Returns whether the server is keeping up, which is whether the
+        next flush is overdue by no more than the most flush lag allowed
+        by the aliveness check settings.
+        """
+        max_lag = float(self.settings["aliveness_check"]["max_flush_lag"])
+        return self._flush_lag() <= max_lag
+
+    def _flush_lag(self):
+        """
+        Returns how many seconds overdue the next flush is, counting from
+        the last flush to finish or else from when the server started.
+        """
+        last_flushed = self.executor.last_flushed or self.started
+        interval = int(self.settings["flush_interval"])
+        return max(0.0, time.time() - last_flushed - interval)
+
     def _enable_aliveness_check(self):
         """
         This enables the TCP aliveness check, which is useful for tools
         such as Monit, Nagios, etc. to verify that Statsite is still
-        alive.
+        alive, and which also serves the live stats over HTTP.
         """
         if self.aliveness_check:
             self.aliveness_check.shutdown()
@@ -148,7 +246,7 @@ class Statsite(object):
         port = int(self.settings["aliveness_check"]["port"])
 
         # Create the server
-        self.aliveness_check = SocketServer.TCPServer((host, port), AlivenessHandler)
+        self.aliveness_check = AlivenessServer((host, port), AlivenessHandler, self)
 
         # Run the aliveness check in a thread
         thread = threading.Thread(target=self.aliveness_check.serve_forever)
@@ -164,18 +262,19 @@ class Statsite(object):
             self.aliveness_check.shutdown()
             self.aliveness_check = None
 
-    def _on_timer(self):
+    def _on_timer(self, timestamp):
         """
-        This is the callback called every flush interval, and is responsible
-        for initiating the aggregator flush.
+        This is the callback called by the scheduler every flush interval,
+        with the time the interval ended, and is responsible for initiating
+        the aggregator flush.
         """
-        self._reset_timer()
-        self._flush_and_switch_aggregator()
+        self._flush_and_switch_aggregator(timestamp)
 
-    def _flush_and_switch_aggregator(self):
+    def _flush_and_switch_aggregator(self, timestamp=None):
         """
         This is called periodically to flush the aggregator and switch
-        the collector to a new aggregator.
+        the collector to a new aggregator. The flushed metrics are stamped
+        with the given time of the end of the interval, if any.
         """
         self.logger.debug("Flushing and switching aggregator...")
 
@@ -185,23 +284,63 @@ class Statsite(object):
         self.aggregator = self._create_aggregator()
         self.collector.set_aggregator(self.aggregator)
 
-        # Flush the old aggregator in it's own thread
-        thread = threading.Thread(target=old_aggregator.flush)
-        thread.daemon = True
-        thread.start()
+        # Collectors which aggregate in other processes hand over their
+        # partial aggregates for the interval, which are merged in
+        try:
+            for partial in self.collector.collect_partials():
+                old_aggregator.merge(partial)
+        except:
+            self.logger.exception("Failed to merge partial aggregates")
 
-    def _create_aggregator(self):
+        old_aggregator.timestamp = timestamp
+
+        # Have Statsite's own metrics for the interval flushed along with it
+        instrumentation = self.settings["instrumentation"]
+        if to_bool(instrumentation["enabled"]):
+            old_aggregator.internal_namespace = instrumentation["namespace"]
+            old_aggregator.internal_metrics = self._internal_metrics()
+
+        # Flush the old aggregator in it's own thread, unless too many
+        # flushes are still running
+        self.executor.submit(old_aggregator)
+
+    def _internal_metrics(self):
         """
-        Returns a new aggregator with the settings given at initialization.
+        Returns Statsite's own metrics for the interval that just ended,
+        keyed by name: how much the collector received, how the flushes and
+        the store kept up, and how late the flush was started.
         """
-        return self._aggregator_cls(metrics_settings=self.settings["metrics"], **self.settings["aggregator"])
+        totals = {}
+        for name in ("packets", "lines", "parse_errors"):
+            totals["collector.%s" % name] = getattr(self.collector, name, 0)
+
+        totals["flush.dropped"] = self.executor.dropped
+        totals["flush.merged"] = self.executor.merged
+        for name,value in getattr(self.store, "counters", {}).items():
+            totals["store.%s" % name] = value
+        for name,value in getattr(self.store, "timings", {}).items():
+            totals["store.%s_seconds" % name] = value
+
+        names = getattr(self.store, "names", None)
+        if names is not None:
+            totals["store.name_cache_hits"] = names.hits
+            totals["store.name_cache_misses"] = names.misses
+
+        # The totals only ever go up, so report how much they went up by
+        # during the interval
+        result = dict([(name, value - self.internal_totals.get(name, 0))
+                       for name,value in totals.iteritems()])
+        self.internal_totals = totals
+
+        result["flush.pending"] = self.executor.pending
+        result["flush.lag_seconds"] = self.scheduler.lag
+        return result
 
-    def _reset_timer(self):
+    def _create_aggregator(self):
         """
-        Resets the flush timer.
+        Returns a new aggregator with the settings given at initialization.
         """
-        if self.timer:
-            self.timer.cancel()
-
-        self.timer = threading.Timer(int(self.settings["flush_interval"]), self._on_timer)
-        self.timer.start()
+        return self._aggregator_cls(metrics_settings=self.settings["metrics"],
+                                    metrics_state=self.metrics_state,
+                                    metrics_lock=self.metrics_lock,
+                                    **self.settings["aggregator"])
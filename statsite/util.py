@@ -52,3 +52,260 @@ def resolve_class_string(full_string):
         raise ImportError, "Class not found in module: %s" % full_string
 
     return getattr(module, cls_string)
+
+def to_bool(value):
+    """
+    Converts a setting, which may be a string from a configuration
+    file such as "true" or "0", to a boolean.
+    """
+    if isinstance(value, basestring):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+
+    return bool(value)
+
+class LRUCache(object):
+    """
+    A cache which holds a bounded number of entries, evicting those which
+    haven't been used recently. Rather than keeping track of the exact
+    order of use, which costs more than many of the values are worth
+    building, entries are kept in two generations of plain dictionaries.
+    Hits on the old generation promote the entry to the new one, and once
+    the new generation is full it replaces the old one, evicting every
+    entry which wasn't used in the meantime. At most ``2 * size`` entries
+    are held.
+
+    The number of hits and misses are counted in :attr:`hits` and
+    :attr:`misses`. The cache can be shared between threads, though the
+    counts may be slightly off under contention.
+    """
+
+    def __init__(self, size):
+        size = int(size)
+        if size <= 0: raise ValueError, "Cache size must be positive!"
+
+        self.size = size
+        self.new = {}
+        self.old = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.new) + len(self.old)
+
+    def get(self, key):
+        """
+        Returns the value cached for the key, or None if there is none.
+        """
+        value = self.new.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        value = self.old.get(key)
+        if value is not None:
+            self.hits += 1
+            self.set(key, value)
+        else:
+            self.misses += 1
+
+        return value
+
+    def set(self, key, value):
+        """
+        Caches a value, which must not be None, for the key.
+        """
+        if len(self.new) >= self.size:
+            self.old = self.new
+            self.new = {}
+
+        self.new[key] = value
+
+class OutputNames(object):
+    """
+    Caches the full output names of metric keys, such as
+    "statsite.timers.api.sum", across flush intervals. The same keys tend
+    to be flushed interval after interval, and looking their names up is
+    much cheaper than formatting them again, especially for timers which
+    have a dozen or more names per key.
+
+    Metric stores which have a prefix keep an instance in their ``names``
+    attribute, which aggregators hand to the folds so that they emit the
+    names with the prefix of the store already added.
+    """
+
+    def __init__(self, prefix=None, size=100000):
+        """
+        :Parameters:
+            - `prefix` (optional) : The prefix of all the names, if any.
+            - `size` (optional) : The number of keys of each namespace to
+            cache the names of. If 0, names are built on every lookup.
+        """
+        self.prefix = "%s." % prefix if prefix else ""
+        self.size = int(size)
+        self.caches = {}
+
+    @property
+    def hits(self):
+        "The number of lookups of names which were cached."
+        return sum([cache.hits for cache in self.caches.values()])
+
+    @property
+    def misses(self):
+        "The number of lookups of names which had to be built."
+        return sum([cache.misses for cache in self.caches.values()])
+
+    def lookup(self, namespace, suffixes=("",)):
+        """
+        Returns a function which takes a key and returns the tuple of its
+        output names, "<prefix><namespace>.<key><suffix>" for each of the
+        suffixes, in order. The namespace may be empty.
+        """
+        base = self.prefix + ("%s." % namespace if namespace else "")
+        if not self.size:
+            return lambda key: tuple([base + key + suffix for suffix in suffixes])
+
+        cache = self.caches.get((namespace, suffixes))
+        if cache is None:
+            cache = self.caches.setdefault((namespace, suffixes), LRUCache(self.size))
+
+        def lookup(key):
+            names = cache.get(key)
+            if names is None:
+                names = tuple([base + key + suffix for suffix in suffixes])
+                cache.set(key, names)
+            return names
+
+        return lookup
+
+class KeyLimiter(object):
+    """
+    Bounds the number of distinct keys aggregated in a flush interval,
+    both in total and under each key prefix, so that a client which puts
+    something unique such as an ID in its keys can't create an unbounded
+    number of keys in memory and series in the store.
+
+    Keys are admitted as they are first seen until a limit is reached,
+    after which new keys are replaced by an overflow key: "<prefix>.<overflow>"
+    when the limit of the prefix is reached, or "<overflow>" when the
+    total limit is. Keys which were already admitted are always kept. The
+    number of keys replaced is counted in :attr:`overflowed`.
+
+    The prefix of a key is its first ``prefix_depth`` dot separated
+    parts. Keys with no more parts than that have no prefix, and only
+    count towards the total.
+    """
+
+    def __init__(self, max_keys=0, max_keys_per_prefix=0, prefix_depth=1, overflow_key="overflow"):
+        """
+        :Parameters:
+            - `max_keys` (optional) : The most keys in total, or 0 for no
+            limit. Defaults to 0.
+            - `max_keys_per_prefix` (optional) : The most keys under each
+            prefix, or 0 for no limit. Defaults to 0.
+            - `prefix_depth` (optional) : The number of parts of the keys
+            which make up their prefix. Defaults to 1.
+            - `overflow_key` (optional) : The key, or the last part of
+            the key under a prefix, which new keys are replaced by once
+            a limit is reached. Defaults to "overflow".
+        """
+        max_keys = int(max_keys)
+        max_keys_per_prefix = int(max_keys_per_prefix)
+        prefix_depth = int(prefix_depth)
+        if max_keys < 0: raise ValueError, "Max keys must not be negative!"
+        if max_keys_per_prefix < 0: raise ValueError, "Max keys per prefix must not be negative!"
+        if prefix_depth <= 0: raise ValueError, "Prefix depth must be positive!"
+        if not overflow_key: raise ValueError, "Must have an overflow key!"
+
+        self.max_keys = max_keys
+        self.max_keys_per_prefix = max_keys_per_prefix
+        self.prefix_depth = prefix_depth
+        self.overflow_key = overflow_key
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets every key admitted, for the start of a new interval.
+        """
+        self.keys = set()
+        self.prefixes = {}
+        self.overflowed = 0
+
+    def limit(self, key):
+        """
+        Returns the key to aggregate the given key under, which is the
+        key itself unless a limit has been reached.
+        """
+        if key in self.keys:
+            return key
+
+        # Overflow keys which are limited again, such as when limiting the
+        # state carried over from earlier intervals, were counted when the
+        # keys in them first overflowed
+        prefix = self._prefix(key)
+        overflow_key = key == self.overflow_key or \
+            (prefix is not None and key == "%s.%s" % (prefix, self.overflow_key))
+
+        if self.max_keys and len(self.keys) >= self.max_keys:
+            if not overflow_key:
+                self.overflowed += 1
+            return self.overflow_key
+
+        # The overflow key of the prefix is admitted without counting
+        # towards the prefix
+        if prefix is not None and not overflow_key:
+            if self.prefixes.get(prefix, 0) >= self.max_keys_per_prefix:
+                self.overflowed += 1
+                key = "%s.%s" % (prefix, self.overflow_key)
+                self.keys.add(key)
+                return key
+
+            self.prefixes[prefix] = self.prefixes.get(prefix, 0) + 1
+
+        self.keys.add(key)
+        return key
+
+    def admit(self, keys):
+        """
+        Admits the given keys whatever the limits, such as the keys of
+        state carried over from earlier intervals, so that they count
+        towards the limits of the keys which come after them.
+        """
+        for key in keys:
+            if key in self.keys:
+                continue
+
+            self.keys.add(key)
+            prefix = self._prefix(key)
+            if prefix is not None and key != "%s.%s" % (prefix, self.overflow_key):
+                self.prefixes[prefix] = self.prefixes.get(prefix, 0) + 1
+
+    def _prefix(self, key):
+        """
+        Returns the prefix of the key if there is a limit per prefix and
+        the key has one, or None otherwise.
+        """
+        if not self.max_keys_per_prefix:
+            return None
+
+        parts = key.split(".", self.prefix_depth)
+        if len(parts) > self.prefix_depth:
+            return ".".join(parts[:self.prefix_depth])
+
+        return None
+
+    def limit_records(self, records):
+        """
+        Returns the given list of (key,value,flag) records with their keys
+        limited. The list itself is returned if every key was already
+        admitted, which is by far the most common case.
+        """
+        keys = self.keys
+        for record in records:
+            if record[0] not in keys:
+                break
+        else:
+            return records
+
+        limit = self.limit
+        return [record if record[0] in keys else (limit(record[0]),) + record[1:]
+                for record in records]
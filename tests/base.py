@@ -11,7 +11,7 @@ import threading
 
 from statsite.statsite import Statsite
 
-from graphite import GraphiteServer, GraphiteHandler
+from graphite import GraphiteServer, GraphiteHandler, GraphitePickleHandler
 from helpers import DumbAggregator, DumbMetricsStore
 
 class TestBase(object):
@@ -43,8 +43,11 @@ class TestBase(object):
         graphite = request.getfuncargvalue("graphite")
 
         # Instantiate server
+        # Flush one interval after starting rather than on the wall clock,
+        # so the tests know when the data is flushed
         settings = {
             "flush_interval": self.DEFAULT_INTERVAL,
+            "flush_align": False,
             "collector": {
                 "host": "localhost",
                 "port": graphite.port + 1
@@ -83,8 +86,11 @@ class TestBase(object):
         graphite = request.getfuncargvalue("graphite")
 
         # Instantiate server
+        # Flush one interval after starting rather than on the wall clock,
+        # so the tests know when the data is flushed
         settings = {
             "flush_interval": self.DEFAULT_INTERVAL,
+            "flush_align": False,
             "collector": {
                 "host": "localhost",
                 "port": graphite.port + 1,
@@ -118,6 +124,22 @@ class TestBase(object):
         """
         This creates a pytest funcarg for a fake Graphite server.
         """
+        return self._graphite_server(request, GraphiteHandler)
+
+    def pytest_funcarg__graphite_pickle(self, request):
+        """
+        This creates a pytest funcarg for a fake Graphite server which
+        speaks the pickle protocol.
+        """
+        server = self._graphite_server(request, GraphitePickleHandler)
+        server.batches = []
+        return server
+
+    def _graphite_server(self, request, handler):
+        """
+        Starts a fake Graphite server with the given request handler
+        on a random port, which is shut down after the test.
+        """
         host = "localhost"
 
         # Instantiate the actual TCP server by trying random ports
@@ -125,7 +147,7 @@ class TestBase(object):
         while True:
             try:
                 port = random.randint(2048, 32768)
-                server = GraphiteServer((host, port), GraphiteHandler)
+                server = GraphiteServer((host, port), handler)
                 break
             except socket.error, e:
                 if e[0] != errno.EADDRINUSE:
@@ -0,0 +1,44 @@
+"""
+Contains benchmarks for the performance critical paths of Statsite.
+These aren't collected by the test runner, and are instead run as
+modules, for example::
+
+    python -m tests.benchmarks.bench_udp_collector
+"""
+
+import time
+import timeit
+
+def best_of(func, repeat=3):
+    """
+    Calls the function the given number of times and returns the
+    fastest time it took, in seconds.
+    """
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def best_per_call(func, repeat=7, min_time=0.5):
+    """
+    Times the function with :mod:`timeit`, which turns off garbage
+    collection while timing, and returns the fastest time of a single
+    call in seconds. Each of the ``repeat`` runs calls the function as
+    many times as it takes to run for at least ``min_time`` seconds, so
+    that fast functions are timed over long enough to be stable.
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed <= 0 else max(2, int(min_time / elapsed * 1.2))
+
+    best = min([elapsed] + timer.repeat(repeat - 1, number))
+    return best / number
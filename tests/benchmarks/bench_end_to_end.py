@@ -0,0 +1,328 @@
+"""
+Benchmarks a whole Statsite server, from the collector through to the
+store. A server is started in its own process with a fake Graphite server
+behind it, and load generator processes send it a configurable mix of
+metrics at a target rate over UDP or TCP. The sustained ingest rate,
+packet loss, flush latency and peak memory of the server are reported,
+for example::
+
+    python -m tests.benchmarks.bench_end_to_end --rate 20000 --keys 5000 \\
+        --mix c=50,ms=30,g=10,s=5,kv=5 --protocol udp --duration 30
+
+The lines received are counted from Statsite's own ``collector.lines``
+metric as it arrives at the fake Graphite server, so that they are
+counted however the collector spreads its work across processes.
+"""
+
+import multiprocessing
+import random
+import resource
+import socket
+import SocketServer
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+from statsite.statsite import Statsite
+from tests.graphite import GraphiteServer
+
+COLLECTORS = {
+    "udp": "collector.UDPCollector",
+    "tcp": "collector.TCPCollector"
+}
+"The default collector class for each protocol."
+
+def parse_mix(mix):
+    """
+    Parses a metric type mix such as "c=60,ms=40" into a list of
+    (type, weight) tuples.
+    """
+    result = []
+    for part in mix.split(","):
+        metric_type, _, weight = part.strip().partition("=")
+        result.append((metric_type, float(weight or 1)))
+
+    return result
+
+def generate_line(rand, mix, keys, sample_rate):
+    """
+    Returns a random metric line of a type picked from the mix, for one
+    of the given number of keys.
+    """
+    total = sum([weight for _, weight in mix])
+    pick = rand.random() * total
+    for metric_type, weight in mix:
+        pick -= weight
+        if pick <= 0:
+            break
+
+    key = "bench.%s.key%d" % (metric_type, rand.randint(0, keys - 1))
+    if metric_type == "c":
+        line = "%s:1|c" % key
+    elif metric_type == "kv":
+        line = "%s:%d|kv|@%d" % (key, rand.randint(0, 1000), int(time.time()))
+    else:
+        line = "%s:%d|%s" % (key, rand.randint(0, 1000), metric_type)
+
+    if metric_type in ("c", "ms") and rand.random() < sample_rate:
+        line += "|@0.1"
+
+    return line
+
+def generate_packets(seed, count, lines, mix, keys, sample_rate):
+    """
+    Returns the given number of random packets of metric lines, which the
+    load generator cycles through rather than building a packet per send.
+    """
+    rand = random.Random(seed)
+    return ["\n".join([generate_line(rand, mix, keys, sample_rate) for _ in xrange(lines)])
+            for _ in xrange(count)]
+
+def send_load(address, protocol, packets, rate, duration, sent):
+    """
+    Sends the packets over and over at the given rate of packets per
+    second, or as fast as possible if the rate is 0, for the duration.
+    The number of packets sent is added to the shared ``sent`` value.
+    This runs in the load generator processes.
+    """
+    if protocol == "udp":
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect(address)
+        send = sock.send
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(address)
+        packets = [packet + "\n" for packet in packets]
+        send = sock.sendall
+
+    count = 0
+    start = time.time()
+    end = start + duration
+    while True:
+        now = time.time()
+        if now >= end:
+            break
+
+        # Pace the packets, sleeping off any time to spare
+        if rate:
+            ahead = start + float(count) / rate - now
+            if ahead > 0:
+                time.sleep(ahead)
+
+        try:
+            send(packets[count % len(packets)])
+        except socket.error:
+            pass
+        count += 1
+
+    sock.close()
+    with sent.get_lock():
+        sent.value += count
+
+class CountingHandler(SocketServer.StreamRequestHandler):
+    """
+    Handler for the fake Graphite server which counts the metrics it
+    receives rather than keeping them, adding up Statsite's own count of
+    the lines it received along the way.
+    """
+
+    def handle(self):
+        server = self.server
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+
+            key, value, timestamp = line.split()
+            with server.lock:
+                server.metrics += 1
+                if key == server.lines_key and float(value) > 0:
+                    server.received_lines += int(float(value))
+                    server.last_ingest = max(server.last_ingest, float(timestamp))
+
+def start_graphite():
+    """
+    Starts the fake Graphite server, returning it.
+    """
+    graphite = GraphiteServer(("127.0.0.1", 0), CountingHandler)
+    graphite.lock = threading.Lock()
+    graphite.metrics = 0
+    graphite.received_lines = 0
+    graphite.last_ingest = 0.0
+    graphite.lines_key = "bench.statsite.collector.lines"
+
+    thread = threading.Thread(target=graphite.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return graphite
+
+def run_statsite(settings, conn):
+    """
+    Runs a Statsite server until told to stop over the connection, then
+    sends back the duration of every flush and the peak memory of the
+    server and of its worker processes, if any. This runs in the process
+    of the server.
+    """
+    server = Statsite(settings)
+
+    # Time each flush, from the switch of aggregators to the metrics
+    # being written to the store
+    durations = []
+    flush = server.executor._flush
+    def timed_flush(aggregator):
+        start = time.time()
+        flush(aggregator)
+        durations.append(time.time() - start)
+    server.executor._flush = timed_flush
+
+    thread = threading.Thread(target=server.start)
+    thread.daemon = True
+    thread.start()
+    conn.send("started")
+
+    conn.recv()
+    server.shutdown()
+    server.store.close()
+    conn.send({
+        "flush_durations": durations,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        "worker_peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    })
+
+def start_server(options, graphite):
+    """
+    Starts a Statsite server flushing to the fake Graphite server in its
+    own process, returning the process, the connection to it and the
+    address of its collector.
+    """
+    # Find a free port for the collector
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+
+    settings = {
+        "flush_interval": options.interval,
+        "flush_align": False,
+        "collector": {
+            "class": options.collector or COLLECTORS[options.protocol],
+            "host": "127.0.0.1",
+            "port": port
+        },
+        "store": {
+            "host": "127.0.0.1",
+            "port": graphite.server_address[1],
+            "prefix": "bench"
+        },
+        "instrumentation": {
+            "enabled": True,
+            "namespace": "statsite"
+        }
+    }
+
+    conn, server_conn = multiprocessing.Pipe()
+    # Not a daemon, since the multi-process collector starts processes
+    process = multiprocessing.Process(target=run_statsite, args=(settings, server_conn))
+    process.start()
+    conn.recv()
+    time.sleep(0.5)
+
+    return (process, conn, ("127.0.0.1", port))
+
+def run(options):
+    """
+    Runs the benchmark, returning a dictionary of the results.
+    """
+    # Start the server before building the packets, so that its process
+    # doesn't start out with them in its memory
+    graphite = start_graphite()
+    process, conn, address = start_server(options, graphite)
+
+    mix = parse_mix(options.mix)
+    sent = multiprocessing.Value("l", 0)
+    generators = []
+    for i in xrange(options.generators):
+        packets = generate_packets(i, 1000, options.lines, mix, options.keys, options.sample_rate)
+        generator = multiprocessing.Process(target=send_load,
+                                            args=(address, options.protocol, packets,
+                                                  float(options.rate) / options.generators,
+                                                  options.duration, sent))
+        generators.append(generator)
+
+    start = time.time()
+    for generator in generators:
+        generator.start()
+    for generator in generators:
+        generator.join()
+
+    # Wait for the lines received to stop going up for a whole interval,
+    # so that the last of them have been flushed
+    while True:
+        received = graphite.received_lines
+        time.sleep(int(options.interval) + 0.5)
+        if graphite.received_lines == received:
+            break
+
+    conn.send("stop")
+    server = conn.recv()
+    process.join()
+    graphite.shutdown()
+
+    # The lines were received by the end of the last interval in which
+    # any arrived, which is only known to within an interval
+    elapsed = max(graphite.last_ingest - start, options.duration)
+    sent_lines = sent.value * options.lines
+    received_lines = graphite.received_lines
+    durations = server["flush_durations"] or [0]
+    return {
+        "sent_packets": sent.value,
+        "received_lines": received_lines,
+        "loss": 1.0 - float(received_lines) / sent_lines if sent_lines else 0.0,
+        "lines_per_sec": received_lines / elapsed,
+        "flushes": len(server["flush_durations"]),
+        "flush_mean": sum(durations) / len(durations),
+        "flush_max": max(durations),
+        "graphite_metrics": graphite.metrics,
+        "peak_rss_mb": server["peak_rss_mb"],
+        "worker_peak_rss_mb": server["worker_peak_rss_mb"]
+    }
+
+def main(args=None):
+    parser = OptionParser()
+    parser.add_option("-r", "--rate", type="int", dest="rate", default=10000,
+                      help="packets per second to send, 0 for as fast as possible")
+    parser.add_option("-d", "--duration", type="float", dest="duration", default=10,
+                      help="seconds to send for")
+    parser.add_option("-k", "--keys", type="int", dest="keys", default=1000,
+                      help="number of distinct keys of each type")
+    parser.add_option("-l", "--lines", type="int", dest="lines", default=1,
+                      help="metric lines per packet")
+    parser.add_option("-m", "--mix", dest="mix", default="c=60,ms=30,g=5,s=5",
+                      help="weights of each metric type, e.g. c=60,ms=30,g=5,s=5,kv=0")
+    parser.add_option("-s", "--sample-rate", type="float", dest="sample_rate", default=0.0,
+                      help="fraction of counters and timers sent with a sample rate")
+    parser.add_option("-p", "--protocol", dest="protocol", default="udp",
+                      choices=sorted(COLLECTORS.keys()), help="udp or tcp")
+    parser.add_option("-c", "--collector", dest="collector", default=None,
+                      help="collector class, defaulting to the plain one for the protocol")
+    parser.add_option("-g", "--generators", type="int", dest="generators", default=1,
+                      help="number of load generator processes")
+    parser.add_option("-i", "--interval", type="int", dest="interval", default=2,
+                      help="flush interval in seconds")
+    (options, _) = parser.parse_args(args)
+
+    results = run(options)
+    print "sent packets:      %d" % results["sent_packets"]
+    print "received lines:    %d" % results["received_lines"]
+    print "loss:              %.1f%%" % (results["loss"] * 100)
+    print "ingest lines/sec:  %.0f" % results["lines_per_sec"]
+    print "flushes:           %d" % results["flushes"]
+    print "flush latency:     %.3fs mean, %.3fs max" % (results["flush_mean"], results["flush_max"])
+    print "graphite metrics:  %d" % results["graphite_metrics"]
+    print "peak RSS:          %.1f MB" % results["peak_rss_mb"]
+    if results["worker_peak_rss_mb"]:
+        print "worker peak RSS:   %.1f MB" % results["worker_peak_rss_mb"]
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,46 @@
+"""
+Benchmarks how long the Graphite stores take to serialize the output
+of a flush for the plaintext protocol compared with the pickle protocol,
+along with the number of bytes each sends.
+"""
+
+import random
+import sys
+from optparse import OptionParser
+
+from statsite.metrics_store import GraphitePickleStore, GraphiteStore
+from tests.benchmarks import best_of
+
+def unconnected(cls, **kwargs):
+    """
+    Returns a store of the given class which isn't connected to a
+    server, since only the serialization is benchmarked.
+    """
+    store = cls.__new__(cls)
+    store.prefix = "statsite"
+    for key, value in kwargs.iteritems():
+        setattr(store, key, value)
+
+    return store
+
+def main(args=None):
+    option_parser = OptionParser()
+    option_parser.add_option("-n", "--metrics", type="int", dest="metrics", default=500000,
+                             help="number of metrics in the flush")
+    (options, _) = option_parser.parse_args(args)
+
+    rand = random.Random(0)
+    metrics = [("timers.app.server%02d.endpoint%05d.mean" % (i % 20, i), rand.random() * 500, 1313107325)
+               for i in xrange(options.metrics)]
+
+    stores = [("plaintext", unconnected(GraphiteStore)),
+              ("pickle", unconnected(GraphitePickleStore, batch_size=500))]
+
+    print "%-10s %10s %12s" % ("protocol", "secs", "bytes")
+    for name, store in stores:
+        elapsed = best_of(lambda: store._format(metrics))
+        size = sum([len(data) for data, _ in store._format(metrics)])
+        print "%-10s %10.3f %12d" % (name, elapsed, size)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,105 @@
+"""
+Benchmarks the bytes used per buffered sample by the different ways
+metrics can be held between the collector and the flush: a queue of
+metric objects with a ``__dict__`` (how every sample used to be kept
+until flush), a queue of the ``__slots__`` metric objects, the batches
+of records handed over by the collectors, and the aggregator's per-key
+accumulators which the records are folded into.
+"""
+
+import random
+import sys
+import time
+from optparse import OptionParser
+
+from statsite import parser
+from statsite.aggregator import DefaultAggregator
+from statsite.metrics import METRIC_TYPES
+
+class DictMetric(object):
+    """
+    A metric object with a ``__dict__``, which is how every metric was
+    represented before metrics used ``__slots__``.
+    """
+    def __init__(self, key, value, flag=None):
+        self.key = key
+        self.value = value
+        self.flag = flag if flag is not None else time.time()
+
+def deep_size(obj, seen):
+    """
+    Returns the size in bytes of the object and everything it references
+    which hasn't been seen yet.
+    """
+    if id(obj) in seen:
+        return 0
+
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum([deep_size(k, seen) + deep_size(v, seen) for k,v in obj.iteritems()])
+    elif isinstance(obj, (list, tuple)):
+        size += sum([deep_size(o, seen) for o in obj])
+    elif hasattr(obj, "__dict__"):
+        size += deep_size(obj.__dict__, seen)
+    elif hasattr(obj, "__slots__"):
+        size += sum([deep_size(getattr(obj, name), seen) for name in ("key", "value", "flag")])
+
+    return size
+
+def datasets(count, keys):
+    """
+    Returns a list of (name, message) tuples of synthetic messages.
+    """
+    rand = random.Random(0)
+    names = ["app.server%02d.requests.endpoint%03d" % (i % 20, i) for i in xrange(keys)]
+    return [
+        ("counters", "\n".join(["%s:%d|c" % (rand.choice(names), rand.randint(1, 10))
+                                for _ in xrange(count)])),
+        ("timers", "\n".join(["%s:%.3f|ms" % (rand.choice(names), rand.random() * 500)
+                              for _ in xrange(count)])),
+        ("kv", "\n".join(["%s:%d|kv" % (rand.choice(names), rand.randint(0, 10000))
+                          for _ in xrange(count)])),
+    ]
+
+def measure(message):
+    """
+    Returns the bytes per sample of each representation of the metrics
+    in the given message.
+    """
+    # Each representation is built from its own parse, so that nothing
+    # is shared between them, just like in the real collector path
+    def records():
+        batch, _ = parser.parse_message(message)
+        return batch.items()[0]
+
+    metric_type, recs = records()
+    cls = METRIC_TYPES[metric_type]
+    count = float(len(recs))
+
+    dict_objects = [DictMetric(k, v, f) for k,v,f in records()[1]]
+    slot_objects = [cls(k, v, f) for k,v,f in records()[1]]
+    batch_records = records()[1]
+
+    aggregator = DefaultAggregator(None)
+    aggregator.add_batch({cls: records()[1]})
+
+    return [deep_size(rep, set()) / count for rep in
+            (dict_objects, slot_objects, batch_records, aggregator.accumulators)]
+
+def main(args=None):
+    option_parser = OptionParser()
+    option_parser.add_option("-n", "--samples", type="int", dest="samples", default=100000,
+                             help="number of samples per dataset")
+    option_parser.add_option("-k", "--keys", type="int", dest="keys", default=500,
+                             help="number of distinct keys")
+    (options, _) = option_parser.parse_args(args)
+
+    print "bytes per buffered sample"
+    print "%-10s %14s %14s %14s %14s" % ("dataset", "dict objects", "slot objects",
+                                         "batch records", "accumulators")
+    for name, message in datasets(options.samples, options.keys):
+        print "%-10s %14.1f %14.1f %14.1f %14.1f" % ((name,) + tuple(measure(message)))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,62 @@
+"""
+Benchmarks the lines per second that :func:`statsite.parser.parse_line`
+can parse for the common line shapes, compared with parsing every line
+using the regular expression without the cache of recent lines.
+"""
+
+import random
+import sys
+from optparse import OptionParser
+
+from statsite import parser
+from tests.benchmarks import best_of
+
+def parse_line_regex(line):
+    """
+    Parses a line using only the regular expression, which is how all
+    lines were parsed before the cache.
+    """
+    match = parser.LINE_REGEX.match(line)
+    if match is None:
+        raise ValueError, "Invalid line: '%s'" % line
+
+    key, value, metric_type, flag = match.groups()
+    value = float(value) if "." in value else int(value)
+    if flag is not None:
+        flag = float(flag) if "." in flag else int(flag)
+
+    return (key, value, metric_type, flag)
+
+def datasets(count):
+    """
+    Returns a list of (name, lines) tuples of synthetic lines.
+    """
+    rand = random.Random(0)
+    keys = ["app.server%02d.requests.endpoint%03d" % (i % 20, i) for i in xrange(500)]
+    return [
+        ("counters", ["%s:%d|c" % (rand.choice(keys), rand.randint(1, 10))
+                      for _ in xrange(count)]),
+        ("timers @rate", ["%s:%.3f|ms|@0.1" % (rand.choice(keys), rand.random() * 500)
+                          for _ in xrange(count)]),
+        ("kv", ["%s:%d|kv|@1313107325" % (rand.choice(keys), rand.randint(0, 10000))
+                for _ in xrange(count)]),
+    ]
+
+def main(args=None):
+    option_parser = OptionParser()
+    option_parser.add_option("-n", "--lines", type="int", dest="lines", default=100000,
+                             help="number of lines per dataset")
+    (options, _) = option_parser.parse_args(args)
+
+    print "%-14s %14s %14s" % ("dataset", "regex lines/s", "cached lines/s")
+    for name, lines in datasets(options.lines):
+        rates = []
+        for func in (parse_line_regex, parser.parse_line):
+            parser._cache.clear()
+            elapsed = best_of(lambda: [func(line) for line in lines])
+            rates.append(len(lines) / elapsed)
+
+        print "%-14s %14.0f %14.0f" % (name, rates[0], rates[1])
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
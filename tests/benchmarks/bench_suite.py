@@ -0,0 +1,270 @@
+"""
+Runs a microbenchmark for each function on the hot path, on synthetic
+data shaped like real traffic, and compares the results with a baseline
+recorded earlier on the same machine. The suite fails if any function
+got slower than the baseline by more than the threshold, so that changes
+to the hot path are measured rather than guessed at.
+
+Each benchmark is timed with :mod:`timeit`, with garbage collection off,
+calling it over and over for at least half a second per run and keeping
+the fastest of the runs, so that the times are stable enough to compare.
+
+A benchmark which looks slower than the threshold allows is run again,
+up to ``--confirm`` times, and only counts as regressed if it stays slow.
+
+Record a baseline before making changes, then run the suite again
+afterwards::
+
+    python -m tests.benchmarks.bench_suite --save
+    python -m tests.benchmarks.bench_suite
+
+The baseline is a JSON object of the threshold, as a fraction of the
+baseline time, and the best time of a single call of each benchmark in
+seconds::
+
+    {"threshold": 0.25, "benchmarks": {"parser.parse_line": 0.0415, ...}}
+"""
+
+import json
+import os
+import random
+import sys
+from optparse import OptionParser
+
+from statsite import parser
+from statsite.aggregator import Aggregator, DefaultAggregator
+from statsite.collector import Collector
+from statsite.metrics import Counter, Gauge, KeyValue, Timer
+from statsite.metrics_store import GraphitePickleStore, GraphiteStore
+from tests.benchmarks import best_per_call
+from tests.benchmarks.bench_graphite_store import unconnected
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+"The default path of the baseline, next to the benchmarks."
+
+DEFAULT_THRESHOLD = 0.25
+"How much slower than the baseline a benchmark may get, if the baseline doesn't say."
+
+def keys(rand, count):
+    """
+    Returns the given number of keys, shaped like those of a fleet of
+    servers each reporting on their endpoints.
+    """
+    return ["app.server%02d.endpoint%04d" % (rand.randint(0, 19), i) for i in xrange(count)]
+
+def lines(rand, count, distinct):
+    """
+    Returns the given number of metric lines in a realistic mix of types,
+    drawn from a smaller number of distinct lines since clients tend to
+    send the same lines over and over.
+    """
+    names = keys(rand, distinct / 4 or 1)
+    shapes = ["%s:1|c", "%s:1|c|@0.1", "%s:%d|ms", "%s:%d|g", "%s:%d|kv|@1313107325"]
+    pool = []
+    for _ in xrange(distinct):
+        shape = rand.choice(shapes)
+        if "%d" in shape:
+            pool.append(shape % (rand.choice(names), rand.randint(0, 1000)))
+        else:
+            pool.append(shape % rand.choice(names))
+
+    return [rand.choice(pool) for _ in xrange(count)]
+
+def messages(rand):
+    """
+    Returns packets of metric lines, as the collectors receive them.
+    """
+    data = lines(rand, 20000, 5000)
+    return ["\n".join(data[i:i + 20]) for i in xrange(0, len(data), 20)]
+
+def bench_parse_line(rand):
+    data = lines(rand, 20000, 5000)
+    def run():
+        parser._cache.clear()
+        for line in data:
+            parser.parse_line(line)
+    return run
+
+def bench_parse_metrics(rand):
+    data = messages(rand)
+    collector = Collector(None)
+    def run():
+        parser._cache.clear()
+        for message in data:
+            collector._parse_metrics(message)
+    return run
+
+def bench_parse_message(rand):
+    data = messages(rand)
+    def run():
+        parser._cache.clear()
+        for message in data:
+            parser.parse_message(message)
+    return run
+
+def bench_parse_batch(rand):
+    data = messages(rand)
+    collector = Collector(None)
+    def run():
+        parser._cache.clear()
+        for message in data:
+            collector._parse_batch(message)
+    return run
+
+def bench_add_batch(rand):
+    collector = Collector(None)
+    batches = [collector._parse_batch(message) for message in messages(rand)]
+    def run():
+        aggregator = DefaultAggregator(None)
+        for batch in batches:
+            aggregator.add_batch(batch)
+    return run
+
+def bench_counter_fold(rand):
+    names = keys(rand, 2000)
+    metrics = [Counter(rand.choice(names), rand.randint(1, 10), rand.choice([None, 0.1]))
+               for _ in xrange(20000)]
+    return lambda: Counter.fold(metrics, 1313107325)
+
+def bench_timer_fold(rand):
+    names = keys(rand, 500)
+    metrics = [Timer(rand.choice(names), rand.random() * 500) for _ in xrange(20000)]
+    return lambda: Timer.fold(metrics, 1313107325)
+
+def bench_key_value_fold(rand):
+    names = keys(rand, 2000)
+    metrics = [KeyValue(rand.choice(names), rand.randint(0, 1000), rand.choice([None, 1313107325]))
+               for _ in xrange(20000)]
+    return lambda: KeyValue.fold(metrics, 1313107325)
+
+def bench_aggregator_fold_metrics(rand):
+    names = keys(rand, 2000)
+    types = [Counter, Counter, Timer, Gauge, KeyValue]
+    metrics = [rand.choice(types)(rand.choice(names), rand.randint(0, 1000)) for _ in xrange(30000)]
+    aggregator = Aggregator(None)
+    return lambda: aggregator._fold_metrics(metrics)
+
+def bench_graphite_format(rand):
+    metrics = [("timers.%s.mean" % key, rand.random() * 500, 1313107325) for key in keys(rand, 50000)]
+    store = unconnected(GraphiteStore)
+    return lambda: store._format(metrics)
+
+def bench_graphite_pickle_format(rand):
+    metrics = [("timers.%s.mean" % key, rand.random() * 500, 1313107325) for key in keys(rand, 50000)]
+    store = unconnected(GraphitePickleStore, batch_size=500)
+    return lambda: store._format(metrics)
+
+BENCHMARKS = [
+    ("parser.parse_line", bench_parse_line),
+    ("Collector._parse_metrics", bench_parse_metrics),
+    ("parser.parse_message", bench_parse_message),
+    ("Collector._parse_batch", bench_parse_batch),
+    ("DefaultAggregator.add_batch", bench_add_batch),
+    ("Counter.fold", bench_counter_fold),
+    ("Timer.fold", bench_timer_fold),
+    ("KeyValue.fold", bench_key_value_fold),
+    ("Aggregator._fold_metrics", bench_aggregator_fold_metrics),
+    ("GraphiteStore._format", bench_graphite_format),
+    ("GraphitePickleStore._format", bench_graphite_pickle_format)
+]
+"""
+The benchmarks, as a list of (name, setup) tuples. Each setup function is
+given a seeded random generator to build its data with, and returns the
+function to time.
+"""
+
+def run(names=None, repeat=7):
+    """
+    Runs the benchmarks with the given names, or all of them, returning
+    a dictionary of the best time of a call of each in seconds.
+    """
+    results = {}
+    for name, setup in BENCHMARKS:
+        if names and name not in names:
+            continue
+
+        results[name] = best_per_call(setup(random.Random(0)), repeat)
+
+    return results
+
+def compare(results, baseline, threshold):
+    """
+    Compares the results with the baseline, returning a list of
+    (name, seconds, baseline seconds, regressed) tuples. Benchmarks
+    without a baseline never count as regressed.
+    """
+    comparison = []
+    for name, _ in BENCHMARKS:
+        if name not in results:
+            continue
+
+        base = baseline.get(name)
+        regressed = base is not None and results[name] > base * (1 + threshold)
+        comparison.append((name, results[name], base, regressed))
+
+    return comparison
+
+def main(args=None):
+    option_parser = OptionParser()
+    option_parser.add_option("-b", "--baseline", dest="baseline", default=DEFAULT_BASELINE,
+                             help="path of the JSON baseline")
+    option_parser.add_option("-s", "--save", action="store_true", dest="save", default=False,
+                             help="save the results as the new baseline")
+    option_parser.add_option("-t", "--threshold", type="float", dest="threshold", default=None,
+                             help="fraction slower than the baseline which counts as a regression")
+    option_parser.add_option("-r", "--repeat", type="int", dest="repeat", default=7,
+                             help="number of times to run each benchmark, keeping the best")
+    option_parser.add_option("-c", "--confirm", type="int", dest="confirm", default=2,
+                             help="number of times to run a regressed benchmark again to confirm it")
+    option_parser.add_option("-o", "--only", action="append", dest="only", default=[],
+                             help="only run the named benchmark, may be given more than once")
+    (options, _) = option_parser.parse_args(args)
+
+    baseline = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+
+    threshold = options.threshold
+    if threshold is None:
+        threshold = baseline.get("threshold", DEFAULT_THRESHOLD)
+
+    results = run(options.only, options.repeat)
+    comparison = compare(results, baseline.get("benchmarks", {}), threshold)
+
+    # Timings on a busy machine are noisy, so a regression only counts
+    # if the benchmark is still as slow when run again
+    for _ in xrange(options.confirm):
+        regressed = [name for name, _, _, regressed in comparison if regressed]
+        if not regressed:
+            break
+
+        for name, seconds in run(regressed, options.repeat).iteritems():
+            results[name] = min(results[name], seconds)
+        comparison = compare(results, baseline.get("benchmarks", {}), threshold)
+
+    print "%-30s %10s %10s %8s" % ("benchmark", "secs", "baseline", "change")
+    for name, seconds, base, regressed in comparison:
+        if base is None:
+            print "%-30s %10.6f %10s %8s" % (name, seconds, "-", "-")
+        else:
+            print "%-30s %10.6f %10.6f %+7.1f%%%s" % (name, seconds, base, (seconds / base - 1) * 100,
+                                                      "  REGRESSED" if regressed else "")
+
+    if options.save:
+        benchmarks = dict(baseline.get("benchmarks", {}))
+        benchmarks.update(results)
+        with open(options.baseline, "w") as f:
+            json.dump({"threshold": threshold, "benchmarks": benchmarks}, f, indent=2, sort_keys=True)
+        print "Saved the baseline to: %s" % options.baseline
+        return 0
+
+    regressions = [name for name, _, _, regressed in comparison if regressed]
+    if regressions:
+        print "%d benchmark(s) regressed by more than %.0f%%" % (len(regressions), threshold * 100)
+        return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
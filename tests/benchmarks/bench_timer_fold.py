@@ -0,0 +1,55 @@
+"""
+Benchmarks how long folding the timers of a flush interval takes with
+the pure Python fold compared with the vectorized NumPy fold, for a
+varying number of keys.
+"""
+
+import random
+import sys
+from optparse import OptionParser
+
+from statsite import metrics
+from statsite.metrics import Timer
+from tests.benchmarks import best_of
+
+def accumulator(keys, values, rand):
+    """
+    Returns a timer accumulator with the given number of keys, each
+    with the given number of values on average.
+    """
+    accum = {}
+    for i in xrange(keys):
+        count = rand.randint(1, values * 2 - 1)
+        accum["app.server%02d.endpoint%05d" % (i % 20, i)] = \
+            [rand.random() * 500 for _ in xrange(count)]
+
+    return accum
+
+def fold(accum, **settings):
+    """
+    Folds a copy of the accumulator, since folding sorts the lists of
+    values in place.
+    """
+    accum = dict([(key, list(vals)) for key, vals in accum.iteritems()])
+    return Timer.fold_accumulator(accum, 0, **settings)
+
+def main(args=None):
+    option_parser = OptionParser()
+    option_parser.add_option("-v", "--values", type="int", dest="values", default=20,
+                             help="average number of values per key")
+    (options, _) = option_parser.parse_args(args)
+
+    if metrics.numpy is None:
+        print "NumPy isn't installed, only the pure Python fold can be run."
+
+    rand = random.Random(0)
+    print "%-8s %12s %14s" % ("keys", "python secs", "vectorized secs")
+    for keys in (1000, 10000, 50000):
+        accum = accumulator(keys, options.values, rand)
+        python = best_of(lambda: fold(accum))
+        vectorized = best_of(lambda: fold(accum, vectorize=True)) if metrics.numpy else None
+        print "%-8d %12.3f %14s" % (keys, python,
+                                    "%.3f" % vectorized if vectorized else "-")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
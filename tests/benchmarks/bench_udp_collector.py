@@ -0,0 +1,91 @@
+"""
+Benchmarks the packets per second that the UDP collectors can take in.
+A separate process blasts packets at each collector as fast as it can,
+and the number of packets the collector actually processed is measured.
+"""
+
+import multiprocessing
+import socket
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+from statsite.aggregator import Aggregator
+from statsite.collector import BatchUDPCollector, UDPCollector
+
+class CountingAggregator(Aggregator):
+    """
+    Aggregator which only counts the metrics added to it.
+    """
+    def __init__(self):
+        super(CountingAggregator, self).__init__(None)
+        self.count = 0
+        self.last_add = None
+
+    def add_metrics(self, metrics):
+        self.count += len(metrics)
+        self.last_add = time.time()
+
+def send_packets(address, packets, lines_per_packet):
+    """
+    Sends the given number of packets to the address as fast as possible.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(address)
+    packet = "\n".join(["bench.counter%d:1|c" % i for i in xrange(lines_per_packet)])
+    for _ in xrange(packets):
+        try:
+            sock.send(packet)
+        except socket.error:
+            pass
+
+def run(collector_cls, packets, lines_per_packet):
+    """
+    Runs the benchmark against a single collector class and returns
+    a tuple of (packets received, seconds elapsed).
+    """
+    aggregator = CountingAggregator()
+    collector = collector_cls(host="127.0.0.1", port=0, aggregator=aggregator)
+    if hasattr(collector, "server"):
+        address = collector.server.socket.getsockname()
+    else:
+        address = collector.socket.getsockname()
+
+    thread = threading.Thread(target=collector.start)
+    thread.daemon = True
+    thread.start()
+
+    sender = multiprocessing.Process(target=send_packets, args=(address, packets, lines_per_packet))
+    start = time.time()
+    sender.start()
+    sender.join()
+
+    # Wait for the collector to go idle before measuring
+    while True:
+        last_count = aggregator.count
+        time.sleep(0.5)
+        if aggregator.count == last_count:
+            break
+
+    collector.shutdown()
+    elapsed = (aggregator.last_add or time.time()) - start
+    return (aggregator.count / lines_per_packet, elapsed)
+
+def main(args=None):
+    parser = OptionParser()
+    parser.add_option("-n", "--packets", type="int", dest="packets", default=200000,
+                      help="number of packets to send")
+    parser.add_option("-l", "--lines", type="int", dest="lines", default=1,
+                      help="metric lines per packet")
+    (options, _) = parser.parse_args(args)
+
+    print "%-20s %12s %10s %12s" % ("collector", "received", "loss", "packets/sec")
+    for collector_cls in (UDPCollector, BatchUDPCollector):
+        received, elapsed = run(collector_cls, options.packets, options.lines)
+        loss = 1.0 - float(received) / options.packets
+        print "%-20s %12d %9.1f%% %12.0f" % (collector_cls.__name__, received,
+                                             loss * 100, received / elapsed)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,6 +2,7 @@
 Contains tests to test the aliveness check of Statsite.
 """
 
+import json
 import socket
 import time
 from tests.base import TestBase
@@ -24,6 +25,47 @@ class TestBasic(TestBase):
 
         assert "YES" == data
 
+    @statsite_settings({
+        "aliveness_check": {
+            "enabled": True
+        }
+    })
+    def test_connect_only_aliveness(self, servers):
+        """
+        Tests that a check which only connects is answered.
+        """
+        socket = self._socket()
+        data = socket.recv(1024)
+        socket.close()
+
+        assert "YES" == data
+
+    @statsite_settings({
+        "aliveness_check": {
+            "enabled": True
+        }
+    })
+    def test_http_stats(self, servers):
+        """
+        Tests that the aliveness check serves the stats over HTTP.
+        """
+        client, server, _ = servers
+        client.send("foo:1|c")
+        time.sleep(0.2)
+
+        socket = self._socket()
+        socket.sendall("GET /stats HTTP/1.0\r\n\r\n")
+        data = self._recv_all(socket)
+        socket.close()
+
+        headers, body = data.split("\r\n\r\n", 1)
+        assert headers.startswith("HTTP/1.0 200 OK")
+
+        stats = json.loads(body)
+        assert stats["healthy"]
+        assert 1 == stats["collector.lines"]
+        assert 1 == stats["aggregator.keys"]
+
     def _socket(self, host="localhost", port=8325):
         """
         Returns a TCP socket to talk to the aliveness check.
@@ -35,7 +77,26 @@ class TestBasic(TestBase):
         # take too long
         sock.settimeout(1.0)
 
-        # Connect to server and send data
-        sock.connect((host, port))
+        # Connect to server, retrying while the server starts up in
+        # its own thread
+        for _ in xrange(20):
+            try:
+                sock.connect((host, port))
+                break
+            except socket.error:
+                time.sleep(0.05)
+        else:
+            sock.connect((host, port))
 
         return sock
+
+    def _recv_all(self, sock):
+        """
+        Reads from the socket until the server closes it.
+        """
+        chunks = []
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                return "".join(chunks)
+            chunks.append(chunk)
@@ -3,7 +3,9 @@ Contains a fake Graphite stub which can be used to test what
 Statsite is sending to Graphite.
 """
 
+import cPickle
 import SocketServer
+import struct
 import time
 
 class GraphiteServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
@@ -13,6 +15,7 @@ class GraphiteServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     """
 
     allow_reuse_address = True
+    daemon_threads = True
 
     def __init__(self, address, *args, **kwargs):
         SocketServer.TCPServer.__init__(self, address, *args, **kwargs)
@@ -40,3 +43,27 @@ class GraphiteHandler(SocketServer.StreamRequestHandler):
 
             self.server.messages.append(line.rstrip("\n"))
             self.server.last_receive = time.time()
+
+class GraphitePickleHandler(SocketServer.StreamRequestHandler):
+    """
+    TCP handler for the fake graphite server which speaks the pickle
+    protocol. The pickled metrics are stored in the same format as
+    the plaintext handler stores them, and each batch received is also
+    stored in the `batches` list of the server, if it has one.
+    """
+
+    def handle(self):
+        while True:
+            header = self.rfile.read(4)
+            if len(header) < 4:
+                break
+
+            (length,) = struct.unpack("!L", header)
+            batch = cPickle.loads(self.rfile.read(length))
+            if hasattr(self.server, "batches"):
+                self.server.batches.append(batch)
+
+            for path, (timestamp, value) in batch:
+                self.server.messages.append("%s %s %s" % (path, value, timestamp))
+
+            self.server.last_receive = time.time()
@@ -12,10 +12,14 @@ class DumbAggregator(Aggregator):
 
         self.flushed = False
         self.metrics = []
+        self.merged = []
 
     def add_metrics(self, metrics):
         self.metrics.extend(metrics)
 
+    def merge(self, partial):
+        self.merged.append(partial)
+
     def flush(self):
         self.flushed = True
 
@@ -25,7 +29,10 @@ class DumbCollector(Collector):
     def __init__(self, host=None, port=None, aggregator=None):
         super(DumbCollector, self).__init__(aggregator)
 
-    pass
+        self.partials = []
+
+    def collect_partials(self):
+        return self.partials
 
 class DumbMetricsStore(MetricsStore):
     # Note that the host/port arguments are to avoid exceptions when
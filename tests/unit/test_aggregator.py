@@ -3,10 +3,27 @@ Contains tests for the statistics aggregator base class as well
 as the default aggregator class.
 """
 
+import threading
 import time
 from tests.base import TestBase
 from statsite.aggregator import Aggregator, DefaultAggregator
-from statsite.metrics import Counter, KeyValue, Timer
+from statsite.metrics import Counter, Gauge, KeyValue, Timer
+from statsite.sketch import KLLSketch
+from statsite.util import OutputNames
+from tests.helpers import DumbMetricsStore
+
+class NamedMetricsStore(DumbMetricsStore):
+    """
+    A metrics store which caches the output names of the keys.
+    """
+    def __init__(self):
+        super(NamedMetricsStore, self).__init__()
+        self.names = OutputNames("foo")
+        self.prefixed = []
+
+    def flush(self, data, prefixed=False):
+        super(NamedMetricsStore, self).flush(data)
+        self.prefixed.append(prefixed)
 
 class TestAggregator(TestBase):
     def test_fold_metrics_works(self, monkeypatch):
@@ -48,3 +65,311 @@ class TestDefaultAggregator(TestBase):
         agg.flush()
 
         assert [("kv.k", 1, now), ("kv.k", 2, now)] == metrics_store.data
+
+    def test_folds_metrics_on_arrival(self, metrics_store, monkeypatch):
+        """
+        Tests that the default aggregator folds metrics into a running
+        state per key as they are added, rather than queueing them.
+        """
+        now = 17
+        monkeypatch.setattr(time, 'time', lambda: now)
+        agg = DefaultAggregator(metrics_store)
+        agg.add_metrics([Counter("j", 2), Counter("j", 3)])
+        agg.add_metrics([Counter("j", 5), Timer("k", 10)])
+
+        assert {"j": 10} == agg.accumulators[Counter]
+        assert {"k": [10]} == agg.accumulators[Timer]
+
+        agg.flush()
+        assert 1 == metrics_store.data.count(("counts.j", 10, now))
+
+    def test_flushes_with_timestamp(self, metrics_store):
+        """
+        Tests that the metrics are stamped with the timestamp of the
+        aggregator, if it was given one.
+        """
+        agg = DefaultAggregator(metrics_store)
+        agg.timestamp = 120
+        agg.add_batch({Counter: [("j", 1, None)]})
+        agg.flush()
+
+        assert [("counts.j", 1, 120)] == metrics_store.data
+
+    def test_flushes_internal_metrics(self, metrics_store):
+        """
+        Tests that the internal metrics given by Statsite are flushed
+        under their namespace, along with the aggregator's own.
+        """
+        agg = DefaultAggregator(metrics_store)
+        agg.timestamp = 120
+        agg.internal_namespace = "self"
+        agg.internal_metrics = {"collector.lines": 3}
+        agg.add_batch({Counter: [("j", 1, None), ("k", 1, None)]})
+        agg.flush()
+
+        data = dict([(key, (value, ts)) for key,value,ts in metrics_store.data])
+        assert (1, 120) == data["counts.j"]
+        assert (3, 120) == data["self.collector.lines"]
+        assert (2, 120) == data["self.aggregator.keys"]
+        assert 0 <= data["self.aggregator.fold_seconds"][0] < 1
+
+    def test_drain_and_merge(self, metrics_store, monkeypatch):
+        """
+        Tests that partial aggregates drained from one aggregator can be
+        merged into another.
+        """
+        now = 17
+        monkeypatch.setattr(time, 'time', lambda: now)
+        worker = DefaultAggregator(None)
+        worker.add_metrics([Counter("j", 2), Timer("k", 10), KeyValue("kv", 1, now)])
+        partial = worker.drain()
+        assert {} == worker.accumulators
+
+        agg = DefaultAggregator(metrics_store)
+        agg.add_metrics([Counter("j", 3), Timer("k", 20)])
+        agg.merge(partial)
+        agg.flush()
+
+        assert 1 == metrics_store.data.count(("counts.j", 5, now))
+        assert 1 == metrics_store.data.count(("timers.k.count", 2, now))
+        assert 1 == metrics_store.data.count(("kv.kv", 1, now))
+
+    def test_add_batch(self, metrics_store, monkeypatch):
+        """
+        Tests that batches of records are folded in the same as the
+        equivalent metric objects.
+        """
+        now = 17
+        monkeypatch.setattr(time, 'time', lambda: now)
+        agg = DefaultAggregator(metrics_store)
+        agg.add_batch({Counter: [("j", 2, None), ("j", 1, 0.5)],
+                       Timer: [("k", 10, None)],
+                       KeyValue: [("kv", 1, None), ("kv", 2, 5)]})
+
+        assert {"j": 2.5} == agg.accumulators[Counter]
+        assert {"k": [10]} == agg.accumulators[Timer]
+        assert [("kv", 1, now), ("kv", 2, 5)] == agg.accumulators[KeyValue]
+
+    def test_flush_while_adding(self, metrics_store):
+        """
+        Tests that metrics added by a collector thread which still holds
+        on to the aggregator don't break a flush in progress.
+        """
+        agg = DefaultAggregator(metrics_store)
+        agg.add_batch({Counter: [("k%d" % i, 1, None) for i in xrange(20000)]})
+
+        stopped = threading.Event()
+        def add():
+            i = 0
+            while not stopped.is_set():
+                agg.add_batch({Counter: [("new%d" % i, 1, None)]})
+                i += 1
+
+        thread = threading.Thread(target=add)
+        thread.start()
+        try:
+            agg.flush()
+        finally:
+            stopped.set()
+            thread.join()
+
+        assert 20000 <= len(metrics_store.data)
+
+    def test_size(self, metrics_store):
+        """
+        Tests that the size is the number of keys aggregated and the
+        number of samples buffered for them.
+        """
+        agg = DefaultAggregator(metrics_store)
+        assert (0, 0) == agg.size()
+
+        agg.add_batch({Counter: [("j", 2, None), ("j", 1, None)],
+                       Timer: [("k", 10, None), ("k", 20, None)],
+                       KeyValue: [("kv", 1, None), ("kv", 2, 5)]})
+
+        assert (3, 5) == agg.size()
+
+    def test_max_keys(self, metrics_store, monkeypatch):
+        """
+        Tests that metrics for new keys past the limit are folded into
+        the overflow key, and counted in the internal metrics.
+        """
+        now = 17
+        monkeypatch.setattr(time, 'time', lambda: now)
+        agg = DefaultAggregator(metrics_store, max_keys=2)
+        agg.add_batch({Counter: [("a", 1, None), ("b", 1, None), ("c", 2, None)]})
+        agg.add_metrics([Counter("d", 3), Counter("a", 1)])
+        agg.internal_metrics = {}
+        agg.flush()
+
+        assert 1 == metrics_store.data.count(("counts.a", 2, now))
+        assert 1 == metrics_store.data.count(("counts.overflow", 5, now))
+        assert 0 == len([key for key,_,_ in metrics_store.data if key == "counts.c"])
+        assert 1 == metrics_store.data.count(("statsite.aggregator.overflowed", 2, now))
+
+    def test_max_keys_per_prefix_on_merge(self, metrics_store, monkeypatch):
+        """
+        Tests that the limits also apply to merged partial aggregates.
+        """
+        now = 17
+        monkeypatch.setattr(time, 'time', lambda: now)
+        worker = DefaultAggregator(None)
+        worker.add_metrics([Counter("api.a", 1), Counter("api.b", 2), Counter("api.c", 3),
+                            KeyValue("api.d", 1, now)])
+
+        agg = DefaultAggregator(metrics_store, max_keys_per_prefix="1")
+        agg.add_metrics([Counter("api.a", 1)])
+        agg.merge(worker.drain())
+        agg.flush()
+
+        assert 1 == metrics_store.data.count(("counts.api.a", 2, now))
+        assert 1 == metrics_store.data.count(("counts.api.overflow", 5, now))
+        assert 1 == metrics_store.data.count(("kv.api.overflow", 1, now))
+
+    def test_timer_sketch_settings(self, metrics_store, monkeypatch):
+        """
+        Tests that timers are accumulated in sketches when configured,
+        and that the sketches are merged from partials.
+        """
+        now = 17
+        monkeypatch.setattr(time, 'time', lambda: now)
+        settings = {"ms": {"sketch": "true"}}
+        worker = DefaultAggregator(None, metrics_settings=settings)
+        worker.add_batch({Timer: [("k", 10, None)]})
+
+        agg = DefaultAggregator(metrics_store, metrics_settings=settings)
+        agg.add_batch({Timer: [("k", 20, None)]})
+        agg.merge(worker.drain())
+
+        assert isinstance(agg.accumulators[Timer]["k"], KLLSketch)
+
+        agg.flush()
+        assert 1 == metrics_store.data.count(("timers.k.count", 2, now))
+        assert 1 == metrics_store.data.count(("timers.k.sum", 30, now))
+
+    def test_gauges_carried_across_aggregators(self, metrics_store, monkeypatch):
+        """
+        Tests that gauges are carried from one aggregator to the next
+        through the shared metrics state.
+        """
+        now = 17
+        monkeypatch.setattr(time, 'time', lambda: now)
+        state = {}
+
+        agg = DefaultAggregator(metrics_store, metrics_state=state)
+        agg.add_batch({Gauge: [("g", 10, None)]})
+        agg.flush()
+
+        agg = DefaultAggregator(metrics_store, metrics_state=state)
+        agg.add_batch({Counter: [("j", 1, None)]})
+        agg.flush()
+
+        agg = DefaultAggregator(metrics_store, metrics_state=state)
+        agg.add_batch({Gauge: [("g", -3, True)]})
+        agg.flush()
+
+        assert [("gauges.g", 10, now), ("gauges.g", 10, now), ("gauges.g", 7, now)] == \
+            [item for item in metrics_store.data if item[0] == "gauges.g"]
+
+    def test_overlapping_flushes_share_gauge_state(self, metrics_store, monkeypatch):
+        """
+        Tests that aggregators flushing at the same time fold their gauges
+        into the shared state one at a time.
+        """
+        state = {}
+        lock = threading.Lock()
+        active = []
+        overlapped = []
+        fold_accumulator = Gauge.fold_accumulator
+
+        def slow_fold(accum, now, **kwargs):
+            active.append(True)
+            overlapped.append(len(active) > 1)
+            time.sleep(0.05)
+            try:
+                return fold_accumulator(accum, now, **kwargs)
+            finally:
+                active.pop()
+
+        monkeypatch.setattr(Gauge, 'fold_accumulator', staticmethod(slow_fold))
+
+        aggs = []
+        for start in (0, 1000):
+            agg = DefaultAggregator(metrics_store, metrics_state=state, metrics_lock=lock)
+            agg.add_batch({Gauge: [("g%d" % i, i, None) for i in xrange(start, start + 1000)]})
+            aggs.append(agg)
+
+        threads = [threading.Thread(target=agg.flush) for agg in aggs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert [False, False] == overlapped
+        assert 2000 == len(state[Gauge])
+
+    def test_max_keys_bounds_gauge_state(self, metrics_store, monkeypatch):
+        """
+        Tests that the limits also apply to the gauges carried across
+        aggregators, so new gauges are folded into the overflow key once
+        the state is full rather than growing it every interval.
+        """
+        now = 17
+        monkeypatch.setattr(time, 'time', lambda: now)
+        state = {}
+
+        agg = DefaultAggregator(metrics_store, metrics_state=state, max_keys=2)
+        agg.add_batch({Gauge: [("a", 1, None), ("b", 2, None)]})
+        agg.flush()
+
+        agg = DefaultAggregator(metrics_store, metrics_state=state, max_keys=2)
+        agg.add_batch({Gauge: [("c", 3, None), ("a", 4, None)]})
+        agg.internal_metrics = {}
+        agg.flush()
+
+        assert ["a", "b", "overflow"] == sorted(state[Gauge].keys())
+        assert 1 == metrics_store.data.count(("gauges.a", 4, now))
+        assert 1 == metrics_store.data.count(("gauges.overflow", 3, now))
+        assert 1 == metrics_store.data.count(("statsite.aggregator.overflowed", 1, now))
+
+    def test_max_keys_counts_gauge_overflow_once(self, metrics_store, monkeypatch):
+        """
+        Tests that gauges which overflowed as they were added aren't
+        counted again when the gauge state is limited.
+        """
+        now = 17
+        monkeypatch.setattr(time, 'time', lambda: now)
+        state = {}
+
+        agg = DefaultAggregator(metrics_store, metrics_state=state, max_keys=1)
+        agg.add_batch({Gauge: [("a", 1, None)]})
+        agg.flush()
+
+        agg = DefaultAggregator(metrics_store, metrics_state=state, max_keys=1)
+        agg.add_batch({Gauge: [("b", 2, None), ("c", 3, None)]})
+        assert 1 == agg.limiter.overflowed
+
+        agg.internal_metrics = {}
+        agg.flush()
+
+        assert ["a", "overflow"] == sorted(state[Gauge].keys())
+        assert 1 == metrics_store.data.count(("statsite.aggregator.overflowed", 2, now))
+
+    def test_names_from_store(self, monkeypatch):
+        """
+        Tests that metrics are named by the output names of the store,
+        which are cached from one aggregator to the next.
+        """
+        now = 17
+        monkeypatch.setattr(time, 'time', lambda: now)
+        store = NamedMetricsStore()
+        for _ in xrange(2):
+            agg = DefaultAggregator(store)
+            agg.add_batch({Counter: [("j", 1, None)], Timer: [("k", 10, None)]})
+            agg.flush()
+
+        assert 2 == store.data.count(("foo.counts.j", 1, now))
+        assert 2 == store.data.count(("foo.timers.k.sum", 10, now))
+        assert [True, True] == store.prefixed
+        assert 2 == store.names.hits
+        assert 2 == store.names.misses
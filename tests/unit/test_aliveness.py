@@ -0,0 +1,115 @@
+"""
+Contains tests for the aliveness check handler.
+"""
+
+import json
+import socket
+from tests.base import TestBase
+from statsite.aliveness import AlivenessHandler
+
+class FakeRequest(object):
+    """
+    A fake socket which replays a request and records the response.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.sent = ""
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def recv(self, size):
+        if self.data is None:
+            raise socket.timeout("timed out")
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+    def sendall(self, data):
+        self.sent += data
+
+class FakeServer(object):
+    def __init__(self, statsite=None):
+        self.statsite = statsite
+
+class FakeStatsite(object):
+    def __init__(self, healthy=True):
+        self.is_healthy = healthy
+        self.profiling = False
+
+    def healthy(self):
+        return self.is_healthy
+
+    def stats(self):
+        return {"collector.lines": 5}
+
+    def profile(self):
+        started, self.profiling = not self.profiling, True
+        return started
+
+class TestAlivenessHandler(TestBase):
+    def handle(self, data, statsite=None):
+        """
+        Handles the request with the given data, returning the response.
+        """
+        request = FakeRequest(data)
+        AlivenessHandler(request, ("127.0.0.1", 1234), FakeServer(statsite))
+        return request.sent
+
+    def test_plain(self):
+        """
+        Tests that a plain TCP check is answered with YES or NO.
+        """
+        assert "YES" == self.handle("hello?")
+        assert "YES" == self.handle("hello?", FakeStatsite())
+        assert "NO" == self.handle("hello?", FakeStatsite(healthy=False))
+
+    def test_connect_only(self):
+        """
+        Tests that a check which sends nothing is answered once the
+        request times out.
+        """
+        assert "YES" == self.handle(None)
+        assert "NO" == self.handle(None, FakeStatsite(healthy=False))
+
+    def test_http_health(self):
+        """
+        Tests that an HTTP check is answered with a status reflecting
+        the health of the server.
+        """
+        healthy = self.handle("GET / HTTP/1.1\r\nHost: x\r\n\r\n", FakeStatsite())
+        unhealthy = self.handle("GET / HTTP/1.1\r\n\r\n", FakeStatsite(healthy=False))
+
+        assert healthy.startswith("HTTP/1.0 200 OK\r\n")
+        assert healthy.endswith("\r\n\r\nYES")
+        assert unhealthy.startswith("HTTP/1.0 503 Service Unavailable\r\n")
+        assert unhealthy.endswith("\r\n\r\nNO")
+
+    def test_http_stats(self):
+        """
+        Tests that the stats are served as JSON.
+        """
+        response = self.handle("GET /stats HTTP/1.0\r\n\r\n", FakeStatsite())
+        headers, body = response.split("\r\n\r\n", 1)
+
+        assert headers.startswith("HTTP/1.0 200 OK")
+        assert "Content-Type: application/json" in headers
+        assert {"collector.lines": 5, "healthy": True} == json.loads(body)
+
+    def test_http_profile(self):
+        """
+        Tests that profiling is started by a POST, but not twice.
+        """
+        statsite = FakeStatsite()
+        first = self.handle("POST /profile HTTP/1.0\r\n\r\n", statsite)
+        second = self.handle("POST /profile HTTP/1.0\r\n\r\n", statsite)
+
+        assert first.startswith("HTTP/1.0 202 Accepted")
+        assert second.startswith("HTTP/1.0 409 Conflict")
+
+    def test_http_not_found(self):
+        """
+        Tests that unknown paths and methods are not found.
+        """
+        assert self.handle("GET /nope HTTP/1.0\r\n\r\n", FakeStatsite()).startswith("HTTP/1.0 404")
+        assert self.handle("GET /profile HTTP/1.0\r\n\r\n", FakeStatsite()).startswith("HTTP/1.0 404")
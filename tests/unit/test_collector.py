@@ -1,11 +1,19 @@
 """
-Contains tests for the collector base class.
+Contains tests for the collector base class and the built-in
+collectors.
 """
 
+import multiprocessing
+import socket
+import threading
+import time
+
 import pytest
 from tests.base import TestBase
 from statsite.metrics import Counter, KeyValue, Timer
-from statsite.collector import Collector
+from statsite.aggregator import DefaultAggregator
+from statsite.collector import BatchUDPCollector, Collector, EventTCPCollector, MultiProcessUDPCollector, \
+    TCPCollector
 
 class TestCollector(TestBase):
     def test_stores_aggregator(self):
@@ -54,6 +62,56 @@ class TestCollector(TestBase):
         message = "\n".join(["", "k:2|ms"])
         assert [Timer("k", 2)] == Collector(aggregator)._parse_metrics(message)
 
+    def test_parse_metrics_counts(self):
+        """
+        Tests that parsing metrics counts the packets, lines and errors.
+        """
+        collector = Collector(None)
+        collector._parse_metrics("\n".join(["k::1|c", "j:2|nope", "", "k:2|ms"]))
+
+        assert 1 == collector.packets
+        assert 3 == collector.lines
+        assert 2 == collector.parse_errors
+
+    def test_parse_batch_counts(self):
+        """
+        Tests that parsing a batch counts the packets it was joined from,
+        and the lines and errors in it.
+        """
+        collector = Collector(None)
+        collector._parse_batch("\n".join(["k::1|c", "j:2|nope", "", "k:2|ms"]), 3)
+
+        assert 3 == collector.packets
+        assert 3 == collector.lines
+        assert 2 == collector.parse_errors
+
+    def test_parse_batch_groups_by_type(self):
+        """
+        Tests that parsing a batch returns the records of each metric
+        type together, in the order they were received.
+        """
+        message = "\n".join(["k:1|c", "j:27|ms|@0.5", "k:2|c|@0.1", "", "i:3|kv|@10"])
+        results = Collector(None)._parse_batch(message)
+
+        assert {Counter: [("k", 1, None), ("k", 2, 0.1)],
+                Timer: [("j", 27, 0.5)],
+                KeyValue: [("i", 3, 10)]} == results
+
+    def test_parse_batch_skips_invalid(self):
+        """
+        Tests that invalid lines and metric types are skipped when
+        parsing a batch, keeping the good metrics.
+        """
+        message = "\n".join(["k::1|c", "j:2|nope", "k:2|ms"])
+        assert {Timer: [("k", 2, None)]} == Collector(None)._parse_batch(message)
+
+    def test_add_batch(self, aggregator):
+        """
+        Tests that add_batch adds the batch to the configured aggregator.
+        """
+        Collector(aggregator)._add_batch({Counter: [("j", 2, None)]})
+        assert [Counter("j", 2)] == aggregator.metrics
+
     def test_add_metrics(self, aggregator):
         """
         Tests that add_metrics successfully adds an array of metrics to
@@ -75,3 +133,283 @@ class TestCollector(TestBase):
         assert aggregator is coll.aggregator
         coll.set_aggregator(new_agg)
         assert new_agg is coll.aggregator
+
+class TestBatchUDPCollector(TestBase):
+    def test_receives_batch(self, aggregator):
+        """
+        Tests that all the datagrams waiting on the socket are parsed
+        and added to the aggregator.
+        """
+        coll = self._collector(aggregator)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.connect(coll.socket.getsockname())
+        client.send("k:1|c")
+        client.send("j:2|ms\nk:3|c")
+
+        coll._receive_batch()
+        coll.socket.close()
+
+        assert [Counter("k", 1), Counter("k", 3)] == [m for m in aggregator.metrics if isinstance(m, Counter)]
+        assert [Timer("j", 2)] == [m for m in aggregator.metrics if isinstance(m, Timer)]
+
+    def test_receive_batch_limits_size(self, aggregator):
+        """
+        Tests that no more than ``batch_size`` datagrams are read in a
+        single batch.
+        """
+        coll = self._collector(aggregator, batch_size=2)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.connect(coll.socket.getsockname())
+        for i in xrange(3):
+            client.send("k:%d|c" % i)
+
+        coll._receive_batch()
+        assert 2 == len(aggregator.metrics)
+
+        coll._receive_batch()
+        coll.socket.close()
+        assert 3 == len(aggregator.metrics)
+
+    def test_start_and_shutdown(self, aggregator):
+        """
+        Tests that the receive loop adds metrics until it is shut down.
+        """
+        coll = self._collector(aggregator)
+        thread = threading.Thread(target=coll.start)
+        thread.start()
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.connect(coll.socket.getsockname())
+        client.send("k:1|kv|@10")
+        time.sleep(0.2)
+
+        coll.shutdown()
+        thread.join(1)
+        assert not thread.isAlive()
+        assert [KeyValue("k", 1, 10)] == aggregator.metrics
+
+    def _collector(self, aggregator, **kwargs):
+        """
+        Returns a batch UDP collector listening on an ephemeral port.
+        """
+        return BatchUDPCollector(host="localhost", port=0, aggregator=aggregator, **kwargs)
+
+class TestMultiProcessUDPCollector(TestBase):
+    def test_collects_partials_from_workers(self, metrics_store):
+        """
+        Tests that the metrics received by all the workers are handed
+        over as partial aggregates.
+        """
+        coll = MultiProcessUDPCollector(host="localhost", port=0, workers=2,
+                                        aggregator=DefaultAggregator(None))
+        thread = threading.Thread(target=coll.start)
+        thread.start()
+
+        try:
+            # Give the workers time to bind
+            time.sleep(0.5)
+
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            for i in xrange(20):
+                client.sendto("k:1|c", coll.address)
+            time.sleep(0.2)
+
+            partials = coll.collect_partials()
+        finally:
+            coll.shutdown()
+            thread.join(1)
+
+        assert 2 == len(partials)
+        assert 20 == coll.packets
+        assert 20 == coll.lines
+
+        agg = DefaultAggregator(metrics_store)
+        for partial in partials:
+            agg.merge(partial)
+
+        assert {"k": 20} == agg.accumulators[Counter]
+
+    def _fake_workers(self, coll, count):
+        """
+        Gives the collector the given number of fake workers, returning
+        the worker ends of their pipes for the test to answer drains on.
+        """
+        class FakeProcess(object):
+            pid = 0
+
+        worker_conns = []
+        for _ in xrange(count):
+            conn, worker_conn = multiprocessing.Pipe()
+            coll._processes.append((FakeProcess(), conn))
+            worker_conns.append(worker_conn)
+
+        return worker_conns
+
+    def test_discards_late_partials(self):
+        """
+        Tests that a partial which arrives after its drain timed out is
+        thrown away rather than taken for the next drain.
+        """
+        coll = MultiProcessUDPCollector(host="localhost", port=0, workers=1,
+                                        aggregator=DefaultAggregator(None))
+        coll.partial_timeout = 0.2
+        worker_conn, = self._fake_workers(coll, 1)
+
+        assert [] == coll.collect_partials()
+        command, drain = worker_conn.recv()
+        worker_conn.send((drain, "late", (0, 0, 0)))
+
+        def answer():
+            command, drain = worker_conn.recv()
+            worker_conn.send((drain, "fresh", (0, 0, 0)))
+
+        thread = threading.Thread(target=answer)
+        thread.start()
+        try:
+            assert ["fresh"] == coll.collect_partials()
+        finally:
+            thread.join()
+
+    def test_waits_for_workers_together(self):
+        """
+        Tests that the workers are all waited for under a single timeout.
+        """
+        coll = MultiProcessUDPCollector(host="localhost", port=0, workers=3,
+                                        aggregator=DefaultAggregator(None))
+        coll.partial_timeout = 0.3
+        self._fake_workers(coll, 3)
+
+        start = time.time()
+        assert [] == coll.collect_partials()
+        assert time.time() - start < 0.6
+
+class TestTCPCollector(TestBase):
+    def pytest_funcarg__collector(self, request):
+        """
+        Returns a TCP collector listening on an ephemeral port, with a
+        small line size limit, and running in its own thread.
+        """
+        aggregator = request.getfuncargvalue("aggregator")
+        coll = TCPCollector(host="localhost", port=0, max_line_size=16, aggregator=aggregator)
+        thread = threading.Thread(target=coll.start)
+        thread.start()
+
+        def shutdown():
+            coll.shutdown()
+            thread.join(1)
+
+        request.addfinalizer(shutdown)
+        return coll
+
+    def test_buffers_partial_lines(self, collector, aggregator):
+        """
+        Tests that lines split across reads are only parsed once they
+        are complete.
+        """
+        client = self._client(collector)
+        client.sendall("k:1|c\nj:2")
+        time.sleep(0.2)
+        assert [Counter("k", 1)] == aggregator.metrics
+
+        client.sendall("7|ms\n")
+        time.sleep(0.2)
+        assert [Counter("k", 1), Timer("j", 27)] == aggregator.metrics
+
+    def test_closes_on_long_line(self, collector, aggregator):
+        """
+        Tests that a connection which sends a line longer than the limit
+        without a newline is closed rather than buffered.
+        """
+        client = self._client(collector)
+        client.sendall("k:1|c\n" + "x" * 32)
+        client.settimeout(1)
+
+        assert "" == client.recv(1)
+        assert [Counter("k", 1)] == aggregator.metrics
+
+    def _client(self, collector):
+        """
+        Returns a TCP socket connected to the collector.
+        """
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(collector.server.server_address)
+        return client
+
+class TestEventTCPCollector(TestBase):
+    def pytest_funcarg__collector(self, request):
+        """
+        Returns an event loop TCP collector listening on an ephemeral
+        port and running in its own thread.
+        """
+        aggregator = request.getfuncargvalue("aggregator")
+        coll = EventTCPCollector(host="localhost", port=0, aggregator=aggregator)
+        thread = threading.Thread(target=coll.start)
+        thread.start()
+
+        def shutdown():
+            coll.shutdown()
+            thread.join(1)
+
+        request.addfinalizer(shutdown)
+        return coll
+
+    def test_multiplexes_connections(self, collector, aggregator):
+        """
+        Tests that metrics from multiple connections are all added to
+        the aggregator.
+        """
+        clients = [self._client(collector) for _ in xrange(3)]
+        for i, client in enumerate(clients):
+            client.sendall("k:%d|c\n" % i)
+
+        time.sleep(0.2)
+        assert [0, 1, 2] == sorted([metric.value for metric in aggregator.metrics])
+
+    def test_buffers_partial_lines(self, collector, aggregator):
+        """
+        Tests that lines split across reads are only parsed once they
+        are complete.
+        """
+        client = self._client(collector)
+        client.sendall("k:1|c\nj:2")
+        time.sleep(0.2)
+        assert [Counter("k", 1)] == aggregator.metrics
+
+        client.sendall("7|ms\n")
+        time.sleep(0.2)
+        assert [Counter("k", 1), Timer("j", 27)] == aggregator.metrics
+
+    def test_closes_on_long_line(self, collector, aggregator):
+        """
+        Tests that a connection which sends a line longer than the limit
+        without a newline is closed rather than buffered.
+        """
+        collector.max_line_size = 16
+        client = self._client(collector)
+        client.sendall("k:1|c\n" + "x" * 32)
+        client.settimeout(1)
+
+        assert "" == client.recv(1)
+        assert [Counter("k", 1)] == aggregator.metrics
+        assert {} == collector._connections
+
+    def test_parses_trailing_line_on_close(self, collector, aggregator):
+        """
+        Tests that a final line without a newline is parsed when the
+        client closes the connection.
+        """
+        client = self._client(collector)
+        client.sendall("k:1|c")
+        client.close()
+
+        time.sleep(0.2)
+        assert [Counter("k", 1)] == aggregator.metrics
+        assert {} == collector._connections
+
+    def _client(self, collector):
+        """
+        Returns a TCP socket connected to the collector.
+        """
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(collector.socket.getsockname())
+        return client
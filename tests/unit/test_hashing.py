@@ -0,0 +1,66 @@
+"""
+Contains tests for the consistent hash ring.
+"""
+
+import hashlib
+import pytest
+from statsite.hashing import ConsistentHashRing
+
+class TestConsistentHashRing(object):
+    def test_carbon_replica_keys(self):
+        """
+        Tests that the replicas of nodes are placed on the ring using the
+        same keys as carbon, which formats the (server, instance) tuple.
+        """
+        ring = ConsistentHashRing([("127.0.0.1", "a")], replica_count=2)
+        expected = sorted([(int(hashlib.md5("('127.0.0.1', 'a'):%d" % i).hexdigest()[:4], 16),
+                            ("127.0.0.1", "a")) for i in xrange(2)])
+        assert expected == ring.ring
+
+    def test_get_node(self):
+        """
+        Tests that keys go to the node at the next position on the ring,
+        wrapping around at the end.
+        """
+        ring = ConsistentHashRing([])
+        ring.ring = [(100, "a"), (200, "b")]
+        ring.compute_ring_position = lambda key: int(key)
+
+        assert "a" == ring.get_node("50")
+        assert "a" == ring.get_node("100")
+        assert "b" == ring.get_node("150")
+        assert "a" == ring.get_node("250")
+
+    def test_independent_of_order(self):
+        """
+        Tests that the ring doesn't depend on the order of the nodes.
+        """
+        nodes = [("10.0.0.1", None), ("10.0.0.2", None), ("10.0.0.3", None)]
+        a = ConsistentHashRing(nodes)
+        b = ConsistentHashRing(reversed(nodes))
+
+        keys = ["statsite.counts.k%d" % i for i in xrange(1000)]
+        assert [a.get_node(key) for key in keys] == [b.get_node(key) for key in keys]
+
+    def test_minimal_movement(self):
+        """
+        Tests that adding a node only moves keys onto the new node.
+        """
+        nodes = [("10.0.0.1", None), ("10.0.0.2", None)]
+        ring = ConsistentHashRing(nodes)
+        keys = ["statsite.counts.k%d" % i for i in xrange(1000)]
+        before = [ring.get_node(key) for key in keys]
+
+        ring.add_node(("10.0.0.3", None))
+        after = [ring.get_node(key) for key in keys]
+
+        moved = [new for old, new in zip(before, after) if old != new]
+        assert moved
+        assert set([("10.0.0.3", None)]) == set(moved)
+
+    def test_empty(self):
+        """
+        Tests that a ring without nodes can't place keys.
+        """
+        with pytest.raises(ValueError):
+            ConsistentHashRing([]).get_node("k")
@@ -18,3 +18,24 @@ class TestMetric(object):
         """
         metrics = [Metric("k", 27, None)]
         assert [("k", 27, 123456)] == Metric.fold(metrics, 123456)
+
+    def test_fold_accumulator(self):
+        """
+        Tests that metrics folded one at a time into an accumulator
+        fold the same as a list of metrics.
+        """
+        accum = Metric.accumulator()
+        Metric("k", 27, 123456)._fold(accum)
+        Metric("j", 28, None)._fold(accum)
+
+        expected = [("k", 27, 123456), ("j", 28, 10)]
+        assert expected == Metric.fold_accumulator(accum, 10)
+
+    def test_no_instance_dict(self):
+        """
+        Tests that metric objects don't carry a ``__dict__`` around,
+        keeping them small.
+        """
+        from statsite.metrics import METRIC_TYPES
+        for cls in [Metric] + METRIC_TYPES.values():
+            assert not hasattr(cls("k", 27, 1), "__dict__")
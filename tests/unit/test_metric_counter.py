@@ -3,6 +3,7 @@ Contains tests for the Counter metric.
 """
 
 from statsite.metrics import Counter
+from statsite.util import OutputNames
 
 class TestCounterMetric(object):
     def test_fold(self):
@@ -18,3 +19,12 @@ class TestCounterMetric(object):
 
         result = Counter.fold(metrics, 0)
         assert expected == result
+
+    def test_fold_with_names(self):
+        """
+        Tests that counters are named with the prefix of the given
+        output names.
+        """
+        metrics = [Counter("k", 10), Counter("k", 15)]
+        result = Counter.fold(metrics, 0, names=OutputNames("foo"))
+        assert [("foo.counts.k", 25, 0)] == result
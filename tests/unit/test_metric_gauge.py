@@ -0,0 +1,68 @@
+"""
+Contains tests for the Gauge metric.
+"""
+
+from statsite.metrics import Gauge
+
+class TestGaugeMetric(object):
+    def test_fold_last_value(self):
+        """
+        Tests that only the last value of each gauge is emitted.
+        """
+        metrics = [Gauge("k", 10),
+                   Gauge("k", 15),
+                   Gauge("j", 5)]
+
+        result = Gauge.fold(metrics, 0)
+        assert sorted([("gauges.k", 15, 0), ("gauges.j", 5, 0)]) == sorted(result)
+
+    def test_fold_relative(self):
+        """
+        Tests that relative updates are applied to the last value.
+        """
+        metrics = [Gauge("k", 10),
+                   Gauge("k", 5, True),
+                   Gauge("k", -3, True)]
+
+        assert [("gauges.k", 12, 0)] == Gauge.fold(metrics, 0)
+
+    def test_sample_rate_is_not_relative(self):
+        """
+        Tests that a sample rate in the flag isn't taken for a relative
+        update.
+        """
+        metrics = [Gauge("k", 10),
+                   Gauge("k", 5, 0.5)]
+
+        assert [("gauges.k", 5, 0)] == Gauge.fold(metrics, 0)
+
+    def test_carries_state(self):
+        """
+        Tests that gauges carry their values across intervals, with
+        relative updates applying to the value from the last interval.
+        """
+        state = {}
+        assert [("gauges.k", 10, 0)] == Gauge.fold([Gauge("k", 10)], 0, state=state)
+        assert [("gauges.k", 10, 1)] == Gauge.fold([], 1, state=state)
+        assert [("gauges.k", 8, 2)] == Gauge.fold([Gauge("k", -2, True)], 2, state=state)
+
+    def test_relative_without_value(self):
+        """
+        Tests that relative updates to a new gauge start from zero.
+        """
+        assert [("gauges.k", -4, 0)] == Gauge.fold([Gauge("k", -4, True)], 0)
+
+    def test_merge(self):
+        """
+        Tests that merging accumulators adds up the relative updates,
+        and that absolute values replace them.
+        """
+        accum = Gauge.accumulator()
+        Gauge.accumulate(accum, [("k", 1, None), ("k", 2, True), ("j", 5, None)])
+
+        other = Gauge.accumulator()
+        Gauge.accumulate(other, [("k", 3, True), ("j", 7, None), ("j", 1, True)])
+        Gauge.merge(accum, other)
+
+        result = Gauge.fold_accumulator(accum, 0)
+        assert sorted([("gauges.k", 6, 0), ("gauges.j", 8, 0)]) == sorted(result)
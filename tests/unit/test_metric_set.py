@@ -0,0 +1,40 @@
+"""
+Contains tests for the Set metric.
+"""
+
+from statsite.metrics import Set
+
+class TestSetMetric(object):
+    def test_fold(self):
+        """
+        Tests that set folding counts the unique members of each key.
+        """
+        metrics = [Set("k", "a"),
+                   Set("k", "b"),
+                   Set("k", "a"),
+                   Set("j", "a")]
+
+        result = Set.fold(metrics, 0)
+        assert sorted([("sets.k", 2, 0), ("sets.j", 1, 0)]) == sorted(result)
+
+    def test_precision_setting(self):
+        """
+        Tests that the precision setting sets the number of registers.
+        """
+        accum = Set.accumulator(precision="10")
+        Set.accumulate(accum, [("k", "a", None)])
+        assert 1024 == len(accum["k"].registers)
+
+    def test_merge(self):
+        """
+        Tests that merging accumulators counts the members of both.
+        """
+        accum = Set.accumulator()
+        Set.accumulate(accum, [("k", "a", None), ("k", "b", None)])
+
+        other = Set.accumulator()
+        Set.accumulate(other, [("k", "b", None), ("k", "c", None), ("j", "a", None)])
+        Set.merge(accum, other)
+
+        result = Set.fold_accumulator(accum, 0)
+        assert sorted([("sets.k", 3, 0), ("sets.j", 1, 0)]) == sorted(result)
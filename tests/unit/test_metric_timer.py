@@ -2,7 +2,11 @@
 Contains tests for the timer metric.
 """
 
+import random
+import pytest
+import statsite.metrics
 from statsite.metrics import Timer
+from statsite.util import OutputNames
 
 class TestTimerMetric(object):
     def test_fold_sum(self):
@@ -106,6 +110,53 @@ class TestTimerMetric(object):
         result = Timer.fold(self._100_timers, now)
         assert ("timers.k.mean_90", 50, now) == self._get_metric("timers.k.mean_90", result)
 
+    def test_multiple_percentiles(self):
+        """
+        Tests that a list of percentiles are all computed, with fractional
+        percentiles named with an underscore.
+        """
+        now = 10
+        result = Timer.fold(self._100_timers, now, percentile=[50, 90, 99.9])
+
+        assert ("timers.k.upper_50", 76, now) == self._get_metric("timers.k.upper_50", result)
+        assert ("timers.k.sum_90", 4545, now) == self._get_metric("timers.k.sum_90", result)
+        assert ("timers.k.count_99_9", 99, now) == self._get_metric("timers.k.count_99_9", result)
+        assert 6 * 4 == len(result)
+
+    def test_fold_with_names(self):
+        """
+        Tests that the names are looked up in the given output names,
+        which adds their prefix and caches them for the next fold.
+        """
+        now = 10
+        names = OutputNames("foo")
+        for _ in xrange(2):
+            result = Timer.fold(self._100_timers, now, names=names)
+            assert ("foo.timers.k.sum", 5050, now) == self._get_metric("foo.timers.k.sum", result)
+            assert ("foo.timers.k.mean_90", 50, now) == self._get_metric("foo.timers.k.mean_90", result)
+
+        assert 1 == names.hits
+        assert 1 == names.misses
+
+    def test_percentiles_string(self):
+        """
+        Tests that percentiles from a configuration file, which are a
+        comma separated string, are parsed.
+        """
+        assert [90] == Timer._percentiles("90")
+        assert [50, 99, 99.9] == Timer._percentiles("50, 99,99.9")
+        assert [80] == Timer._percentiles(80.0)
+
+    def test_sketch_multiple_percentiles(self):
+        """
+        Tests that a list of percentiles are all computed from a sketch.
+        """
+        now = 10
+        result = Timer.fold(self._100_timers, now, percentile="50,90", sketch=True)
+
+        assert ("timers.k.count_50", 50, now) == self._get_metric("timers.k.count_50", result)
+        assert ("timers.k.sum_90", 4545, now) == self._get_metric("timers.k.sum_90", result)
+
     def test_stdev(self):
         """
         Tests that the standard deviation is properly computed.
@@ -116,6 +167,116 @@ class TestTimerMetric(object):
 
         assert int(0.205767 * 10000) == int(Timer._stdev(numbers, average) * 10000)
 
+    def test_sketch_exact_stats(self):
+        """
+        Tests that the sketch mode computes the overall stats exactly.
+        """
+        now = 10
+        result = Timer.fold(self._100_timers, now, sketch=True)
+
+        assert ("timers.k.sum", 5050, now) == self._get_metric("timers.k.sum", result)
+        assert ("timers.k.mean", 50.5, now) == self._get_metric("timers.k.mean", result)
+        assert ("timers.k.lower", 1, now) == self._get_metric("timers.k.lower", result)
+        assert ("timers.k.upper", 100, now) == self._get_metric("timers.k.upper", result)
+        assert ("timers.k.count", 100, now) == self._get_metric("timers.k.count", result)
+
+    def test_sketch_percentile(self):
+        """
+        Tests that the sketch mode approximates the percentile stats
+        closely.
+        """
+        now = 10
+        timers = [Timer("k", i) for i in xrange(1, 100001)]
+        exact = Timer.fold(timers, now)
+        result = Timer.fold(timers, now, sketch=True, sketch_k="200")
+
+        assert 90000 == self._get_metric("timers.k.count_90", result)[1]
+        for name in ("sum_90", "mean_90", "stdev_90"):
+            key = "timers.k.%s" % name
+            expected = self._get_metric(key, exact)[1]
+            assert abs(expected - self._get_metric(key, result)[1]) < 0.02 * expected
+
+        # The bounds are off by their rank error, relative to the count
+        for name in ("lower_90", "upper_90"):
+            key = "timers.k.%s" % name
+            expected = self._get_metric(key, exact)[1]
+            assert abs(expected - self._get_metric(key, result)[1]) < 0.02 * len(timers)
+
+    def test_sketch_single_value(self):
+        """
+        Tests the sketch mode with a single value matches the exact mode.
+        """
+        now = 10
+        exact = Timer.fold([Timer("k", 5)], now)
+        result = Timer.fold([Timer("k", 5)], now, sketch="true")
+        assert sorted(exact) == sorted(result)
+
+    def test_sketch_merge(self):
+        """
+        Tests that accumulators with sketches can be merged.
+        """
+        accum = Timer.accumulator(sketch=True)
+        other = Timer.accumulator(sketch=True)
+        Timer.accumulate(accum, [("k", 1, None), ("k", 2, None)])
+        Timer.accumulate(other, [("k", 3, None), ("j", 4, None)])
+        Timer.merge(accum, other)
+
+        result = Timer.fold_accumulator(accum, 10)
+        assert ("timers.k.count", 3, 10) == self._get_metric("timers.k.count", result)
+        assert ("timers.k.upper", 3, 10) == self._get_metric("timers.k.upper", result)
+        assert ("timers.j.sum", 4, 10) == self._get_metric("timers.j.sum", result)
+
+    def test_vectorized_matches(self):
+        """
+        Tests that the vectorized fold computes the same stats as the
+        pure Python fold, up to the rounding of the floating point stats
+        such as the standard deviation.
+        """
+        pytest.importorskip("numpy")
+        for seed in xrange(5):
+            rand = random.Random(seed)
+            accum = {}
+            for i in xrange(200):
+                count = rand.randint(1, 50)
+                if i % 2:
+                    accum["k%d" % i] = [rand.randint(0, 1000) for _ in xrange(count)]
+                else:
+                    accum["k%d" % i] = [rand.random() * 500 for _ in xrange(count)]
+
+            percentiles = [50, 90, 99.9]
+            expected = Timer.fold_accumulator(dict((k, list(v)) for k,v in accum.iteritems()), 10,
+                                              percentile=percentiles)
+            result = Timer.fold_accumulator(accum, 10, percentile=percentiles, vectorize=True)
+
+            expected = dict([(key, value) for key,value,_ in expected])
+            result = dict([(key, value) for key,value,_ in result])
+            assert sorted(expected) == sorted(result)
+            for key,value in expected.iteritems():
+                assert abs(value - result[key]) <= 1e-9 * max(abs(value), 1)
+
+    def test_vectorized_percentile(self):
+        """
+        Tests the vectorized percentile stats, including the integer
+        mean.
+        """
+        pytest.importorskip("numpy")
+        now = 10
+        result = Timer.fold(self._100_timers, now, vectorize="true")
+        assert ("timers.k.sum_90", 4545, now) == self._get_metric("timers.k.sum_90", result)
+        assert ("timers.k.mean_90", 50, now) == self._get_metric("timers.k.mean_90", result)
+        assert ("timers.k.lower_90", 6, now) == self._get_metric("timers.k.lower_90", result)
+        assert ("timers.k.upper_90", 96, now) == self._get_metric("timers.k.upper_90", result)
+
+    def test_vectorized_without_numpy(self, monkeypatch):
+        """
+        Tests that the vectorize setting falls back to the pure Python
+        fold if NumPy isn't available.
+        """
+        monkeypatch.setattr(statsite.metrics, "numpy", None)
+        now = 10
+        result = Timer.fold(self._100_timers, now, vectorize=True)
+        assert ("timers.k.sum_90", 4545, now) == self._get_metric("timers.k.sum_90", result)
+
     def _get_metric(self, key, metrics):
         """
         This will extract a specific metric out of an array of metrics.
@@ -2,9 +2,13 @@
 Contains metric store tests.
 """
 
+import Queue
+import socket
+import threading
+import time
 import pytest
 from tests.base import TestBase
-from statsite.metrics_store import GraphiteStore, MetricsStore
+from statsite.metrics_store import GraphitePickleStore, GraphiteStore, MetricsStore, ShardedGraphiteStore
 
 class TestMetricsStore(TestBase):
     """
@@ -34,3 +38,372 @@ class TestGraphiteStore(TestBase):
             assert metric_strings == graphite.messages
 
         self.after_flush_interval(check, interval=1)
+
+    def test_flushes_prefixed(self, graphite):
+        """
+        Tests that metrics which were named by the output names of the
+        store aren't prefixed again.
+        """
+        store = GraphiteStore(graphite.host, graphite.port, prefix="foobar")
+        lookup = store.names.lookup("counts")
+        store.flush([(lookup("k")[0], 1, 10)], prefixed=True)
+        store.close()
+
+        def check():
+            assert ["foobar.counts.k 1 10"] == graphite.messages
+
+        self.after_flush_interval(check, interval=1)
+
+    def test_name_cache_size(self, graphite):
+        """
+        Tests that the name cache can be disabled, and can't be negative.
+        """
+        store = GraphiteStore(graphite.host, graphite.port, name_cache_size="0")
+        assert store.names is None
+        store.close()
+
+        with pytest.raises(ValueError):
+            GraphiteStore(graphite.host, graphite.port, name_cache_size=-1)
+
+    def test_timings(self, graphite):
+        """
+        Tests that the time spent formatting and writing is added up.
+        """
+        store = GraphiteStore(graphite.host, graphite.port)
+        store.flush([("k", 1, 10)])
+        store.close()
+
+        assert 0 < store.timings["format"] < 1
+        assert 0 < store.timings["write"] < 1
+
+    def test_flushes_through_queue(self, graphite):
+        """
+        Tests that metrics are sent by the background thread when there
+        is a queue, and that they are counted.
+        """
+        store = GraphiteStore(graphite.host, graphite.port, prefix="foobar", queue_size="10")
+        metrics = [("k", 1, 10), ("j", 2, 20)]
+
+        store.flush(metrics)
+        store.close()
+
+        assert 2 == store.counters["enqueued"]
+        assert 2 == store.counters["sent"]
+        assert 0 == store.counters["dropped"]
+
+        def check():
+            assert ["foobar.k 1 10", "foobar.j 2 20"] == graphite.messages
+
+        self.after_flush_interval(check, interval=1)
+
+    def test_queue_drops_newest(self, graphite):
+        """
+        Tests that the batch being queued is dropped when the queue is
+        full with the "newest" drop policy.
+        """
+        store = GraphiteStore(graphite.host, graphite.port, queue_size=2, drop="newest")
+
+        # Swap in a queue which the background thread isn't reading, and
+        # put back the real one before closing the store
+        queue, store.queue = store.queue, Queue.Queue(2)
+        try:
+            for i in xrange(3):
+                store.flush([("k", i, 10)] * (i + 1))
+
+            assert [1, 2] == [count for _, count in store.queue.queue]
+            assert 3 == store.counters["enqueued"]
+            assert 3 == store.counters["dropped"]
+        finally:
+            store.queue = queue
+            store.close()
+
+    def test_queue_drops_oldest(self, graphite):
+        """
+        Tests that the oldest queued batch is dropped when the queue is
+        full with the "oldest" drop policy.
+        """
+        store = GraphiteStore(graphite.host, graphite.port, queue_size=2, drop="oldest")
+
+        # Swap in a queue which the background thread isn't reading, and
+        # put back the real one before closing the store
+        queue, store.queue = store.queue, Queue.Queue(2)
+        try:
+            for i in xrange(3):
+                store.flush([("k", i, 10)] * (i + 1))
+
+            assert [2, 3] == [count for _, count in store.queue.queue]
+            assert 6 == store.counters["enqueued"]
+            assert 1 == store.counters["dropped"]
+        finally:
+            store.queue = queue
+            store.close()
+
+    def test_invalid_queue_settings(self, graphite):
+        """
+        Tests that the queue size and drop policy are validated.
+        """
+        with pytest.raises(ValueError):
+            GraphiteStore(graphite.host, graphite.port, queue_size=-1)
+
+        with pytest.raises(ValueError):
+            GraphiteStore(graphite.host, graphite.port, queue_size=1, drop="random")
+
+    def test_invalid_timeout(self, graphite):
+        """
+        Tests that the timeout is validated.
+        """
+        with pytest.raises(ValueError):
+            GraphiteStore(graphite.host, graphite.port, timeout=0)
+
+    def test_spools_failed_batches(self, graphite, tempfile, monkeypatch):
+        """
+        Tests that batches which fail to send are spooled, and replayed
+        once they can be sent.
+        """
+        store = GraphiteStore(graphite.host, graphite.port, prefix="foobar",
+                              spool_path=tempfile.name)
+        monkeypatch.setattr(store, "_write_metric", lambda data: False)
+        store.flush([("k", 1, 10), ("j", 2, 20)])
+
+        assert 1 == len(store.spool)
+        assert 2 == store.counters["failed"]
+        assert 2 == store.counters["spooled"]
+
+        store._replay()
+        store.close()
+
+        assert 0 == len(store.spool)
+        assert 2 == store.counters["replayed"]
+
+        def check():
+            assert ["foobar.k 1 10", "foobar.j 2 20"] == graphite.messages
+
+        self.after_flush_interval(check, interval=1)
+
+    def test_replay_rate(self, graphite, tempfile, monkeypatch):
+        """
+        Tests that replaying stops once the allowance of metrics is used.
+        """
+        store = GraphiteStore(graphite.host, graphite.port, spool_path=tempfile.name,
+                              replay_rate=3)
+        monkeypatch.setattr(store, "_write_metric", lambda data: False)
+        try:
+            for i in xrange(3):
+                store.flush([("k", 1, 10), ("j", 2, 20)])
+
+            store._replay()
+            assert 1 == len(store.spool)
+            assert 4 == store.counters["replayed"]
+        finally:
+            store.close()
+
+    def test_replay_rate_of_large_chunks(self, graphite, tempfile, monkeypatch):
+        """
+        Tests that a chunk larger than the replay rate uses up the
+        allowance of the seconds after it is replayed.
+        """
+        store = GraphiteStore(graphite.host, graphite.port, spool_path=tempfile.name,
+                              replay_rate=100)
+        monkeypatch.setattr(store, "_write_metric", lambda data: False)
+        try:
+            store.flush([("k%d" % i, i, 10) for i in xrange(250)])
+            store.flush([("j", 1, 10)])
+
+            replayed = []
+            for second in xrange(3):
+                store._replay()
+                replayed.append(store.counters["replayed"])
+
+            assert [250, 250, 251] == replayed
+            assert 0 == len(store.spool)
+        finally:
+            store.close()
+
+class TestGraphitePickleStore(TestBase):
+    def test_flushes(self, graphite_pickle):
+        """
+        Tests that metrics are properly flushed to a graphite server
+        using the pickle protocol.
+        """
+        store = GraphitePickleStore(graphite_pickle.host, graphite_pickle.port, prefix="foobar")
+        metrics = [("k", 1, 10), ("j", 2.5, 20.7)]
+
+        store.flush(metrics)
+        store.close()
+
+        def check():
+            assert ["foobar.k 1 10", "foobar.j 2.5 20"] == graphite_pickle.messages
+
+        self.after_flush_interval(check, interval=1)
+
+    def test_flushes_in_batches(self, graphite_pickle):
+        """
+        Tests that the metrics are split into batches of at most
+        the batch size.
+        """
+        store = GraphitePickleStore(graphite_pickle.host, graphite_pickle.port,
+                                    prefix="foobar", batch_size="2")
+        metrics = [("k%d" % i, i, 10) for i in xrange(5)]
+
+        store.flush(metrics)
+        store.close()
+
+        def check():
+            assert [2, 2, 1] == [len(batch) for batch in graphite_pickle.batches]
+            assert ["foobar.k%d %d 10" % (i, i) for i in xrange(5)] == graphite_pickle.messages
+
+        self.after_flush_interval(check, interval=1)
+
+    def test_invalid_batch_size(self, graphite_pickle):
+        """
+        Tests that the batch size must be positive.
+        """
+        with pytest.raises(ValueError):
+            GraphitePickleStore(graphite_pickle.host, graphite_pickle.port, batch_size=0)
+
+class FailingMetricsStore(MetricsStore):
+    """
+    A metrics store which fails to flush.
+    """
+    def __init__(self, host=None, port=None, prefix=None):
+        pass
+
+    def flush(self, metrics):
+        raise Exception("Failed to flush")
+
+class TestShardedGraphiteStore(TestBase):
+    def test_routes_by_ring(self):
+        """
+        Tests that each metric is flushed to the destination its key
+        hashes to on the ring, including the prefix.
+        """
+        store = ShardedGraphiteStore("a:2003, b:2003,c:2003:x", prefix="foobar",
+                                     destination_class="tests.helpers.DumbMetricsStore")
+        metrics = [("k%d" % i, i, 10) for i in xrange(100)]
+        store.flush(metrics)
+        store.close()
+
+        assert set([("a", None), ("b", None), ("c", "x")]) == set(store.stores)
+
+        seen = []
+        for node, child in store.stores.iteritems():
+            assert child.data
+            for metric in child.data:
+                assert node == store.ring.get_node("foobar." + metric[0])
+            seen.extend(child.data)
+
+        assert sorted(metrics) == sorted(seen)
+
+    def test_isolates_failures(self, monkeypatch):
+        """
+        Tests that a destination failing to flush doesn't stop the
+        others from flushing.
+        """
+        store = ShardedGraphiteStore(["a:2003", "b:2003"],
+                                     destination_class="tests.helpers.DumbMetricsStore")
+        monkeypatch.setitem(store.stores, ("a", None), FailingMetricsStore())
+        store.flush([("k%d" % i, i, 10) for i in xrange(100)])
+        store.close()
+
+        assert store.stores[("b", None)].data
+
+    def test_starts_with_destination_down(self, graphite):
+        """
+        Tests that a destination which is down doesn't stop the store
+        from starting, and that its metrics fail without affecting the
+        destination which is up.
+        """
+        probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        probe.bind(("localhost", 0))
+        down = probe.getsockname()[1]
+        probe.close()
+
+        store = ShardedGraphiteStore(["%s:%d:up" % (graphite.host, graphite.port),
+                                      "localhost:%d:down" % down], prefix="foobar", attempts=2)
+        store.flush([("k%d" % i, i, 10) for i in xrange(20)])
+        store.close()
+
+        assert store.counters["sent"] > 0
+        assert store.counters["failed"] > 0
+        assert 20 == store.counters["sent"] + store.counters["failed"]
+
+    def test_stuck_destination(self, graphite):
+        """
+        Tests that a destination which accepts connections but never
+        reads doesn't hold up the flush, and that writing to it times
+        out while the other destination is written to.
+        """
+        stuck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        stuck.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        stuck.bind(("localhost", 0))
+        stuck.listen(5)
+
+        store = ShardedGraphiteStore(["%s:%d:up" % (graphite.host, graphite.port),
+                                      "localhost:%d:stuck" % stuck.getsockname()[1]],
+                                     prefix="foobar", attempts=2, timeout=0.2)
+
+        # Keep the send buffer small too, so the writes block quickly
+        child = store.stores[("localhost", "stuck")]
+        create_socket = child._create_socket
+        def small_socket():
+            sock = create_socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+            return sock
+        child._create_socket = small_socket
+
+        try:
+            start = time.time()
+            store.flush([("k%d" % i, i, 10) for i in xrange(20000)])
+            assert time.time() - start < 0.2
+
+            store.close()
+            up = store.stores[(graphite.host, "up")].counters
+            assert up["sent"] > 0
+            assert 0 == up["failed"]
+            assert child.counters["failed"] > 0
+            assert 20000 == store.counters["sent"] + store.counters["failed"]
+        finally:
+            stuck.close()
+
+    def test_drops_shards_for_stuck_destination(self, monkeypatch):
+        """
+        Tests that shards for a destination which has too many queued
+        are dropped and counted.
+        """
+        monkeypatch.setattr(ShardedGraphiteStore, "SHARD_QUEUE_SIZE", 1)
+        store = ShardedGraphiteStore(["a:2003"], destination_class="tests.helpers.DumbMetricsStore")
+        release = threading.Event()
+        monkeypatch.setattr(store.stores[("a", None)], "flush", lambda data: release.wait())
+
+        for i in xrange(3):
+            store.flush([("k", i, 10)])
+
+        release.set()
+        store.close()
+        assert store.counters["dropped"] >= 1
+
+    def test_invalid_destinations(self):
+        """
+        Tests that the destinations are validated.
+        """
+        with pytest.raises(ValueError):
+            ShardedGraphiteStore([], destination_class="tests.helpers.DumbMetricsStore")
+
+        with pytest.raises(ValueError):
+            ShardedGraphiteStore(["a"], destination_class="tests.helpers.DumbMetricsStore")
+
+        with pytest.raises(ValueError):
+            ShardedGraphiteStore(["a:2003", "a:2004"], destination_class="tests.helpers.DumbMetricsStore")
+
+    def test_flushes_to_graphite(self, graphite):
+        """
+        Tests that metrics are flushed to real destinations.
+        """
+        store = ShardedGraphiteStore(["%s:%d" % (graphite.host, graphite.port)], prefix="foobar")
+        store.flush([("k", 1, 10)])
+        store.close()
+
+        def check():
+            assert ["foobar.k 1 10"] == graphite.messages
+
+        self.after_flush_interval(check, interval=1)
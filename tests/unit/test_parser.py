@@ -20,6 +20,28 @@ class TestParser(object):
         """Tests that lines can contain negative numbers as values."""
         assert ("k", -27, "ms", None) == p.parse_line("k:-27|ms")
 
+    def test_parses_gauge(self):
+        """Tests that gauges with a sign are flagged as relative."""
+        assert ("k", 5, "g", None) == p.parse_line("k:5|g")
+        assert ("k", 5, "g", True) == p.parse_line("k:+5|g")
+        assert ("k", -5, "g", True) == p.parse_line("k:-5|g")
+
+    def test_ignores_gauge_sample_rate(self):
+        """Tests that a sample rate sent with a gauge is dropped."""
+        assert ("k", 5, "g", None) == p.parse_line("k:5|g|@0.5")
+        assert ({"g": [("k", 10, None), ("k", 5, None)]}, []) == p.parse_message("k:10|g\nk:5|g|@0.5")
+
+    def test_parses_set_members(self):
+        """Tests that the members of sets are kept as strings, and
+        may be any string."""
+        assert ("k", "12", "s", None) == p.parse_line("k:12|s")
+        assert ("k", "user-1@example.com", "s", None) == p.parse_line("k:user-1@example.com|s")
+
+    def test_fails_non_numeric_value(self):
+        """Tests that only sets may have non-numeric values."""
+        with pytest.raises(ValueError):
+            p.parse_line("k:abc|c")
+
     def test_parses_float_value(self):
         """Tests that float values can be parsed."""
         assert ("k", 3.14, "ms", None) == p.parse_line("k:3.14|ms")
@@ -51,3 +73,99 @@ class TestParser(object):
         fail at some point in production.
         """
         p.parse_line("hosts.lucid64.bi.metrics.tasks.update_session_create_counts:6.330013|ms")
+
+    def test_fails_invalid_key(self):
+        """Tests that keys with characters outside of the allowed set
+        can not be parsed."""
+        with pytest.raises(ValueError):
+            p.parse_line("k k:27|kv")
+
+    def test_fails_flag_without_at(self):
+        """Tests that flags must be prefixed with an @."""
+        with pytest.raises(ValueError):
+            p.parse_line("k:27|ms|0.1")
+
+    def test_fails_exponent_value(self):
+        """Tests that values are restricted to plain decimal numbers,
+        even though Python could convert them."""
+        with pytest.raises(ValueError):
+            p.parse_line("k:1e5|ms")
+
+    def test_caches_results(self):
+        """Tests that parsing the same line again returns the same
+        result from the cache."""
+        first = p.parse_line("cached.k:1|c|@0.1")
+        assert "cached.k:1|c|@0.1" in p._cache
+        assert first is p.parse_line("cached.k:1|c|@0.1")
+        assert ("cached.k", 1, "c", 0.1) == first
+
+    def test_only_caches_counters(self):
+        """Tests that the lines of types whose values rarely repeat
+        are parsed but not remembered."""
+        for line in ("uncached.k:3.5|ms", "uncached.k:4|kv", "uncached.k:a|s", "uncached.k:2|g"):
+            p.parse_line(line)
+            assert line not in p._cache
+
+    def test_does_not_cache_invalid_lines(self):
+        """Tests that invalid lines fail every time they are parsed."""
+        for _ in xrange(2):
+            with pytest.raises(ValueError):
+                p.parse_line("k:27|c|@")
+
+    def test_cache_is_bounded(self, monkeypatch):
+        """Tests that the cache never grows beyond its size."""
+        monkeypatch.setattr(p, "CACHE_SIZE", 10)
+        for i in xrange(25):
+            p.parse_line("k:%d|c" % i)
+
+        assert len(p._cache) <= 10
+
+    def test_does_not_cache_long_lines(self, monkeypatch):
+        """Tests that lines longer than the limit are parsed but not
+        remembered."""
+        monkeypatch.setattr(p, "CACHE_LINE_LENGTH", 10)
+        assert ("long.key", 1, "c", None) == p.parse_line("long.key:1|c")
+        assert "long.key:1|c" not in p._cache
+
+    def test_parse_message_uses_cache(self):
+        """Tests that whole messages are parsed through the cache."""
+        message = "msg.k:27|c\nmsg.j:1|ms"
+        p.parse_message(message)
+        assert "msg.k:27|c" in p._cache
+
+        p._cache["msg.k:27|c"] = ("msg.k", 5, "c", None)
+        try:
+            assert [("msg.k", 5, None)] == p.parse_message(message)[0]["c"]
+        finally:
+            p._cache.clear()
+
+    def test_parse_message(self):
+        """Tests that all the lines of a message are parsed at once
+        and grouped by metric type."""
+        message = "k:27|c\n\nj:3.14|ms|@0.1\nk:-1|c"
+        expected = ({"c": [("k", 27, None), ("k", -1, None)],
+                     "ms": [("j", 3.14, 0.1)]}, [])
+        assert expected == p.parse_message(message)
+
+    def test_parse_message_invalid_lines(self):
+        """Tests that invalid lines are returned separately, without
+        affecting the valid lines around them."""
+        message = "k:27|c\nk|kv\nk:1.2.3|ms\nj:1|c"
+        metrics, invalid = p.parse_message(message)
+
+        assert {"c": [("k", 27, None), ("j", 1, None)]} == metrics
+        assert ["k|kv", "k:1.2.3|ms"] == invalid
+
+    def test_parse_message_gauges(self):
+        """Tests that gauges with a sign are flagged as relative when
+        parsing a whole message."""
+        message = "k:5|g\nk:+2|g\nk:-1.5|g"
+        expected = ({"g": [("k", 5, None), ("k", 2, True), ("k", -1.5, True)]}, [])
+        assert expected == p.parse_message(message)
+
+    def test_parse_message_sets(self):
+        """Tests that set members are parsed from whole messages,
+        while non-numeric values of other types are invalid."""
+        message = "k:abc|s\nk:12|s|@0.5\nj:abc|c"
+        expected = ({"s": [("k", "abc", None), ("k", "12", 0.5)]}, ["j:abc|c"])
+        assert expected == p.parse_message(message)
@@ -0,0 +1,76 @@
+"""
+Contains tests for the sampling profiler.
+"""
+
+import collections
+import os
+import shutil
+import tempfile
+import threading
+import pytest
+from tests.base import TestBase
+from statsite.profiler import SamplingProfiler
+
+class TestSamplingProfiler(TestBase):
+    def pytest_funcarg__directory(self, request):
+        """
+        Returns a temporary directory which is removed after the test.
+        """
+        directory = tempfile.mkdtemp()
+        request.addfinalizer(lambda: shutil.rmtree(directory))
+        return directory
+
+    def test_sample(self):
+        """
+        Tests that a sample collapses the stack of other threads, named
+        by the thread and from the outermost function in.
+        """
+        started = threading.Event()
+        stopped = threading.Event()
+        def waiting_function():
+            started.set()
+            stopped.wait()
+
+        thread = threading.Thread(target=waiting_function, name="waiter")
+        thread.start()
+        started.wait()
+        try:
+            stacks = collections.defaultdict(int)
+            SamplingProfiler().sample(stacks, threading.current_thread().ident)
+        finally:
+            stopped.set()
+            thread.join()
+
+        waiting = [stack for stack in stacks if stack.startswith("waiter;")]
+        assert 1 == len(waiting)
+        assert "waiting_function (test_profiler.py:" in waiting[0]
+        assert not [stack for stack in stacks if "test_sample" in stack]
+
+    def test_writes_profile(self, directory):
+        """
+        Tests that profiling writes the collapsed stacks to the directory.
+        """
+        profiler = SamplingProfiler(directory, duration=0.1)
+        assert profiler.start()
+        assert not profiler.start()
+        profiler.thread.join(2)
+
+        files = os.listdir(directory)
+        assert 1 == len(files)
+        assert files[0].endswith(".collapsed")
+
+        lines = open(os.path.join(directory, files[0])).read().splitlines()
+        assert lines
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            assert int(count) > 0
+
+    def test_invalid_settings(self):
+        """
+        Tests that the settings are validated.
+        """
+        with pytest.raises(ValueError):
+            SamplingProfiler(duration=0)
+
+        with pytest.raises(ValueError):
+            SamplingProfiler(interval=-1)
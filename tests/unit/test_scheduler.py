@@ -0,0 +1,184 @@
+"""
+Contains tests for the flush scheduler.
+"""
+
+import threading
+import time
+import pytest
+from tests.base import TestBase
+from statsite.aggregator import DefaultAggregator
+from statsite.metrics import Counter
+from statsite.scheduler import FlushExecutor, FlushScheduler
+
+class BlockingAggregator(DefaultAggregator):
+    """
+    An aggregator whose flush blocks until it is released.
+    """
+    def __init__(self, *args, **kwargs):
+        super(BlockingAggregator, self).__init__(*args, **kwargs)
+        self.released = threading.Event()
+        self.flushed = threading.Event()
+
+    def flush(self):
+        self.released.wait()
+        super(BlockingAggregator, self).flush()
+        self.flushed.set()
+
+class TestFlushScheduler(TestBase):
+    def test_first_boundary(self):
+        """
+        Tests that the first interval ends on a multiple of the interval
+        when aligned, and one interval after starting otherwise.
+        """
+        assert 130 == FlushScheduler(10, None).first_boundary(123.4)
+        assert 140 == FlushScheduler(10, None).first_boundary(130)
+        assert 133.4 == FlushScheduler(10, None, align=False).first_boundary(123.4)
+
+    def test_calls_on_boundaries(self):
+        """
+        Tests that the function is called with the end of each interval,
+        without drifting however long the calls take.
+        """
+        boundaries = []
+        def callback(boundary):
+            boundaries.append(boundary)
+            time.sleep(0.05)
+
+        scheduler = FlushScheduler(0.1, callback)
+        scheduler.start()
+        time.sleep(0.45)
+        scheduler.stop()
+
+        assert len(boundaries) >= 3
+        for boundary in boundaries:
+            assert abs(round(boundary / 0.1) * 0.1 - boundary) < 1e-6
+        for previous, boundary in zip(boundaries, boundaries[1:]):
+            assert abs(boundary - previous - 0.1) < 1e-6
+
+        assert 0 <= scheduler.lag <= scheduler.max_lag < 0.05
+
+    def test_skips_missed_intervals(self):
+        """
+        Tests that intervals which pass during a slow call are skipped
+        rather than all called for at once.
+        """
+        boundaries = []
+        def callback(boundary):
+            boundaries.append(boundary)
+            time.sleep(0.25)
+
+        scheduler = FlushScheduler(0.1, callback)
+        scheduler.start()
+        time.sleep(0.4)
+        scheduler.stop()
+
+        assert scheduler.skipped >= 1
+        assert boundaries[1] - boundaries[0] > 0.15
+
+    def test_stop_from_callback(self):
+        """
+        Tests that the scheduler can be stopped from within the function.
+        """
+        boundaries = []
+        def callback(boundary):
+            boundaries.append(boundary)
+            scheduler.stop()
+
+        scheduler = FlushScheduler(0.05, callback)
+        scheduler.start()
+        time.sleep(0.2)
+
+        assert 1 == len(boundaries)
+
+    def test_interval_must_be_positive(self):
+        """
+        Tests that the interval is validated.
+        """
+        with pytest.raises(ValueError):
+            FlushScheduler(0, None)
+
+class TestFlushExecutor(TestBase):
+    def test_flushes(self, metrics_store):
+        """
+        Tests that submitted aggregators are flushed in the background.
+        """
+        executor = FlushExecutor()
+        agg = BlockingAggregator(metrics_store)
+        assert executor.submit(agg)
+        assert 1 == executor.pending
+
+        agg.released.set()
+        assert agg.flushed.wait(1)
+        time.sleep(0.05)
+        assert 0 == executor.pending
+
+    def test_wait_policy(self, metrics_store):
+        """
+        Tests that submitting waits for a running flush to finish when
+        the most flushes are running.
+        """
+        executor = FlushExecutor(max_pending=1, policy="wait")
+        first = BlockingAggregator(metrics_store)
+        executor.submit(first)
+
+        second = BlockingAggregator(metrics_store)
+        second.released.set()
+        thread = threading.Thread(target=executor.submit, args=(second,))
+        thread.start()
+        time.sleep(0.1)
+        assert not second.flushed.is_set()
+
+        first.released.set()
+        thread.join(1)
+        assert second.flushed.wait(1)
+
+    def test_drop_policy(self, metrics_store):
+        """
+        Tests that aggregators are dropped and counted when the most
+        flushes are running.
+        """
+        executor = FlushExecutor(max_pending=1, policy="drop")
+        first = BlockingAggregator(metrics_store)
+        executor.submit(first)
+
+        assert not executor.submit(BlockingAggregator(metrics_store))
+        assert 1 == executor.dropped
+        assert 1 == executor.pending
+        first.released.set()
+
+    def test_merge_policy(self, metrics_store):
+        """
+        Tests that aggregators are merged into the next one submitted
+        when the most flushes are running.
+        """
+        executor = FlushExecutor(max_pending=1, policy="merge")
+        first = BlockingAggregator(metrics_store)
+        executor.submit(first)
+
+        late = BlockingAggregator(metrics_store)
+        late.add_batch({Counter: [("j", 1, None)]})
+        assert not executor.submit(late)
+        assert 1 == executor.merged
+
+        first.released.set()
+        assert first.flushed.wait(1)
+        time.sleep(0.05)
+
+        last = BlockingAggregator(metrics_store)
+        last.timestamp = 10
+        last.add_batch({Counter: [("j", 2, None)]})
+        last.released.set()
+        assert executor.submit(last)
+        assert last.flushed.wait(1)
+
+        assert [("counts.j", 3, 10)] == metrics_store.data
+
+    def test_invalid_settings(self):
+        """
+        Tests that the settings are validated.
+        """
+        with pytest.raises(ValueError):
+            FlushExecutor(max_pending=0)
+
+        with pytest.raises(ValueError):
+            FlushExecutor(policy="random")
@@ -0,0 +1,144 @@
+"""
+Contains tests for the quantile sketch and the HyperLogLog.
+"""
+
+import math
+import random
+import pytest
+from statsite.sketch import HyperLogLog, KLLSketch
+
+class TestKLLSketch(object):
+    def test_exact_stats(self):
+        """
+        Tests that the count, sum, min, max and standard deviation are
+        tracked exactly no matter how many values are compacted away.
+        """
+        values = [random.uniform(0, 1000) for i in xrange(20000)]
+        sketch = KLLSketch()
+        for value in values: sketch.append(value)
+
+        mean = sum(values) / len(values)
+        stdev = (sum([(v - mean) ** 2 for v in values]) / (len(values) - 1)) ** 0.5
+
+        assert len(values) == sketch.count
+        assert abs(sum(values) - sketch.sum) < 1e-6
+        assert min(values) == sketch.min
+        assert max(values) == sketch.max
+        assert abs(stdev - sketch.stdev()) < 1e-6
+
+    def test_bounded_size(self):
+        """
+        Tests that the sketch only holds a bounded number of values.
+        """
+        sketch = KLLSketch(k=100)
+        for i in xrange(100000): sketch.append(i)
+
+        assert 100000 == sum([weight for _, weight in sketch.items()])
+        assert len(sketch.items()) <= 3 * 100 + len(sketch.compactors)
+
+    def test_rank_error(self):
+        """
+        Tests that the ranks of the values in the sketch are close to
+        their true ranks.
+        """
+        values = range(50000)
+        random.shuffle(values)
+        sketch = KLLSketch()
+        for value in values: sketch.append(value)
+
+        rank = 0
+        for value, weight in sketch.items():
+            # The true rank of the value is the value itself
+            assert abs(rank - value) < 0.02 * len(values)
+            rank += weight
+
+    def test_merge(self):
+        """
+        Tests that merging sketches is equivalent to adding all of the
+        values to a single sketch.
+        """
+        sketches = [KLLSketch() for i in xrange(4)]
+        for i in xrange(40000): sketches[i % 4].append(i)
+
+        merged = KLLSketch()
+        for sketch in sketches: merged.merge(sketch)
+
+        assert 40000 == merged.count
+        assert sum(xrange(40000)) == merged.sum
+        assert 0 == merged.min
+        assert 39999 == merged.max
+        assert 40000 == sum([weight for _, weight in merged.items()])
+
+        rank = 0
+        for value, weight in merged.items():
+            assert abs(rank - value) < 0.02 * 40000
+            rank += weight
+
+class TestHyperLogLog(object):
+    def test_error_bound(self):
+        """
+        Tests that the estimates are within three standard errors,
+        1.04 / sqrt(2**precision), of the true cardinality.
+        """
+        for precision in (10, 12, 14):
+            hll = HyperLogLog(precision)
+            error = 1.04 / math.sqrt(2 ** precision)
+            count = 0
+            for cardinality in (100, 1000, 10000, 50000):
+                while count < cardinality:
+                    hll.add("member%d" % count)
+                    count += 1
+
+                assert abs(hll.cardinality() - cardinality) <= 3 * error * cardinality
+
+    def test_duplicates(self):
+        """
+        Tests that adding the same members again doesn't change the
+        estimate.
+        """
+        hll = HyperLogLog()
+        for i in xrange(1000): hll.add(str(i))
+        estimate = hll.cardinality()
+
+        for i in xrange(1000): hll.add(str(i))
+        assert estimate == hll.cardinality()
+
+    def test_fixed_size(self):
+        """
+        Tests that the registers are a fixed size.
+        """
+        hll = HyperLogLog(12)
+        for i in xrange(20000): hll.add(str(i))
+        assert 4096 == len(hll.registers)
+
+    def test_merge(self):
+        """
+        Tests that merging gives the same estimate as adding all of the
+        members to a single HyperLogLog.
+        """
+        a, b, union = HyperLogLog(), HyperLogLog(), HyperLogLog()
+        for i in xrange(0, 6000):
+            a.add(str(i))
+            union.add(str(i))
+        for i in xrange(4000, 10000):
+            b.add(str(i))
+            union.add(str(i))
+
+        a.merge(b)
+        assert union.cardinality() == a.cardinality()
+
+    def test_merge_different_precision(self):
+        """
+        Tests that HyperLogLogs with different precisions can't be merged.
+        """
+        with pytest.raises(ValueError):
+            HyperLogLog(10).merge(HyperLogLog(12))
+
+    def test_invalid_precision(self):
+        """
+        Tests that the precision must be within the supported range.
+        """
+        with pytest.raises(ValueError):
+            HyperLogLog(3)
+        with pytest.raises(ValueError):
+            HyperLogLog(17)
@@ -0,0 +1,113 @@
+"""
+Contains tests for the disk-backed spool.
+"""
+
+import os
+import pytest
+from tests.base import TestBase
+from statsite.spool import RingSpool
+
+class TestRingSpool(TestBase):
+    def pytest_funcarg__spool_path(self, request):
+        """
+        Returns a path for a spool file which is removed after the test.
+        """
+        path = request.getfuncargvalue("tempfile").name + ".spool"
+        request.addfinalizer(lambda: os.path.exists(path) and os.remove(path))
+        return path
+
+    def test_fifo(self, spool_path):
+        """
+        Tests that records come out of the spool in the order they
+        went in.
+        """
+        spool = RingSpool(spool_path, 1024)
+        spool.append("a", 1)
+        spool.append("bb", 2)
+
+        seq, data, count = spool.peek()
+        assert ("a", 1) == (data, count)
+        spool.pop(seq)
+
+        seq, data, count = spool.peek()
+        assert ("bb", 2) == (data, count)
+        spool.pop(seq)
+
+        assert spool.peek() is None
+        assert 0 == len(spool)
+
+    def test_drops_oldest_when_full(self, spool_path):
+        """
+        Tests that the oldest records are dropped to make room, and that
+        the records wrap around the end of the file.
+        """
+        spool = RingSpool(spool_path, 60)
+        for i in xrange(10):
+            spool.append("record%d" % i, i)
+
+        assert 4 == len(spool)
+        assert 6 == spool.dropped
+        assert sum(range(6)) == spool.dropped_count
+
+        records = []
+        while len(spool):
+            seq, data, _ = spool.peek()
+            records.append(data)
+            spool.pop(seq)
+
+        assert ["record6", "record7", "record8", "record9"] == records
+
+    def test_pop_ignores_dropped_record(self, spool_path):
+        """
+        Tests that popping a record which was already dropped to make
+        room doesn't remove the record after it.
+        """
+        spool = RingSpool(spool_path, 40)
+        spool.append("first", 1)
+        seq, _, _ = spool.peek()
+
+        spool.append("second", 1)
+        spool.append("third", 1)
+        spool.pop(seq)
+
+        assert "second" == spool.peek()[1]
+
+    def test_rejects_oversized_record(self, spool_path):
+        """
+        Tests that records larger than the spool aren't appended.
+        """
+        spool = RingSpool(spool_path, 20)
+        assert not spool.append("x" * 20, 1)
+        assert 0 == len(spool)
+
+    def test_survives_reopening(self, spool_path):
+        """
+        Tests that the records are still there when the spool file is
+        opened again.
+        """
+        spool = RingSpool(spool_path, 1024)
+        spool.append("a", 1)
+        spool.append("b", 2)
+        spool.pop(spool.peek()[0])
+        spool.close()
+
+        spool = RingSpool(spool_path, 1024)
+        assert 1 == len(spool)
+        assert "b" == spool.peek()[1]
+
+    def test_fixed_file_size(self, spool_path):
+        """
+        Tests that the spool file doesn't grow past its size.
+        """
+        spool = RingSpool(spool_path, 100)
+        for i in xrange(100):
+            spool.append("record%d" % i, 1)
+
+        assert RingSpool.HEADER.size + 100 == os.path.getsize(spool_path)
+
+    def test_too_small(self, spool_path):
+        """
+        Tests that the spool must be large enough for a record.
+        """
+        with pytest.raises(ValueError):
+            RingSpool(spool_path, 8)
@@ -35,6 +35,19 @@ class TestStatsite(TestBase):
         assert statsite_dummy.aggregator is statsite_dummy.collector.aggregator
         assert statsite_dummy.store is statsite_dummy.aggregator.metrics_store
 
+    def test_aggregators_share_metrics_state(self, statsite_dummy):
+        """
+        Tests that each aggregator is given the same metrics state, so
+        that gauges carry across flush intervals, along with its lock.
+        """
+        original = statsite_dummy.aggregator
+        statsite_dummy._flush_and_switch_aggregator()
+
+        assert original.metrics_state is statsite_dummy.metrics_state
+        assert statsite_dummy.aggregator.metrics_state is statsite_dummy.metrics_state
+        assert original.metrics_lock is statsite_dummy.metrics_lock
+        assert statsite_dummy.aggregator.metrics_lock is statsite_dummy.metrics_lock
+
     def test_flush_and_switch_aggregator(self, statsite_dummy):
         """
         Tests that flushing and switching the aggregator properly
@@ -50,3 +63,108 @@ class TestStatsite(TestBase):
         assert statsite_dummy.aggregator is statsite_dummy.collector.aggregator
         assert original is not statsite_dummy.aggregator
         assert original.flushed
+
+    def test_flush_and_switch_stamps_interval(self, statsite_dummy):
+        """
+        Tests that the aggregator being flushed is given the end of the
+        flush interval to stamp the metrics with.
+        """
+        original = statsite_dummy.aggregator
+        statsite_dummy._flush_and_switch_aggregator(120)
+
+        assert 120 == original.timestamp
+        assert statsite_dummy.aggregator.timestamp is None
+
+    def test_internal_metrics(self, statsite_dummy):
+        """
+        Tests that the internal metrics are how much the totals went up
+        by since the last flush.
+        """
+        collector = statsite_dummy.collector
+        collector.lines = 5
+        first = statsite_dummy._internal_metrics()
+        collector.lines = 7
+        second = statsite_dummy._internal_metrics()
+
+        assert 5 == first["collector.lines"]
+        assert 2 == second["collector.lines"]
+        assert 0 == second["flush.pending"]
+
+    def test_flush_and_switch_instrumentation(self):
+        """
+        Tests that the aggregator being flushed is given the internal
+        metrics only when self-instrumentation is enabled.
+        """
+        settings = {
+            "aggregator": {"class": "tests.helpers.DumbAggregator"},
+            "collector": {"class": "tests.helpers.DumbCollector"},
+            "store": {"class": "tests.helpers.DumbMetricsStore"},
+            "instrumentation": {"enabled": "true", "namespace": "self"}
+        }
+        server = Statsite(settings)
+        original = server.aggregator
+        server._flush_and_switch_aggregator(120)
+
+        assert "self" == original.internal_namespace
+        assert "collector.packets" in original.internal_metrics
+
+    def test_flush_and_switch_no_instrumentation(self, statsite_dummy):
+        """
+        Tests that there are no internal metrics by default.
+        """
+        original = statsite_dummy.aggregator
+        statsite_dummy._flush_and_switch_aggregator(120)
+
+        assert original.internal_metrics is None
+
+    def test_flush_and_switch_merges_partials(self, statsite_dummy):
+        """
+        Tests that partial aggregates from the collector are merged into
+        the aggregator being flushed.
+        """
+        original = statsite_dummy.aggregator
+        statsite_dummy.collector.partials = [{"a": 1}, {"b": 2}]
+        statsite_dummy._flush_and_switch_aggregator()
+
+        assert [{"a": 1}, {"b": 2}] == original.merged
+        assert [] == statsite_dummy.aggregator.merged
+
+    def test_stats(self, statsite_dummy):
+        """
+        Tests that the stats report what the collector received and
+        how the flushes are keeping up.
+        """
+        statsite_dummy.collector.lines = 5
+        statsite_dummy.executor.pending = 1
+        stats = statsite_dummy.stats()
+
+        assert 5 == stats["collector.lines"]
+        assert 1 == stats["flush.pending"]
+        assert 0 == stats["aggregator.keys"]
+        assert 0.0 == stats["flush.lag"]
+
+    def test_stats_without_aggregator_size(self, statsite_dummy):
+        """
+        Tests that the keys and samples are left out for collectors
+        which aggregate in other processes.
+        """
+        statsite_dummy.collector.aggregates_elsewhere = True
+        stats = statsite_dummy.stats()
+
+        assert "aggregator.keys" not in stats
+        assert "aggregator.samples" not in stats
+        assert "flush.pending" in stats
+
+    def test_healthy(self, statsite_dummy):
+        """
+        Tests that the server is healthy until the next flush is overdue
+        by more than the most flush lag allowed.
+        """
+        statsite_dummy.settings["aliveness_check"]["max_flush_lag"] = 5
+        assert statsite_dummy.healthy()
+
+        statsite_dummy.executor.last_flushed = time.time() - 12
+        assert statsite_dummy.healthy()
+
+        statsite_dummy.executor.last_flushed = time.time() - 30
+        assert not statsite_dummy.healthy()
@@ -61,3 +61,192 @@ class TestResolveClassString(TestBase):
         """
         result = statsite.util.resolve_class_string("os.getlogin")
         assert callable(result)
+
+class TestToBool(TestBase):
+    def test_strings(self):
+        """
+        Tests that settings from configuration files are converted.
+        """
+        assert statsite.util.to_bool("true")
+        assert statsite.util.to_bool(" Yes ")
+        assert statsite.util.to_bool("1")
+        assert not statsite.util.to_bool("false")
+        assert not statsite.util.to_bool("0")
+
+    def test_non_strings(self):
+        """
+        Tests that other values use their truthiness.
+        """
+        assert statsite.util.to_bool(True)
+        assert not statsite.util.to_bool(0)
+        assert not statsite.util.to_bool(None)
+
+class TestLRUCache(TestBase):
+    def test_counts_hits_and_misses(self):
+        """
+        Tests that lookups are counted as hits or misses.
+        """
+        cache = statsite.util.LRUCache(10)
+        assert cache.get("a") is None
+        cache.set("a", 1)
+        assert 1 == cache.get("a")
+
+        assert 1 == cache.hits
+        assert 1 == cache.misses
+
+    def test_evicts_unused(self):
+        """
+        Tests that entries which aren't used are evicted, while those which
+        are used stay cached.
+        """
+        cache = statsite.util.LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.set("c", 3)
+        assert 1 == cache.get("a")
+        cache.set("d", 4)
+        cache.set("e", 5)
+
+        assert 1 == cache.get("a")
+        assert cache.get("b") is None
+        assert len(cache) <= 4
+
+    def test_size_must_be_positive(self):
+        """
+        Tests that a cache can't be empty.
+        """
+        with pytest.raises(ValueError):
+            statsite.util.LRUCache(0)
+
+class TestOutputNames(TestBase):
+    def test_names(self):
+        """
+        Tests that the names have the prefix, namespace and suffixes.
+        """
+        lookup = statsite.util.OutputNames("foo").lookup("timers", (".sum", ".mean"))
+        assert ("foo.timers.k.sum", "foo.timers.k.mean") == lookup("k")
+
+    def test_no_prefix_or_namespace(self):
+        """
+        Tests that the names have no leading dot without a prefix or
+        namespace.
+        """
+        assert ("k",) == statsite.util.OutputNames().lookup("")("k")
+
+    def test_caches_across_lookups(self):
+        """
+        Tests that the names are cached across the lookups of each flush.
+        """
+        names = statsite.util.OutputNames("foo")
+        for _ in xrange(3):
+            assert ("foo.counts.k",) == names.lookup("counts")("k")
+
+        assert 2 == names.hits
+        assert 1 == names.misses
+
+    def test_namespaces_are_separate(self):
+        """
+        Tests that the same key is named separately in each namespace.
+        """
+        names = statsite.util.OutputNames()
+        assert ("counts.k",) == names.lookup("counts")("k")
+        assert ("gauges.k",) == names.lookup("gauges")("k")
+        assert 2 == names.misses
+
+class TestKeyLimiter(TestBase):
+    def test_max_keys(self):
+        """
+        Tests that new keys past the limit are replaced by the overflow
+        key, while keys already admitted are kept.
+        """
+        limiter = statsite.util.KeyLimiter(max_keys=2)
+        assert "a" == limiter.limit("a")
+        assert "b" == limiter.limit("b")
+        assert "overflow" == limiter.limit("c")
+        assert "a" == limiter.limit("a")
+        assert "overflow" == limiter.limit("c")
+        assert 2 == limiter.overflowed
+
+    def test_max_keys_per_prefix(self):
+        """
+        Tests that new keys past the limit of their prefix are replaced
+        by the overflow key of the prefix.
+        """
+        limiter = statsite.util.KeyLimiter(max_keys_per_prefix=1, overflow_key="other")
+        assert "api.a" == limiter.limit("api.a")
+        assert "api.other" == limiter.limit("api.b")
+        assert "api.other" == limiter.limit("api.c")
+        assert "web.a" == limiter.limit("web.a")
+        assert "solo" == limiter.limit("solo")
+        assert 2 == limiter.overflowed
+
+    def test_prefix_depth(self):
+        """
+        Tests that the prefix is made up of the given number of parts.
+        """
+        limiter = statsite.util.KeyLimiter(max_keys_per_prefix=1, prefix_depth=2)
+        assert "app.api.a" == limiter.limit("app.api.a")
+        assert "app.web.a" == limiter.limit("app.web.a")
+        assert "app.api.overflow" == limiter.limit("app.api.b")
+
+    def test_limit_records(self):
+        """
+        Tests that the keys of records are limited, and that the list is
+        returned as is when every key was already admitted.
+        """
+        limiter = statsite.util.KeyLimiter(max_keys=1)
+        records = [("a", 1, None), ("b", 2, 0.5), ("a", 3, None)]
+        assert [("a", 1, None), ("overflow", 2, 0.5), ("a", 3, None)] == limiter.limit_records(records)
+
+        admitted = [("a", 4, None)]
+        assert admitted is limiter.limit_records(admitted)
+
+    def test_admit(self):
+        """
+        Tests that admitted keys are kept whatever the limits, and count
+        towards the limits of the keys which come after them.
+        """
+        limiter = statsite.util.KeyLimiter(max_keys=4, max_keys_per_prefix=1)
+        limiter.admit(["api.a", "api.b", "api.overflow"])
+        assert 2 == limiter.prefixes["api"]
+        assert "api.b" == limiter.limit("api.b")
+        assert "api.overflow" == limiter.limit("api.c")
+        assert "web.a" == limiter.limit("web.a")
+        assert "overflow" == limiter.limit("web.b")
+
+    def test_overflow_keys_not_counted_again(self):
+        """
+        Tests that limiting an overflow key again doesn't count it as
+        overflowed, since its keys were counted when they overflowed.
+        """
+        limiter = statsite.util.KeyLimiter(max_keys=1, max_keys_per_prefix=1)
+        limiter.admit(["a"])
+        assert "overflow" == limiter.limit("overflow")
+        assert "overflow" == limiter.limit("api.overflow")
+        assert 0 == limiter.overflowed
+
+        limiter = statsite.util.KeyLimiter(max_keys_per_prefix=1)
+        limiter.admit(["api.a"])
+        assert "api.overflow" == limiter.limit("api.overflow")
+        assert 0 == limiter.overflowed
+        assert 1 == limiter.prefixes["api"]
+
+    def test_reset(self):
+        """
+        Tests that resetting forgets the keys admitted.
+        """
+        limiter = statsite.util.KeyLimiter(max_keys=1)
+        limiter.limit("a")
+        limiter.reset()
+        assert "b" == limiter.limit("b")
+        assert 0 == limiter.overflowed
+
+    def test_invalid(self):
+        """
+        Tests that the limits are validated.
+        """
+        with pytest.raises(ValueError):
+            statsite.util.KeyLimiter(max_keys=-1)
+
+        with pytest.raises(ValueError):
+            statsite.util.KeyLimiter(prefix_depth=0)